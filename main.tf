@@ -304,6 +304,9 @@ module "stack" {
   service_control_lambda_reserved_concurrency          = var.service_control_lambda_reserved_concurrency
   service_control_schedule_overrides                   = var.service_control_schedule_overrides
   service_control_schedule_overwrite                   = var.service_control_schedule_overwrite
+  service_control_holiday_overrides                    = var.service_control_holiday_overrides
+  service_control_prewarm                              = var.service_control_prewarm
+  ecs_logs_duplicate_routes                            = var.ecs_logs_duplicate_routes
   service_control_metrics_stream_services              = var.service_control_metrics_stream_services
   service_control_metrics_bucket_name                  = var.service_control_metrics_bucket_name
   service_control_metrics_bucket_kms_key_arn           = var.service_control_metrics_bucket_kms_key_arn
@@ -65,6 +65,20 @@ resource "aws_s3_bucket_lifecycle_configuration" "alb_access_logs" {
       days = var.alb_access_logs_retention_days
     }
   }
+
+  # The realm sorter Lambda writes its outputs with multipart uploads; clean up parts left by timed-out invocations.
+  rule {
+    id     = "abort-incomplete-multipart-uploads"
+    status = "Enabled"
+
+    filter {
+      prefix = ""
+    }
+
+    abort_incomplete_multipart_upload {
+      days_after_initiation = 1
+    }
+  }
 }
 
 data "aws_iam_policy_document" "alb_access_logs" {
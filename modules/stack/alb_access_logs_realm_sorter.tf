@@ -5,6 +5,16 @@ locals {
   alb_access_logs_realm_sorter_target_prefix        = trim(var.alb_access_logs_realm_sorter_target_prefix, "/")
   alb_access_logs_realm_sorter_realms               = length(var.realms) > 0 ? var.realms : [local.keycloak_realm_effective]
   alb_access_logs_realm_sorter_realms_csv           = join(",", local.alb_access_logs_realm_sorter_realms)
+  alb_access_logs_realm_sorter_concurrency          = 4
+  alb_access_logs_realm_sorter_part_size_mb         = 8
+  # Each in-flight source object keeps one gzip output buffer per realm (the default realm included) that grows up to
+  # the multipart part size, so buffered output peaks at concurrency x realms x part size. Size the function for that
+  # bound (plus 1 MiB of compressor state per buffer) on top of 128 MiB for the runtime and the object being read.
+  alb_access_logs_realm_sorter_output_realms = length(distinct(concat(local.alb_access_logs_realm_sorter_realms, [local.keycloak_realm_effective])))
+  alb_access_logs_realm_sorter_memory_mb     = max(
+    256,
+    128 + local.alb_access_logs_realm_sorter_concurrency * local.alb_access_logs_realm_sorter_output_realms * (local.alb_access_logs_realm_sorter_part_size_mb + 1)
+  )
 }
 
 data "archive_file" "alb_access_logs_realm_sorter_lambda" {
@@ -40,7 +50,7 @@ data "aws_iam_policy_document" "alb_access_logs_realm_sorter_inline" {
 
     content {
       actions = concat(
-        ["s3:GetObject", "s3:PutObject"],
+        ["s3:GetObject", "s3:PutObject", "s3:AbortMultipartUpload"],
         var.alb_access_logs_realm_sorter_delete_source ? ["s3:DeleteObject"] : []
       )
       resources = ["${statement.value}/*"]
@@ -74,19 +84,24 @@ resource "aws_lambda_function" "alb_access_logs_realm_sorter" {
   handler       = "alb_access_logs_realm_sorter_lambda.handler"
   runtime       = "python3.12"
   timeout       = 30
-  memory_size   = 256
+  memory_size   = local.alb_access_logs_realm_sorter_memory_mb
 
   filename         = data.archive_file.alb_access_logs_realm_sorter_lambda.output_path
   source_code_hash = data.archive_file.alb_access_logs_realm_sorter_lambda.output_base64sha256
 
   environment {
     variables = {
-      SOURCE_PREFIX = local.alb_access_logs_realm_sorter_source_prefix_filter
-      TARGET_PREFIX = local.alb_access_logs_realm_sorter_target_prefix
-      DEFAULT_REALM = local.keycloak_realm_effective
-      REALMS        = local.alb_access_logs_realm_sorter_realms_csv
-      DELETE_SOURCE = var.alb_access_logs_realm_sorter_delete_source ? "true" : "false"
-      LOG_LEVEL     = "INFO"
+      SOURCE_PREFIX          = local.alb_access_logs_realm_sorter_source_prefix_filter
+      TARGET_PREFIX          = local.alb_access_logs_realm_sorter_target_prefix
+      DEFAULT_REALM          = local.keycloak_realm_effective
+      REALMS                 = local.alb_access_logs_realm_sorter_realms_csv
+      DELETE_SOURCE          = var.alb_access_logs_realm_sorter_delete_source ? "true" : "false"
+      MULTIPART_PART_SIZE_MB = tostring(local.alb_access_logs_realm_sorter_part_size_mb)
+      MAX_CONCURRENCY        = tostring(local.alb_access_logs_realm_sorter_concurrency)
+      REALM_CACHE_SIZE       = "1024"
+      WRITE_STATS            = "true"
+      STATS_PREFIX           = "alb-stats"
+      LOG_LEVEL              = "INFO"
     }
   }
 
@@ -6,8 +6,18 @@ data "archive_file" "ecs_logs_duplicate_lambda" {
   count = local.ecs_logs_duplicate_enabled ? 1 : 0
 
   type        = "zip"
-  source_file = "${path.module}/templates/ecs_logs_duplicate_lambda.py"
   output_path = "${path.module}/templates/ecs_logs_duplicate_lambda.zip"
+
+  source {
+    content  = file("${path.module}/templates/ecs_logs_duplicate_lambda.py")
+    filename = "ecs_logs_duplicate_lambda.py"
+  }
+
+  # Shared JSON codec (uses orjson/msgspec when bundled, stdlib json otherwise).
+  source {
+    content  = file("${path.module}/templates/json_codec.py")
+    filename = "json_codec.py"
+  }
 }
 
 data "aws_iam_policy_document" "ecs_logs_duplicate_assume" {
@@ -29,7 +39,6 @@ data "aws_iam_policy_document" "ecs_logs_duplicate_inline" {
     actions = [
       "logs:CreateLogGroup",
       "logs:CreateLogStream",
-      "logs:DescribeLogStreams",
       "logs:PutLogEvents"
     ]
     resources = [
@@ -72,6 +81,8 @@ resource "aws_lambda_function" "ecs_logs_duplicate" {
   role          = aws_iam_role.ecs_logs_duplicate[0].arn
   handler       = "ecs_logs_duplicate_lambda.handler"
   runtime       = "python3.11"
+  # PutLogEvents の再試行（バックオフ込み）が収まるようにする。既定の 3 秒ではスロットリング時に途中でタイムアウトする
+  timeout = 60
 
   filename         = data.archive_file.ecs_logs_duplicate_lambda[0].output_path
   source_code_hash = data.archive_file.ecs_logs_duplicate_lambda[0].output_base64sha256
@@ -79,6 +90,7 @@ resource "aws_lambda_function" "ecs_logs_duplicate" {
   environment {
     variables = {
       NAME_PREFIX = local.name_prefix
+      LOG_ROUTES  = length(var.ecs_logs_duplicate_routes) > 0 ? jsonencode([for route in var.ecs_logs_duplicate_routes : { for k, v in route : k => v if v != null }]) : ""
     }
   }
 
@@ -15,8 +15,18 @@ locals {
 
 data "archive_file" "logs_firehose_processor" {
   type        = "zip"
-  source_file = "${path.module}/templates/cloudwatch_logs_to_json_lambda.py"
   output_path = "${path.module}/templates/cloudwatch_logs_to_json_lambda.zip"
+
+  source {
+    content  = file("${path.module}/templates/cloudwatch_logs_to_json_lambda.py")
+    filename = "cloudwatch_logs_to_json_lambda.py"
+  }
+
+  # Shared JSON codec (uses orjson/msgspec when bundled, stdlib json otherwise).
+  source {
+    content  = file("${path.module}/templates/json_codec.py")
+    filename = "json_codec.py"
+  }
 }
 
 data "aws_iam_policy_document" "logs_firehose_processor_assume" {
@@ -44,6 +54,24 @@ resource "aws_iam_role_policy_attachment" "logs_firehose_processor_basic" {
   policy_arn = "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"
 }
 
+data "aws_iam_policy_document" "logs_firehose_processor_inline" {
+  count = local.logs_firehose_processing_enabled ? 1 : 0
+
+  # Re-ingest records that would push the response over the 6 MB Lambda limit.
+  statement {
+    actions   = ["firehose:PutRecordBatch"]
+    resources = ["arn:aws:firehose:${var.region}:${local.account_id}:deliverystream/${local.name_prefix}-*"]
+  }
+}
+
+resource "aws_iam_role_policy" "logs_firehose_processor" {
+  count = local.logs_firehose_processing_enabled ? 1 : 0
+
+  name   = "${local.name_prefix}-logs-firehose-processor"
+  role   = aws_iam_role.logs_firehose_processor[0].id
+  policy = data.aws_iam_policy_document.logs_firehose_processor_inline[0].json
+}
+
 resource "aws_lambda_function" "logs_firehose_processor" {
   count = local.logs_firehose_processing_enabled ? 1 : 0
 
@@ -56,6 +84,12 @@ resource "aws_lambda_function" "logs_firehose_processor" {
   filename         = data.archive_file.logs_firehose_processor.output_path
   source_code_hash = data.archive_file.logs_firehose_processor.output_base64sha256
 
+  environment {
+    variables = {
+      RESPONSE_SIZE_LIMIT = "6000000"
+    }
+  }
+
   tags = merge(local.tags, { Name = "${local.name_prefix}-logs-firehose-processor" })
 }
 
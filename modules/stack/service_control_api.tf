@@ -97,14 +97,58 @@ locals {
 
 data "archive_file" "service_control_lambda" {
   type        = "zip"
-  source_file = "${path.module}/templates/service_control_lambda.py"
   output_path = "${path.module}/templates/service_control_lambda.zip"
+
+  source {
+    content  = file("${path.module}/templates/service_control_lambda.py")
+    filename = "service_control_lambda.py"
+  }
+
+  # Shared SSM parameter cache (batched GetParameters with a warm-container TTL).
+  source {
+    content  = file("${path.module}/templates/ssm_cache.py")
+    filename = "ssm_cache.py"
+  }
+
+  # Shared schedule timeline (holiday-aware active windows, next start/stop).
+  source {
+    content  = file("${path.module}/templates/service_schedule.py")
+    filename = "service_schedule.py"
+  }
+
+  # Precomputed holiday bitmap (regenerate with: python3 templates/service_schedule.py).
+  source {
+    content  = file("${path.module}/templates/japan_holidays.json")
+    filename = "japan_holidays.json"
+  }
 }
 
 data "archive_file" "service_control_scheduler" {
   type        = "zip"
-  source_file = "${path.module}/templates/service_control_scheduler.py"
   output_path = "${path.module}/templates/service_control_scheduler.zip"
+
+  source {
+    content  = file("${path.module}/templates/service_control_scheduler.py")
+    filename = "service_control_scheduler.py"
+  }
+
+  # Shared SSM parameter cache (batched GetParameters with a warm-container TTL).
+  source {
+    content  = file("${path.module}/templates/ssm_cache.py")
+    filename = "ssm_cache.py"
+  }
+
+  # Shared schedule timeline (holiday-aware active windows, next start/stop).
+  source {
+    content  = file("${path.module}/templates/service_schedule.py")
+    filename = "service_schedule.py"
+  }
+
+  # Precomputed holiday bitmap (regenerate with: python3 templates/service_schedule.py).
+  source {
+    content  = file("${path.module}/templates/japan_holidays.json")
+    filename = "japan_holidays.json"
+  }
 }
 
 data "aws_iam_policy_document" "service_control_assume" {
@@ -167,10 +211,20 @@ data "aws_iam_policy_document" "service_control_inline" {
     resources = ["*"]
   }
 
+  # スケジューラがアイドル停止アラームの現在の設定を比較し、予測起動のためにリクエスト数の履歴を読むため
+  statement {
+    actions = [
+      "cloudwatch:DescribeAlarms",
+      "cloudwatch:GetMetricData"
+    ]
+    resources = ["*"]
+  }
+
   # ECR イメージタグ取得
   statement {
     actions = [
-      "ecr:DescribeImages"
+      "ecr:DescribeImages",
+      "ecr:ListImages"
     ]
     resources = ["*"]
   }
@@ -190,13 +244,15 @@ data "aws_iam_policy_document" "service_control_inline" {
   statement {
     actions = [
       "ssm:GetParameter",
+      "ssm:GetParameters",
       "ssm:PutParameter"
     ]
     resources = ["arn:aws:ssm:${var.region}:${data.aws_caller_identity.current.account_id}:parameter${local.service_control_schedule_prefix}/*"]
   }
   statement {
     actions = [
-      "ssm:GetParameter"
+      "ssm:GetParameter",
+      "ssm:GetParameters"
     ]
     resources = [
       "arn:aws:ssm:${var.region}:${data.aws_caller_identity.current.account_id}:parameter${local.keycloak_admin_username_parameter_name}",
@@ -289,6 +345,7 @@ resource "aws_lambda_function" "service_control" {
         ODOO_ADMIN_PASSWORD_SSM_PARAMETER     = local.odoo_admin_password_parameter_name
         PGADMIN_ADMIN_USERNAME                = "admin@${local.hosted_zone_name_input}"
         PGADMIN_PASSWORD_SSM_PARAMETER        = local.pgadmin_default_password_parameter_name
+        SERVICE_CONTROL_HOLIDAY_OVERRIDES     = jsonencode(var.service_control_holiday_overrides)
       },
       var.create_ssm_parameters ? {
         SERVICE_ARNS_SSM_PARAMETER      = aws_ssm_parameter.service_control_service_arns[0].name
@@ -328,6 +385,11 @@ resource "aws_lambda_function" "service_control_scheduler" {
         SERVICE_CONTROL_AUTOSTOP_ALARM_REGION             = var.region
         SERVICE_CONTROL_AUTOSTOP_WAF_NAME                 = try(aws_wafv2_web_acl.alb[0].name, "")
         SERVICE_CONTROL_AUTOSTOP_ALARM_TREAT_MISSING_DATA = "breaching"
+        SERVICE_CONTROL_HOLIDAY_OVERRIDES                 = jsonencode(var.service_control_holiday_overrides)
+        SERVICE_CONTROL_PREWARM_ENABLED                   = tostring(var.service_control_prewarm.enabled)
+        SERVICE_CONTROL_PREWARM_LEAD_MINUTES              = tostring(var.service_control_prewarm.lead_minutes)
+        SERVICE_CONTROL_PREWARM_LOOKBACK_DAYS             = tostring(var.service_control_prewarm.lookback_days)
+        SERVICE_CONTROL_PREWARM_MIN_PROBABILITY           = tostring(var.service_control_prewarm.min_probability)
       },
       var.create_ssm_parameters ? {
         SERVICE_ARNS_SSM_PARAMETER                    = aws_ssm_parameter.service_control_service_arns[0].name
@@ -422,6 +484,9 @@ resource "aws_apigatewayv2_route" "service_control" {
     "GET /status" = {
       route = "GET /status"
     }
+    "GET /status/all" = {
+      route = "GET /status/all"
+    }
     "POST /start" = {
       route = "POST /start"
     }
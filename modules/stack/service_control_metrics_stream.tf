@@ -185,8 +185,18 @@ resource "aws_s3_bucket_object_lock_configuration" "service_control_metrics" {
 
 data "archive_file" "service_control_metrics_filter" {
   type        = "zip"
-  source_file = "${path.module}/templates/service_control_metric_stream_filter.py"
   output_path = "${path.module}/templates/service_control_metric_stream_filter.zip"
+
+  source {
+    content  = file("${path.module}/templates/service_control_metric_stream_filter.py")
+    filename = "service_control_metric_stream_filter.py"
+  }
+
+  # Shared JSON codec (uses orjson/msgspec when bundled, stdlib json otherwise).
+  source {
+    content  = file("${path.module}/templates/json_codec.py")
+    filename = "json_codec.py"
+  }
 }
 
 data "aws_iam_policy_document" "service_control_metrics_filter_assume" {
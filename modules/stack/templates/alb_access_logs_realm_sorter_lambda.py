@@ -1,9 +1,18 @@
+import functools
 import gzip
 import io
+import json
 import logging
 import os
+import re
 import shlex
+import struct
+import sys
+import threading
 import urllib.parse
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import boto3
 from botocore.exceptions import ClientError
@@ -22,13 +31,41 @@ DEFAULT_REALM = os.environ.get("DEFAULT_REALM", "").strip() or "default"
 REALMS = [r.strip() for r in os.environ.get("REALMS", "").split(",") if r.strip()]
 REALMS_SET = set(REALMS) if REALMS else {DEFAULT_REALM}
 DELETE_SOURCE = os.environ.get("DELETE_SOURCE", "false").lower() in ("1", "true", "yes")
+WRITE_STATS = os.environ.get("WRITE_STATS", "true").lower() in ("1", "true", "yes")
+# Athena の realm 別テーブルは TARGET_PREFIX/<realm>/ 配下を全て読むため、統計サイドカーは別プレフィックスに置く
+STATS_PREFIX = _normalize_prefix(os.environ.get("STATS_PREFIX", "alb-stats"))
+STATS_SUFFIX = ".stats"
+# S3 multipart upload の最小パートサイズは 5 MiB（最終パートを除く）
+MIN_PART_SIZE = 5 * 1024 * 1024
+PART_SIZE = max(MIN_PART_SIZE, int(os.environ.get("MULTIPART_PART_SIZE_MB", "8") or "8") * 1024 * 1024)
+# 同時に処理するソースオブジェクト数と、realm 出力の確定（最終パート送信・complete）の同時実行数
+MAX_CONCURRENCY = max(1, int(os.environ.get("MAX_CONCURRENCY", "4") or "4"))
+REALM_CACHE_SIZE = max(1, int(os.environ.get("REALM_CACHE_SIZE", "1024") or "1024"))
 
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
+# ソースオブジェクト用とは別プールにして、オブジェクト処理中に出力確定を待ってもデッドロックしないようにする
+_upload_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
 
-def _extract_host(line):
+# 処理中のオブジェクトの realmCache 集計。1 つのオブジェクトは 1 スレッドで処理する
+_thread_state = threading.local()
+
+
+# ALB アクセスログの 13 番目のフィールド（最初の引用符付きフィールド）が "request"。
+# 先頭 12 フィールドは空白・引用符を含まないため、位置だけで target_processing_time(7)、
+# elb_status_code(9)、sent_bytes(12) と request 内の URL ホストを取り出せる。
+# 数字のポート・パス・クエリ以外で終わるホスト（userinfo や IPv6 リテラル等）は group(4) を空にし shlex の経路に任せる。
+ALB_LINE_RE = re.compile(
+    rb'(?:[^ "]* ){6}([^ "]*) [^ "]* ([^ "]*) [^ "]* [^ "]* ([^ "]*) "(?:[^ "]* https?://([^/?#:@\[\]" ]+)(?::[0-9]*)?[/?#" ])?'
+)
+# target_processing_time のヒストグラム境界（秒）。1ms から約 131s まで 2^(1/4) 刻み、最後のバケットは超過分
+TPT_BUCKET_BOUNDS = tuple(0.001 * 2 ** (i / 4) for i in range(69))
+TPT_PERCENTILES = (50, 90, 95, 99)
+
+
+def _extract_host_slow(line):
     try:
         parts = shlex.split(line)
     except ValueError:
@@ -65,7 +102,35 @@ def _realm_from_host(host):
     return candidate if candidate in REALMS_SET else DEFAULT_REALM
 
 
-def _target_key(source_key, realm):
+# ホスト名（ログ行の生バイト列）→ realm の LRU。ウォームコンテナの間は呼び出しをまたいで再利用する。
+# lru_cache はロックを取らないため、ヒットした行のコストは辞書の参照 1 回で済む
+@functools.lru_cache(maxsize=REALM_CACHE_SIZE)
+def _realm_for_host_bytes(host_bytes):
+    # キャッシュに無いときだけ呼ばれる。呼び出し元でヒットとして数えた分をミスに付け替える
+    cache_stats = getattr(_thread_state, "cache_stats", None)
+    if cache_stats is not None:
+        cache_stats["hits"] -= 1
+        cache_stats["misses"] += 1
+    return _realm_from_host(host_bytes.decode("utf-8", "replace").lower())
+
+
+def _new_cache_stats():
+    # hits + misses + uncached（正規表現でホストを取り出せず shlex の経路で判定した行）= 行数
+    cache_stats = {"hits": 0, "misses": 0, "uncached": 0}
+    _thread_state.cache_stats = cache_stats
+    return cache_stats
+
+
+def _realm_for_line(line_bytes, match, cache_stats):
+    host_bytes = match.group(4) if match else None
+    if not host_bytes:
+        cache_stats["uncached"] += 1
+        return _realm_from_host(_extract_host_slow(line_bytes.decode("utf-8", "replace")))
+    cache_stats["hits"] += 1
+    return _realm_for_host_bytes(host_bytes)
+
+
+def _target_key(source_key, realm, prefix=TARGET_PREFIX):
     key = source_key
     if SOURCE_PREFIX and key.startswith(SOURCE_PREFIX):
         key = key[len(SOURCE_PREFIX) :]
@@ -77,8 +142,8 @@ def _target_key(source_key, realm):
     if len(parts) > 1 and parts[0] == DEFAULT_REALM:
         key = parts[1]
 
-    if TARGET_PREFIX:
-        return f"{TARGET_PREFIX}{realm}/{key}"
+    if prefix:
+        return f"{prefix}{realm}/{key}"
     return f"{realm}/{key}"
 
 
@@ -92,83 +157,264 @@ def _iter_lines(body, is_gzip):
             yield line + b"\n"
 
 
-def _get_writer(buffers, realm):
-    writer = buffers.get(realm)
-    if writer:
-        return writer
-    raw = io.BytesIO()
-    gz = gzip.GzipFile(fileobj=raw, mode="wb")
-    writer = (raw, gz)
-    buffers[realm] = writer
+# realm ごとの gzip 出力を PART_SIZE 単位で S3 multipart upload へ流し、メモリ使用量を抑える。
+# バッファは同時処理中のオブジェクト x realm ごとに最大 PART_SIZE で、Lambda のメモリはこの上限から決める（.tf 参照）。
+# 送信時はバッファをそのまま Body に渡し、パート分の複製を作らない
+class _RealmWriter:
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.raw = io.BytesIO()
+        self.gz = gzip.GzipFile(fileobj=self.raw, mode="wb")
+        self.upload_id = None
+        self.parts = []
+
+    def write(self, line_bytes):
+        self.gz.write(line_bytes)
+        if self.raw.tell() >= PART_SIZE:
+            self._flush_part()
+
+    def _flush_part(self):
+        if not self.raw.tell():
+            return
+        if self.upload_id is None:
+            resp = s3.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                ContentType="text/plain",
+                ContentEncoding="gzip",
+            )
+            self.upload_id = resp["UploadId"]
+        part_number = len(self.parts) + 1
+        self.raw.seek(0)
+        resp = s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=self.raw,
+        )
+        self.parts.append({"ETag": resp["ETag"], "PartNumber": part_number})
+        self.raw.seek(0)
+        self.raw.truncate()
+
+    def close(self):
+        self.gz.close()
+        if self.upload_id is None:
+            # PART_SIZE に届かなかった出力は従来どおり 1 回の put_object で書き込む
+            self.raw.seek(0)
+            s3.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=self.raw,
+                ContentType="text/plain",
+                ContentEncoding="gzip",
+            )
+            return
+        self._flush_part()
+        s3.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+    def abort(self):
+        if self.upload_id is None:
+            return
+        try:
+            s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except ClientError as exc:
+            logger.warning("failed to abort multipart upload: %s (%s)", self.key, exc)
+
+
+# realm ごとの集計（リクエスト数・ステータス別件数・送信バイト数・target_processing_time ヒストグラム）。
+# 行数に関わらずメモリは一定で、パーセンタイルはヒストグラムのバケット上限から近似する
+class _RealmStats:
+    def __init__(self):
+        self.requests = 0
+        self.bytes_sent = 0
+        self.status = {}
+        self.tpt_counts = array("Q", [0]) * (len(TPT_BUCKET_BOUNDS) + 1)
+        self.tpt_max = 0.0
+
+    def add(self, match):
+        self.requests += 1
+        if not match:
+            return
+        tpt, status, sent = match.group(1, 2, 3)
+        if status.isdigit():
+            code = int(status)
+            self.status[code] = self.status.get(code, 0) + 1
+        if sent.isdigit():
+            self.bytes_sent += int(sent)
+        try:
+            value = float(tpt)
+        except ValueError:
+            return
+        # -1 はターゲットへ転送されなかった / 応答が無かったリクエスト
+        if value < 0:
+            return
+        self.tpt_counts[bisect_left(TPT_BUCKET_BOUNDS, value)] += 1
+        if value > self.tpt_max:
+            self.tpt_max = value
+
+    def _percentile(self, total, pct):
+        threshold = total * pct / 100
+        cumulative = 0
+        for index, count in enumerate(self.tpt_counts):
+            cumulative += count
+            if count and cumulative >= threshold:
+                if index < len(TPT_BUCKET_BOUNDS):
+                    return min(TPT_BUCKET_BOUNDS[index], self.tpt_max)
+                return self.tpt_max
+        return None
+
+    def encode(self, realm, source_key):
+        # 形式: b"ALBSTAT1" + uint32(LE) ヘッダ長 + JSON ヘッダ + ヘッダの columns 順に並べたリトルエンディアン配列
+        codes = sorted(self.status)
+        tpt_total = sum(self.tpt_counts)
+        columns = [
+            ("status_code", array("H", codes)),
+            ("status_count", array("Q", [self.status[code] for code in codes])),
+            ("tpt_bucket_upper_seconds", array("d", TPT_BUCKET_BOUNDS)),
+            ("tpt_bucket_count", self.tpt_counts),
+        ]
+        header = {
+            "version": 1,
+            "realm": realm,
+            "source": source_key,
+            "requests": self.requests,
+            "bytesSent": self.bytes_sent,
+            "targetProcessingTime": {
+                "count": tpt_total,
+                "max": self.tpt_max if tpt_total else None,
+                **{f"p{pct}": self._percentile(tpt_total, pct) if tpt_total else None for pct in TPT_PERCENTILES},
+            },
+            "columns": [{"name": name, "type": values.typecode, "length": len(values)} for name, values in columns],
+        }
+        header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        out = bytearray(b"ALBSTAT1")
+        out += struct.pack("<I", len(header_bytes))
+        out += header_bytes
+        for _, values in columns:
+            if sys.byteorder != "little":
+                values = array(values.typecode, values)
+                values.byteswap()
+            out += values.tobytes()
+        return bytes(out)
+
+
+def _put_stats(bucket, key, data):
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=data,
+        ContentType="application/octet-stream",
+    )
+
+
+def _get_writer(writers, bucket, source_key, realm):
+    if realm in writers:
+        return writers[realm]
+    target_key = _target_key(source_key, realm)
+    writer = _RealmWriter(bucket, target_key) if target_key else None
+    writers[realm] = writer
     return writer
 
 
-def _split_by_realm(body, is_gzip):
-    buffers = {}
+def _split_by_realm(body, is_gzip, bucket, source_key):
+    writers = {}
+    stats = {}
     total_lines = 0
-    for line_bytes in _iter_lines(body, is_gzip):
-        total_lines += 1
-        line = line_bytes.decode("utf-8", "replace")
-        realm = _realm_from_host(_extract_host(line))
-        _, gz = _get_writer(buffers, realm)
-        gz.write(line_bytes)
+    cache_stats = _new_cache_stats()
+    try:
+        for line_bytes in _iter_lines(body, is_gzip):
+            total_lines += 1
+            match = ALB_LINE_RE.match(line_bytes)
+            realm = _realm_for_line(line_bytes, match, cache_stats)
+            writer = _get_writer(writers, bucket, source_key, realm)
+            if writer:
+                writer.write(line_bytes)
+                if WRITE_STATS:
+                    realm_stats = stats.get(realm)
+                    if realm_stats is None:
+                        realm_stats = stats[realm] = _RealmStats()
+                    realm_stats.add(match)
+
+        active = [writer for writer in writers.values() if writer]
+        futures = [_upload_pool.submit(writer.close) for writer in active]
+        for realm, realm_stats in stats.items():
+            stats_key = _target_key(source_key, realm, STATS_PREFIX)
+            futures.append(
+                _upload_pool.submit(_put_stats, bucket, f"{stats_key}{STATS_SUFFIX}", realm_stats.encode(realm, source_key))
+            )
+        wait(futures)
+        for future in futures:
+            future.result()
+        written = len(active)
+    except Exception:
+        for writer in writers.values():
+            if writer:
+                writer.abort()
+        raise
+    return written, total_lines, cache_stats, len(stats)
+
+
+def _process_record(record):
+    if record.get("eventSource") != "aws:s3":
+        return None
+    bucket = (record.get("s3") or {}).get("bucket", {}).get("name")
+    key = (record.get("s3") or {}).get("object", {}).get("key")
+    if not bucket or not key:
+        return None
+    key = urllib.parse.unquote_plus(key)
+    if SOURCE_PREFIX and not key.startswith(SOURCE_PREFIX):
+        return None
+
+    try:
+        resp = s3.get_object(Bucket=bucket, Key=key)
+    except ClientError as exc:
+        if exc.response.get("Error", {}).get("Code") == "NoSuchKey":
+            logger.info("skip missing object: %s", key)
+            return None
+        raise
+
+    is_gzip = key.endswith(".gz") or resp.get("ContentEncoding") == "gzip"
+    written, total_lines, cache_stats, stats_written = _split_by_realm(resp["Body"], is_gzip, bucket, key)
 
-    outputs = {}
-    for realm, (raw, gz) in buffers.items():
-        gz.close()
-        outputs[realm] = raw.getvalue()
-    return outputs, total_lines
+    if DELETE_SOURCE and written > 0:
+        s3.delete_object(Bucket=bucket, Key=key)
+
+    return {
+        "source": key,
+        "bucket": bucket,
+        "lines": total_lines,
+        "outputs": written,
+        "statsOutputs": stats_written,
+        "realmCache": cache_stats,
+    }
 
 
 def handler(event, context):
     records = event.get("Records") or []
     results = []
-
-    for record in records:
-        if record.get("eventSource") != "aws:s3":
-            continue
-        bucket = (record.get("s3") or {}).get("bucket", {}).get("name")
-        key = (record.get("s3") or {}).get("object", {}).get("key")
-        if not bucket or not key:
-            continue
-        key = urllib.parse.unquote_plus(key)
-        if SOURCE_PREFIX and not key.startswith(SOURCE_PREFIX):
-            continue
-
-        try:
-            resp = s3.get_object(Bucket=bucket, Key=key)
-        except ClientError as exc:
-            if exc.response.get("Error", {}).get("Code") == "NoSuchKey":
-                logger.info("skip missing object: %s", key)
-                continue
-            raise
-
-        is_gzip = key.endswith(".gz") or resp.get("ContentEncoding") == "gzip"
-        outputs, total_lines = _split_by_realm(resp["Body"], is_gzip)
-        written = 0
-        for realm, data in outputs.items():
-            target_key = _target_key(key, realm)
-            if not target_key or not data:
+    failures = []
+
+    # 1 オブジェクトの失敗で他のオブジェクトの処理を止めない。失敗分は最後にまとめて例外にし、S3 からの再試行に任せる
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as pool:
+        futures = [pool.submit(_process_record, record) for record in records]
+        for record, future in zip(records, futures):
+            try:
+                result = future.result()
+            except Exception as exc:  # pylint: disable=broad-except
+                key = (record.get("s3") or {}).get("object", {}).get("key")
+                logger.exception("failed to sort object: %s", key)
+                failures.append(f"{key}: {exc}")
                 continue
-            s3.put_object(
-                Bucket=bucket,
-                Key=target_key,
-                Body=data,
-                ContentType="text/plain",
-                ContentEncoding="gzip",
-            )
-            written += 1
-
-        if DELETE_SOURCE and written > 0:
-            s3.delete_object(Bucket=bucket, Key=key)
-
-        results.append(
-            {
-                "source": key,
-                "bucket": bucket,
-                "lines": total_lines,
-                "outputs": written,
-            }
-        )
+            if result:
+                results.append(result)
 
+    if failures:
+        raise RuntimeError(f"failed to sort {len(failures)} object(s): {'; '.join(failures)}")
     return {"ok": True, "processed": len(results), "results": results}
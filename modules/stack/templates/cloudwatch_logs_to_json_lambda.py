@@ -1,52 +1,197 @@
 import base64
 import gzip
-import io
 import json
+import math
+import os
+import time
+import zlib
+
+import boto3
+
+import json_codec
+
+firehose = boto3.client("firehose")
+
+GZIP_MAGIC = b"\x1f\x8b"
+# Lambda の同期レスポンス上限は 6 MiB。JSON の括弧等の分だけ余裕を残す
+RESPONSE_SIZE_LIMIT = int(os.environ.get("RESPONSE_SIZE_LIMIT", "6000000") or "6000000")
+# {"recordId": "", "result": "", "data": ""} とレコード間区切りの概算
+RECORD_OVERHEAD = 64
+# PutRecordBatch の上限（500 レコード / 4 MiB、1 レコード 1,000 KiB）
+REINGEST_MAX_RECORDS = 500
+REINGEST_MAX_BYTES = 4 * 1024 * 1024
+REINGEST_MAX_RECORD_BYTES = 1000 * 1024
+REINGEST_MAX_ATTEMPTS = 5
+
+
+def _gunzip(raw):
+    # CloudWatch Logs のサブスクリプションデータは gzip。連結された複数メンバーにも対応する
+    out = bytearray()
+    while raw:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out += decompressor.decompress(raw)
+        out += decompressor.flush()
+        raw = decompressor.unused_data
+        if not raw.startswith(GZIP_MAGIC):
+            break
+    return out
 
 
 def _decode_record(data):
     raw = base64.b64decode(data)
-    try:
-        raw = gzip.GzipFile(fileobj=io.BytesIO(raw)).read()
-    except OSError:
-        pass
-    return json.loads(raw.decode("utf-8"))
+    if raw.startswith(GZIP_MAGIC):
+        raw = _gunzip(raw)
+    return json_codec.loads(raw)
 
 
-def _encode_events(payload):
+def _encode_events(payload, out):
+    # json.dumps({"timestamp", "message", "log_group", "log_stream"}) と同一のバイト列を、
+    # レコード内で共通の log_group / log_stream 部分を 1 回だけエンコードして組み立てる
     events = payload.get("logEvents") or []
-    log_group = payload.get("logGroup")
-    log_stream = payload.get("logStream")
-    out = []
+    dumps = json_codec.dumps_bytes
+    suffix = (
+        b', "log_group": '
+        + dumps(payload.get("logGroup"))
+        + b', "log_stream": '
+        + dumps(payload.get("logStream"))
+        + b"}\n"
+    )
     for event in events:
-        out.append(
-            json.dumps(
-                {
-                    "timestamp": event.get("timestamp"),
-                    "message": event.get("message"),
-                    "log_group": log_group,
-                    "log_stream": log_stream,
-                }
+        out += b'{"timestamp": '
+        out += dumps(event.get("timestamp"))
+        out += b', "message": '
+        out += dumps(event.get("message"))
+        out += suffix
+    return out
+
+
+def _split_payload(payload, output_size):
+    # 単独でもレスポンス上限を超えるレコードは logEvents を分割し、CloudWatch Logs と同じ形式で再圧縮する。
+    # 再投入の 1 レコードの上限を超えた部分はさらに半分に分ける。1 イベントだけでも超える場合は None
+    events = payload.get("logEvents") or []
+    chunks = max(2, math.ceil(output_size / (RESPONSE_SIZE_LIMIT / 2)))
+    chunk_size = max(1, math.ceil(len(events) / chunks))
+    pending = [events[i : i + chunk_size] for i in range(0, len(events), chunk_size)]
+    parts = []
+    while pending:
+        chunk = pending.pop(0)
+        data = gzip.compress(json.dumps({**payload, "logEvents": chunk}).encode("utf-8"))
+        if len(data) <= REINGEST_MAX_RECORD_BYTES:
+            parts.append(data)
+            continue
+        if len(chunk) == 1:
+            return None
+        half = len(chunk) // 2
+        pending[:0] = [chunk[:half], chunk[half:]]
+    return parts
+
+
+def _put_records(stream_name, records):
+    # 再投入できなかった records のインデックスを返す
+    failed = []
+    batch = []
+    batch_bytes = 0
+    for index, data in enumerate(records):
+        if batch and (len(batch) >= REINGEST_MAX_RECORDS or batch_bytes + len(data) > REINGEST_MAX_BYTES):
+            failed += _put_record_batch(stream_name, records, batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(index)
+        batch_bytes += len(data)
+    if batch:
+        failed += _put_record_batch(stream_name, records, batch)
+    return failed
+
+
+def _put_record_batch(stream_name, records, batch):
+    pending = batch
+    for attempt in range(REINGEST_MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(min(2, 0.1 * 2 ** (attempt - 1)))
+        try:
+            resp = firehose.put_record_batch(
+                DeliveryStreamName=stream_name,
+                Records=[{"Data": records[index]} for index in pending],
             )
-        )
-    return ("\n".join(out) + "\n") if out else ""
+        except Exception as exc:  # pylint: disable=broad-except
+            print({"stream": stream_name, "warning": "put_record_batch failed", "error": str(exc)})
+            continue
+        if not resp.get("FailedPutCount"):
+            return []
+        pending = [
+            index
+            for index, result in zip(pending, resp.get("RequestResponses") or [])
+            if result.get("ErrorCode")
+        ]
+    return pending
 
 
 def handler(event, context):
+    stream_name = (event.get("deliveryStreamArn") or "").split("/")[-1]
     output = []
+    # (output のインデックス, 再投入するデータ)
+    reingest = []
+    counters = {"reingested": 0, "split": 0, "oversized": 0, "reingestFailed": 0}
+    response_size = len('{"records": []}')
     for record in event.get("records", []):
+        out = bytearray()
+        payload = None
         try:
             payload = _decode_record(record["data"])
-            data = _encode_events(payload)
+            _encode_events(payload, out)
             result = "Ok"
         except Exception:
-            data = ""
+            out.clear()
             result = "ProcessingFailed"
+        data = base64.b64encode(out).decode("ascii")
+        size = len(data) + len(record["recordId"]) + RECORD_OVERHEAD
+
+        # 上限を超えるレコードは Dropped として返し、元データ（または分割したデータ）を同じストリームへ再投入する
+        # 再投入の 1 レコードの上限に収まらない（1 イベントが大きすぎる）場合は ProcessingFailed にしてエラー出力に回す
+        if result == "Ok" and stream_name and response_size + size > RESPONSE_SIZE_LIMIT:
+            raw = base64.b64decode(record["data"])
+            if size + len('{"records": []}') <= RESPONSE_SIZE_LIMIT and len(raw) <= REINGEST_MAX_RECORD_BYTES:
+                parts = [raw]
+                counters["reingested"] += 1
+            else:
+                parts = _split_payload(payload, size)
+                if parts is not None:
+                    counters["split"] += 1
+            if parts is None:
+                counters["oversized"] += 1
+                result = "ProcessingFailed"
+            else:
+                reingest.extend((len(output), part) for part in parts)
+                result = "Dropped"
+            data = ""
+            size = len(record["recordId"]) + RECORD_OVERHEAD
+
+        response_size += size
         output.append(
             {
                 "recordId": record["recordId"],
                 "result": result,
-                "data": base64.b64encode(data.encode("utf-8")).decode("utf-8"),
+                "data": data,
+            }
+        )
+
+    # 再投入に失敗したレコードだけを ProcessingFailed にする（例外にすると成功した分まで Firehose が再処理して重複する）
+    if reingest:
+        failed = {reingest[index][0] for index in _put_records(stream_name, [part for _, part in reingest])}
+        for index in failed:
+            output[index]["result"] = "ProcessingFailed"
+        counters["reingestFailed"] = len(failed)
+    if reingest or counters["oversized"]:
+        print(
+            {
+                "stream": stream_name,
+                "records": len(output),
+                "reingested": counters["reingested"],
+                "split": counters["split"],
+                "oversized": counters["oversized"],
+                "reingestFailed": counters["reingestFailed"],
+                "reingestedRecords": len(reingest),
+                "responseBytes": response_size,
             }
         )
     return {"records": output}
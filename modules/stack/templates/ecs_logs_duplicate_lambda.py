@@ -1,16 +1,69 @@
 import base64
+import codecs
 import gzip
 import json
 import os
+import random
+import re
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from botocore.exceptions import ClientError
+
+import json_codec
 
 logs = boto3.client("logs")
 
 NAME_PREFIX = os.environ.get("NAME_PREFIX", "").strip("-")
-MAX_EVENTS_PER_BATCH = int(os.environ.get("MAX_EVENTS_PER_BATCH", "1000") or "1000")
+# PutLogEvents の上限: 1 回あたり 10,000 イベント / 1,048,576 バイト（メッセージの UTF-8 長 + 1 イベントあたり 26 バイト）/ 24 時間の範囲
+MAX_EVENTS_PER_BATCH = min(10000, max(1, int(os.environ.get("MAX_EVENTS_PER_BATCH", "10000") or "10000")))
+MAX_BATCH_BYTES = 1048576
+EVENT_OVERHEAD_BYTES = 26
+MAX_BATCH_SPAN_MS = 24 * 60 * 60 * 1000
+# 作成済みと分かっているロググループ / ストリームを覚えておく期間（秒）
+KNOWN_RESOURCE_TTL_SECONDS = int(os.environ.get("KNOWN_RESOURCE_TTL_SECONDS", "3600") or "3600")
+# 作成に失敗した（権限不足や上限超過など）ロググループ / ストリームへの再試行を控える期間（秒）
+NEGATIVE_CACHE_TTL_SECONDS = int(os.environ.get("NEGATIVE_CACHE_TTL_SECONDS", "60") or "60")
+# 再試行しても結果が変わらないため、ネガティブキャッシュの対象にするエラー
+NEGATIVE_CACHE_ERROR_CODES = {"AccessDeniedException", "InvalidParameterException", "LimitExceededException"}
+
+# 送信先ストリームごとの並列度。同じストリーム宛てのバッチは 1 つのワーカーで順番に送る
+PUT_CONCURRENCY = max(1, int(os.environ.get("PUT_CONCURRENCY", "4") or "4"))
+
+# PutLogEvents はシーケンストークン不要。スロットリング / 一時障害のみ指数バックオフ（フルジッター）で再試行する
+PUT_MAX_ATTEMPTS = max(1, int(os.environ.get("PUT_MAX_ATTEMPTS", "5") or "5"))
+PUT_RETRY_BASE_SECONDS = 0.2
+PUT_RETRY_MAX_SECONDS = 5.0
+RETRYABLE_ERROR_CODES = {"ThrottlingException", "ServiceUnavailableException"}
+# 残り時間がこの秒数（次の PutLogEvents 1 回分）と待ち時間の合計に満たなければ再試行せず、そのバッチを諦める。
+# タイムアウトすると呼び出し全体が再実行され、送信済みのイベントまで重複するため
+PUT_CALL_RESERVE_SECONDS = float(os.environ.get("PUT_CALL_RESERVE_SECONDS", "2") or "2")
+
+# 複製先のルーティング表（JSON 配列）。未指定なら /aws/ecs/<realm>/<service>/<container> を /aws/ecs/<realm>/<service> へ複製する
+#   name:              ルート名（レスポンスの集計キー）
+#   realms / services / containers: 対象を絞り込む場合に指定（省略時はすべて）
+#   target_log_group:  {realm} {service} {container} を置換する（既定: /aws/ecs/{realm}/{service}）
+#   target_log_stream: {log_stream} {container} を置換する（既定: {log_stream}）
+#   pattern:           メッセージに対する正規表現（省略時はすべてのイベント）
+#   sample_rate:       0〜1。イベント ID のハッシュで決めるため、再送されても同じイベントが選ばれる
+LOG_ROUTES = os.environ.get("LOG_ROUTES", "").strip()
+DEFAULT_ROUTE = {"name": "service"}
+SAMPLE_BUCKETS = 10000
 
-_sequence_tokens = {}
+# 圧縮後の awslogs.data がこのサイズ（バイト）以上なら、全体を展開せずストリーミングで解析する
+STREAM_DECODE_MIN_BYTES = int(os.environ.get("STREAM_DECODE_MIN_BYTES", "262144") or "262144")
+STREAM_CHUNK_BYTES = 64 * 1024
+# ルーティングはこの件数ずつまとめて行う（正規表現の評価はチャンク単位）
+ROUTE_CHUNK_EVENTS = 1000
+# 送信待ちの数（宛先ごとの送信単位）の上限。超えたら古いものの完了を待つ（メモリをバッチサイズ程度に抑える）
+MAX_INFLIGHT_BATCHES = PUT_CONCURRENCY * 2
+
+_executor = ThreadPoolExecutor(max_workers=PUT_CONCURRENCY)
+# ウォームコンテナの間だけ保持する。値は (存在するか, 有効期限の time.monotonic())
+_known_log_groups = {}
+_known_log_streams = {}
 
 
 def _parse_log_group(log_group):
@@ -30,72 +83,437 @@ def _parse_log_group(log_group):
     return realm, service_name, container
 
 
-def _target_log_group(parsed):
-    realm, service_name, _ = parsed
-    return f"/aws/ecs/{realm}/{service_name}"
+def _decompressed_chunks(data):
+    # base64 / gzip を少しずつ展開し、UTF-8 の文字列として返す
+    text = codecs.getincrementaldecoder("utf-8")()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    step = STREAM_CHUNK_BYTES // 3 * 4
+    for i in range(0, len(data), step):
+        raw = base64.b64decode(data[i : i + step])
+        while raw:
+            chunk = decompressor.decompress(raw)
+            if chunk:
+                yield text.decode(chunk)
+            raw = decompressor.unused_data
+            if raw:
+                # 連結された gzip メンバー
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if not decompressor.eof:
+        raise ValueError("truncated gzip payload")
+    yield text.decode(b"", final=True)
+
+
+class _PayloadReader:
+    # CloudWatch Logs のサブスクリプションデータ（1 つの JSON オブジェクト）を先頭から解析する。
+    # logEvents 以外のキーは header に入れ、logEvents の要素は解析した順に返す
+    def __init__(self, data):
+        self.header = {}
+        self._chunks = _decompressed_chunks(data)
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._decode = json.JSONDecoder().raw_decode
+
+    def _fill(self):
+        if self._eof:
+            raise ValueError("unexpected end of payload")
+        if self._pos:
+            self._buf = self._buf[self._pos :]
+            self._pos = 0
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+        else:
+            self._buf += chunk
+
+    def _peek(self):
+        # 空白を読み飛ばして次の 1 文字を返す
+        while True:
+            buf = self._buf
+            pos = self._pos
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            self._pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            self._fill()
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError(f"unexpected {char!r} in payload")
+        self._pos += 1
+        return char
+
+    def _value(self):
+        # 値の直後の区切り文字まで読めていれば確定（数値が途中で切れている場合に備える）
+        self._peek()
+        while True:
+            try:
+                value, end = self._decode(self._buf, self._pos)
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def events(self):
+        self._expect("{")
+        if self._peek() == "}":
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key == "logEvents":
+                self._expect("[")
+                if self._peek() == "]":
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(",]") == "]":
+                            break
+            else:
+                self.header[key] = self._value()
+            if self._expect(",}") == "}":
+                return
+
+
+def _read_payload(data):
+    # 小さいデータはまとめて展開したほうが速い。大きいデータはイベント単位で流し、
+    # logEvents より前にあるキー（logGroup など）だけ先に解析しておく
+    if len(data) < STREAM_DECODE_MIN_BYTES:
+        payload = json_codec.loads(gzip.decompress(base64.b64decode(data)))
+        return payload, iter(payload.get("logEvents") or [])
+    reader = _PayloadReader(data)
+    events = reader.events()
+    first = next(events, None)
+    if not {"messageType", "logGroup", "logStream"} <= reader.header.keys():
+        # logEvents が先頭にある場合は最後まで読む
+        buffered = ([first] if first is not None else []) + list(events)
+        return reader.header, iter(buffered)
+    if first is None:
+        return reader.header, events
+    return reader.header, _prepend(first, events)
+
+
+def _prepend(first, events):
+    yield first
+    yield from events
+
+
+def _chunked(events, size):
+    chunk = []
+    for event in events:
+        chunk.append(event)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _compile_routes(spec):
+    # ルートを realm ごとの辞書に索引化し、同じ正規表現は 1 つのマッチャーにまとめる
+    routes_by_realm = {}
+    patterns = {}
+    for i, route in enumerate(spec):
+        if not isinstance(route, dict):
+            raise ValueError(f"LOG_ROUTES[{i}] must be an object")
+        target_group = route.get("target_log_group") or "/aws/ecs/{realm}/{service}"
+        target_stream = route.get("target_log_stream") or "{log_stream}"
+        # 未知のプレースホルダーは起動時に検出する
+        target_group.format(realm="", service="", container="")
+        target_stream.format(log_stream="", container="")
+        # 複製元と同じロググループに書くと、そのサブスクリプションで自分自身が呼ばれ続ける
+        if target_group.format(realm="\0r", service="\0s", container="\0c") == "/aws/ecs/\0r/\0s/\0c":
+            raise ValueError(f"LOG_ROUTES[{i}].target_log_group must not be the source log group")
+        pattern = route.get("pattern") or None
+        if pattern is not None and pattern not in patterns:
+            patterns[pattern] = len(patterns)
+        sample_rate = float(route.get("sample_rate", 1))
+        if not 0 < sample_rate <= 1:
+            raise ValueError(f"LOG_ROUTES[{i}].sample_rate must be in (0, 1]")
+        compiled = {
+            "name": route.get("name") or f"route{i}",
+            "services": set(route.get("services") or []) or None,
+            "containers": set(route.get("containers") or []) or None,
+            "target_log_group": target_group,
+            "target_log_stream": target_stream,
+            "matcher": patterns.get(pattern) if pattern is not None else None,
+            "sample_threshold": int(sample_rate * SAMPLE_BUCKETS) if sample_rate < 1 else None,
+        }
+        for realm in route.get("realms") or ["*"]:
+            routes_by_realm.setdefault(realm, []).append(compiled)
+    matchers = [re.compile(pattern).search for pattern in patterns]
+    return routes_by_realm, matchers
+
+
+def _load_routes():
+    spec = json_codec.loads(LOG_ROUTES) if LOG_ROUTES else [DEFAULT_ROUTE]
+    if not isinstance(spec, list):
+        raise ValueError("LOG_ROUTES must be a JSON array")
+    return _compile_routes(spec)
+
+
+_routes_by_realm, _matchers = _load_routes()
+
+
+def _routes_for(realm, service_name, container):
+    candidates = _routes_by_realm.get(realm, []) + _routes_by_realm.get("*", [])
+    return [
+        route
+        for route in candidates
+        if (route["services"] is None or service_name in route["services"])
+        and (route["containers"] is None or container in route["containers"])
+    ]
+
+
+def _sampled(event, threshold):
+    key = event.get("id") or f"{event.get('timestamp')}:{event.get('message')}"
+    return zlib.crc32(key.encode("utf-8")) % SAMPLE_BUCKETS < threshold
+
+
+def _route_events(routes, parsed, log_stream, events):
+    # 正規表現はルート数に関係なくイベントごとに 1 回だけ評価し、結果を共有する
+    realm, service_name, container = parsed
+    used = {route["matcher"] for route in routes if route["matcher"] is not None}
+    hits = {index: [_matchers[index](event.get("message") or "") is not None for event in events] for index in used}
+
+    destinations = {}
+    counts = {}
+    for route in routes:
+        selected = events
+        if route["matcher"] is not None:
+            selected = [event for event, hit in zip(selected, hits[route["matcher"]]) if hit]
+        if route["sample_threshold"] is not None:
+            selected = [event for event in selected if _sampled(event, route["sample_threshold"])]
+        counts[route["name"]] = counts.get(route["name"], 0) + len(selected)
+        if not selected:
+            continue
+        key = (
+            route["target_log_group"].format(realm=realm, service=service_name, container=container),
+            route["target_log_stream"].format(log_stream=log_stream, container=container),
+        )
+        if key in destinations:
+            # 複数のルートが同じ宛先を指す場合は同じイベントを重複して送らない
+            seen = {id(event) for event in destinations[key]}
+            destinations[key] = destinations[key] + [event for event in selected if id(event) not in seen]
+        else:
+            destinations[key] = selected
+    return destinations, counts
+
+
+def _cached(cache, key):
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    exists, expires_at = entry
+    if time.monotonic() >= expires_at:
+        cache.pop(key, None)
+        return None
+    return exists
+
 
+def _remember(cache, key, exists):
+    ttl = KNOWN_RESOURCE_TTL_SECONDS if exists else NEGATIVE_CACHE_TTL_SECONDS
+    cache[key] = (exists, time.monotonic() + ttl)
 
-def _ensure_log_group(name):
+
+def _forget(log_group, log_stream):
+    _known_log_groups.pop(log_group, None)
+    _known_log_streams.pop((log_group, log_stream), None)
+
+
+def _ensure_log_group(name, stats):
+    cached = _cached(_known_log_groups, name)
+    if cached is not None:
+        stats["apiCallsAvoided"] += 1
+        return cached
+    stats["controlPlaneCalls"] += 1
     try:
         logs.create_log_group(logGroupName=name)
     except logs.exceptions.ResourceAlreadyExistsException:
-        return
+        pass
+    except ClientError as exc:
+        if exc.response.get("Error", {}).get("Code") not in NEGATIVE_CACHE_ERROR_CODES:
+            raise
+        print({"warning": "create_log_group failed", "logGroup": name, "error": str(exc)})
+        _remember(_known_log_groups, name, False)
+        return False
+    _remember(_known_log_groups, name, True)
+    return True
 
 
-def _get_sequence_token(log_group, log_stream):
-    key = f"{log_group}:{log_stream}"
-    token = _sequence_tokens.get(key)
-    if token is not None:
-        return token
-    resp = logs.describe_log_streams(
-        logGroupName=log_group,
-        logStreamNamePrefix=log_stream,
-        limit=1,
-    )
-    for stream in resp.get("logStreams", []):
-        if stream.get("logStreamName") == log_stream:
-            token = stream.get("uploadSequenceToken")
-            break
-    _sequence_tokens[key] = token
-    return token
-
-
-def _ensure_log_stream(log_group, log_stream):
+def _ensure_log_stream(log_group, log_stream, stats):
+    key = (log_group, log_stream)
+    cached = _cached(_known_log_streams, key)
+    if cached is not None:
+        stats["apiCallsAvoided"] += 1
+        return cached
+    stats["controlPlaneCalls"] += 1
     try:
         logs.create_log_stream(logGroupName=log_group, logStreamName=log_stream)
     except logs.exceptions.ResourceAlreadyExistsException:
         pass
-    return _get_sequence_token(log_group, log_stream)
+    except ClientError as exc:
+        if exc.response.get("Error", {}).get("Code") not in NEGATIVE_CACHE_ERROR_CODES:
+            raise
+        print({"warning": "create_log_stream failed", "logGroup": log_group, "logStream": log_stream, "error": str(exc)})
+        _remember(_known_log_streams, key, False)
+        return False
+    _remember(_known_log_streams, key, True)
+    return True
+
 
+def _put_with_retry(kwargs, stats, deadline=None):
+    # deadline: 呼び出しの終了期限（time.monotonic()）。None なら期限を見ない
+    for attempt in range(PUT_MAX_ATTEMPTS):
+        try:
+            return logs.put_log_events(**kwargs)
+        except ClientError as exc:
+            code = exc.response.get("Error", {}).get("Code")
+            if code not in RETRYABLE_ERROR_CODES or attempt + 1 >= PUT_MAX_ATTEMPTS:
+                raise
+            delay = random.uniform(0, min(PUT_RETRY_MAX_SECONDS, PUT_RETRY_BASE_SECONDS * 2**attempt))
+            if deadline is not None and time.monotonic() + delay + PUT_CALL_RESERVE_SECONDS > deadline:
+                stats["droppedEvents"] += len(kwargs["logEvents"])
+                print(
+                    {
+                        "warning": "put_log_events retry skipped near timeout",
+                        "logGroup": kwargs["logGroupName"],
+                        "logStream": kwargs["logStreamName"],
+                        "events": len(kwargs["logEvents"]),
+                        "error": code,
+                    }
+                )
+                return None
+            stats["retries"] += 1
+            time.sleep(delay)
+    return None
 
-def _put_log_events(log_group, log_stream, events):
+
+def _put_log_events(log_group, log_stream, events, stats, deadline=None):
     if not events:
         return
-    key = f"{log_group}:{log_stream}"
-    events_sorted = sorted(events, key=lambda e: e.get("timestamp", 0))
-    token = _ensure_log_stream(log_group, log_stream)
+    if not _ensure_log_stream(log_group, log_stream, stats):
+        stats["skippedEvents"] += len(events)
+        return
     kwargs = {
         "logGroupName": log_group,
         "logStreamName": log_stream,
-        "logEvents": events_sorted,
+        "logEvents": events,
     }
-    if token:
-        kwargs["sequenceToken"] = token
     try:
-        resp = logs.put_log_events(**kwargs)
-    except (logs.exceptions.InvalidSequenceTokenException, logs.exceptions.DataAlreadyAcceptedException):
-        token = _get_sequence_token(log_group, log_stream)
-        if token:
-            kwargs["sequenceToken"] = token
-        else:
-            kwargs.pop("sequenceToken", None)
-        resp = logs.put_log_events(**kwargs)
-    _sequence_tokens[key] = resp.get("nextSequenceToken")
+        _put_with_retry(kwargs, stats, deadline)
+    except logs.exceptions.ResourceNotFoundException:
+        # キャッシュ後にロググループ / ストリームが削除された場合は作り直して 1 回だけ再送する
+        _forget(log_group, log_stream)
+        if not _ensure_log_group(log_group, stats) or not _ensure_log_stream(log_group, log_stream, stats):
+            stats["skippedEvents"] += len(events)
+            return
+        _put_with_retry(kwargs, stats, deadline)
+
+
+def _batches(events):
+    # 時刻順に並べ、件数・バイト数・時間範囲のいずれかが上限に達するまで 1 バッチに詰める
+    batch = []
+    batch_bytes = 0
+    first_timestamp = None
+    for event in sorted(events, key=lambda e: e.get("timestamp", 0)):
+        timestamp = event.get("timestamp", 0)
+        message = event.get("message") or ""
+        size = len(message.encode("utf-8")) + EVENT_OVERHEAD_BYTES
+        if batch and (
+            len(batch) >= MAX_EVENTS_PER_BATCH
+            or batch_bytes + size > MAX_BATCH_BYTES
+            or timestamp - first_timestamp > MAX_BATCH_SPAN_MS
+        ):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        if not batch:
+            first_timestamp = timestamp
+        batch.append({"timestamp": timestamp, "message": message})
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def _new_stats():
+    return {"controlPlaneCalls": 0, "apiCallsAvoided": 0, "skippedEvents": 0, "retries": 0, "droppedEvents": 0}
+
+
+def _event_bytes(event):
+    return len((event.get("message") or "").encode("utf-8")) + EVENT_OVERHEAD_BYTES
+
 
+def _send_to_stream(log_group, log_stream, batches, previous=None, deadline=None):
+    # batches: _batches() で分けたイベント。スレッドごとに集計し、呼び出し元で合算する。同じ宛先の前の送信が終わってから送る
+    if previous is not None:
+        previous.result()
+    stats = _new_stats()
+    if not _ensure_log_group(log_group, stats):
+        stats["skippedEvents"] += sum(len(batch) for batch in batches)
+        return stats
+    for batch in batches:
+        _put_log_events(log_group, log_stream, batch, stats, deadline)
+    return stats
 
-def _chunks(items, size):
-    for i in range(0, len(items), size):
-        yield items[i : i + size]
+
+class _Sender:
+    # 宛先ごとにイベントをため、上限まで詰めたバッチだけを送り始める。
+    # 詰め切れなかった残りは次に届いたイベントと合わせて詰め直し、close() で送る
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.stats = _new_stats()
+        self._pending = {}
+        self._pending_bytes = {}
+        self._tails = {}
+        self._inflight = []
+
+    def add(self, destinations):
+        for key, events in destinations.items():
+            pending = self._pending.setdefault(key, [])
+            pending.extend(events)
+            size = self._pending_bytes.get(key, 0) + sum(_event_bytes(event) for event in events)
+            self._pending_bytes[key] = size
+            if len(pending) > MAX_EVENTS_PER_BATCH or size > MAX_BATCH_BYTES:
+                # 1 バッチに収まらない分がある。最後の（まだ詰められる）バッチは次に持ち越す
+                batches = list(_batches(pending))
+                remainder = batches.pop()
+                self._pending[key] = remainder
+                self._pending_bytes[key] = sum(_event_bytes(event) for event in remainder)
+                self._submit(key, batches)
+
+    def _submit(self, key, batches):
+        while len(self._inflight) >= MAX_INFLIGHT_BATCHES:
+            self._merge(self._inflight.pop(0).result())
+        log_group, log_stream = key
+        future = _executor.submit(_send_to_stream, log_group, log_stream, batches, self._tails.get(key), self.deadline)
+        self._tails[key] = future
+        self._inflight.append(future)
+
+    def _merge(self, result):
+        for key, value in result.items():
+            self.stats[key] += value
+
+    def close(self):
+        pending = {key: events for key, events in self._pending.items() if events}
+        self._pending = {}
+        self._pending_bytes = {}
+        if not self._inflight and len(pending) == 1:
+            # 宛先が 1 つで小さい場合はスレッドを使わない
+            (log_group, log_stream), events = pending.popitem()
+            self._merge(_send_to_stream(log_group, log_stream, list(_batches(events)), deadline=self.deadline))
+        for key, events in pending.items():
+            self._submit(key, list(_batches(events)))
+        for future in self._inflight:
+            self._merge(future.result())
+        self._inflight = []
+        return self.stats
 
 
 def handler(event, context):
@@ -103,7 +521,7 @@ def handler(event, context):
     if not data:
         return {"ok": True, "reason": "missing awslogs.data"}
 
-    payload = json.loads(gzip.decompress(base64.b64decode(data)).decode("utf-8"))
+    payload, events = _read_payload(data)
     if payload.get("messageType") != "DATA_MESSAGE":
         return {"ok": True, "messageType": payload.get("messageType")}
 
@@ -117,16 +535,40 @@ def handler(event, context):
     if NAME_PREFIX and not service_name.startswith(f"{NAME_PREFIX}-"):
         return {"ok": True, "skipped": True, "logGroup": log_group}
 
-    target_group = _target_log_group(parsed)
-    _ensure_log_group(target_group)
-    events = payload.get("logEvents") or []
-    for batch in _chunks(events, max(1, MAX_EVENTS_PER_BATCH)):
-        _put_log_events(target_group, log_stream, batch)
+    routes = _routes_for(realm, service_name, container)
+    if not routes:
+        return {"ok": True, "skipped": True, "logGroup": log_group}
+
+    # ROUTE_CHUNK_EVENTS 件ずつルーティングし、宛先ごとのバッチがたまり次第送る
+    deadline = None
+    if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000
+    sender = _Sender(deadline)
+    route_counts = {}
+    target_groups = set()
+    total = 0
+    loop_skipped = 0
+    for chunk in _chunked(events, ROUTE_CHUNK_EVENTS):
+        destinations, counts = _route_events(routes, parsed, log_stream, chunk)
+        for key in [key for key in destinations if key[0] == log_group]:
+            # 固定値の target_log_group が複製元と一致した場合も書き戻さない
+            loop_skipped += len(destinations.pop(key))
+        sender.add(destinations)
+        target_groups.update(target_group for target_group, _ in destinations)
+        for name, count in counts.items():
+            route_counts[name] = route_counts.get(name, 0) + count
+        total += len(chunk)
+    stats = sender.close()
+    if loop_skipped:
+        print({"warning": "route target is the source log group", "logGroup": log_group, "events": loop_skipped})
 
     return {
         "ok": True,
-        "targetGroup": target_group,
-        "events": len(events),
+        "targetGroups": sorted(target_groups),
+        "events": total,
+        "routes": route_counts,
+        "loopSkippedEvents": loop_skipped,
         "container": container,
         "realm": realm,
+        **stats,
     }
@@ -0,0 +1,53 @@
+import json
+import os
+
+# ログ系 Lambda 共通の JSON コーデック。orjson / msgspec が同梱されていれば使い、無ければ標準ライブラリに戻る。
+# JSON_BACKEND=json|orjson|msgspec で明示指定できる（未インストールの場合は標準ライブラリ）
+JSON_BACKEND = os.environ.get("JSON_BACKEND", "auto").strip().lower() or "auto"
+
+_fast_loads = None
+_fast_dumps = None
+BACKEND = "json"
+
+if JSON_BACKEND in ("auto", "orjson"):
+    try:
+        import orjson
+
+        _fast_loads = orjson.loads
+        _fast_dumps = orjson.dumps
+        BACKEND = "orjson"
+    except ImportError:
+        pass
+
+if _fast_loads is None and JSON_BACKEND in ("auto", "msgspec"):
+    try:
+        import msgspec
+
+        _fast_loads = msgspec.json.decode
+        BACKEND = "msgspec"
+    except ImportError:
+        pass
+
+
+def loads(data):
+    # 高速実装が拒否する入力（NaN や Infinity など）は標準ライブラリで解釈し、例外も標準ライブラリのものにそろえる。
+    # orjson は 64bit を超える整数を float として返すが、CloudWatch Logs / Metric Streams の数値は int64 に収まる
+    if _fast_loads is not None:
+        try:
+            return _fast_loads(data)
+        except Exception:  # pylint: disable=broad-except
+            pass
+    return json.loads(data)
+
+
+def dumps_bytes(value):
+    # json.dumps(value).encode("utf-8") とバイト単位で同一の結果を返す。
+    # orjson は非 ASCII 文字と DEL をエスケープせず、浮動小数点の表記も異なるため、その場合は標準ライブラリを使う
+    if _fast_dumps is not None and (value is None or isinstance(value, (str, int))):
+        try:
+            out = _fast_dumps(value)
+        except Exception:  # pylint: disable=broad-except
+            out = None
+        if out is not None and out.isascii() and b"\x7f" not in out:
+            return out
+    return json.dumps(value).encode("utf-8")
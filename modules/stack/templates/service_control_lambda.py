@@ -1,10 +1,19 @@
+import functools
 import json
+import math
 import os
 import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
 import boto3
 
+import service_schedule
+import ssm_cache
+
 ecs = boto3.client("ecs")
 elbv2 = boto3.client("elbv2")
 ecr = boto3.client("ecr")
@@ -21,6 +30,33 @@ ODOO_ADMIN_USERNAME = os.environ.get("ODOO_ADMIN_USERNAME", "admin")
 ODOO_ADMIN_PASSWORD_PARAMETER = os.environ.get("ODOO_ADMIN_PASSWORD_SSM_PARAMETER")
 PGADMIN_ADMIN_USERNAME = os.environ.get("PGADMIN_ADMIN_USERNAME", "admin")
 PGADMIN_PASSWORD_PARAMETER = os.environ.get("PGADMIN_PASSWORD_SSM_PARAMETER")
+# /status/all で ECR / ターゲットグループ / タスク定義を並行して取得するときの並列度
+STATUS_CONCURRENCY = max(1, int(os.environ.get("STATUS_CONCURRENCY", "8") or "8"))
+# describe_services に一度に渡せるサービス数の上限
+DESCRIBE_SERVICES_BATCH = 10
+# ECR の最新タグをウォームコンテナ内で覚えておく期間（秒）
+ECR_LATEST_TAG_TTL_SECONDS = int(os.environ.get("ECR_LATEST_TAG_TTL_SECONDS", "300") or "300")
+# true なら最新タグを SSM（<SERVICE_CONTROL_SSM_PATH>/ecr-latest/<repository>）にも保存し、コールドスタート時に使う
+ECR_LATEST_TAG_SSM_CACHE = os.environ.get("ECR_LATEST_TAG_SSM_CACHE", "false").strip().lower() == "true"
+ECR_DESCRIBE_IMAGES_BATCH = 100
+# 確認済みのダイジェストは先頭の 16 文字（64 ビット）で覚える。SSM の標準パラメータ（4 KB）に収まる場合だけ保存する
+ECR_DIGEST_KEY_CHARS = 16
+SSM_PARAMETER_MAX_BYTES = 4096
+# タスク定義のリビジョンは変更されないため、ARN ごとのイメージを上限付きで覚えておく
+TASK_DEFINITION_CACHE_SIZE = max(1, int(os.environ.get("TASK_DEFINITION_CACHE_SIZE", "256") or "256"))
+
+# repository -> {"tag", "digest", "pushedAt", "checkedAt", "digests"（確認済みのダイジェストのキー）, "expiresAt"}
+_ecr_latest = {}
+_ecr_latest_lock = threading.Lock()
+# task definition ARN -> image（LRU）
+_task_definition_images = OrderedDict()
+_task_definition_lock = threading.Lock()
+# ウォームコンテナ内の累計。レスポンスの cache に載せる
+_cache_stats = {
+    "taskDefinition": {"hits": 0, "misses": 0},
+    "ecrLatestTag": {"hits": 0, "misses": 0},
+}
+_cache_stats_lock = threading.Lock()
 
 
 def _load_json_config(env_key, ssm_param_env_key, default=None):
@@ -90,6 +126,198 @@ def _get_target_group_arn(service_key, realm):
     return (tg_arn or None), resolved_realm
 
 
+def _count_cache(name, hit):
+    with _cache_stats_lock:
+        _cache_stats[name]["hits" if hit else "misses"] += 1
+
+
+def _cache_report():
+    report = {}
+    with _cache_stats_lock:
+        for name, counts in _cache_stats.items():
+            total = counts["hits"] + counts["misses"]
+            report[name] = {**counts, "hitRatio": round(counts["hits"] / total, 3) if total else None}
+        report["taskDefinition"]["size"] = len(_task_definition_images)
+    return report
+
+
+def _task_definition_image(task_def_arn, api_calls=None):
+    # api_calls: 渡された場合、実際に describe_task_definition した ARN を追加する
+    with _task_definition_lock:
+        cached = task_def_arn in _task_definition_images
+        if cached:
+            _task_definition_images.move_to_end(task_def_arn)
+            image = _task_definition_images[task_def_arn]
+    _count_cache("taskDefinition", cached)
+    if cached:
+        return image
+    if api_calls is not None:
+        api_calls.append(task_def_arn)
+    td = ecs.describe_task_definition(taskDefinition=task_def_arn).get("taskDefinition", {})
+    containers = td.get("containerDefinitions", [])
+    target = next((c for c in containers if c.get("essential", True) and c.get("image")), None) or (containers[0] if containers else None)
+    image = target.get("image") if target else None
+    with _task_definition_lock:
+        _task_definition_images[task_def_arn] = image
+        if len(_task_definition_images) > TASK_DEFINITION_CACHE_SIZE:
+            _task_definition_images.popitem(last=False)
+    return image
+
+
+def _ecr_repository(image):
+    parts = image.split("/", 1)
+    if len(parts) == 2 and ".dkr.ecr." in parts[0]:
+        return parts[1].split(":")[0]
+    return None
+
+
+def _ecr_image_tags(repository):
+    # {digest: [tag, ...]}。タグの無いイメージも含める。
+    # list_images はダイジェストとタグだけを 1,000 件単位で返すため describe_images より軽い。
+    # ECR には push 日時順の一覧や差分の取得が無いため、新しいイメージを見つけるにはこの一覧が要る
+    images = {}
+    paginator = ecr.get_paginator("list_images")
+    for page in paginator.paginate(repositoryName=repository, PaginationConfig={"PageSize": 1000}):
+        for image_id in page.get("imageIds", []):
+            digest = image_id.get("imageDigest")
+            if not digest:
+                continue
+            tags = images.setdefault(digest, [])
+            if image_id.get("imageTag"):
+                tags.append(image_id["imageTag"])
+    return images
+
+
+def _digest_key(digest):
+    return digest.rsplit(":", 1)[-1][:ECR_DIGEST_KEY_CHARS]
+
+
+def _ecr_newest_image(repository, digests):
+    # push 日時が最も新しいイメージ（タグの無いものを含む）
+    newest = None
+    digests = sorted(digests)
+    for i in range(0, len(digests), ECR_DESCRIBE_IMAGES_BATCH):
+        resp = ecr.describe_images(
+            repositoryName=repository,
+            imageIds=[{"imageDigest": digest} for digest in digests[i : i + ECR_DESCRIBE_IMAGES_BATCH]],
+        )
+        for detail in resp.get("imageDetails", []):
+            pushed = detail.get("imagePushedAt")
+            if not pushed:
+                continue
+            if newest is None or pushed > newest.get("imagePushedAt"):
+                newest = detail
+    return newest
+
+
+def _ecr_latest_parameter_name(repository):
+    return f"{SERVICE_CONTROL_SSM_PATH.rstrip('/')}/ecr-latest/{repository}"
+
+
+def _load_ecr_latest(repository):
+    if not (ECR_LATEST_TAG_SSM_CACHE and SERVICE_CONTROL_SSM_PATH):
+        return None
+    try:
+        resp = ssm.get_parameter(Name=_ecr_latest_parameter_name(repository))
+        return json.loads(resp["Parameter"]["Value"])
+    except ssm.exceptions.ParameterNotFound:
+        return None
+    except Exception as exc:  # pylint: disable=broad-except
+        print({"warning": "failed to load ecr latest tag", "repository": repository, "error": str(exc)})
+        return None
+
+
+def _store_ecr_latest(repository, entry):
+    if not (ECR_LATEST_TAG_SSM_CACHE and SERVICE_CONTROL_SSM_PATH):
+        return
+    stored = {key: entry[key] for key in ("tag", "digest", "pushedAt", "checkedAt")}
+    value = json.dumps({**stored, "knownDigests": sorted(entry["digests"])})
+    if len(value.encode("utf-8")) > SSM_PARAMETER_MAX_BYTES:
+        # 収まらない場合、コールドスタート時は全件から探し直す
+        value = json.dumps(stored)
+    try:
+        ssm.put_parameter(Name=_ecr_latest_parameter_name(repository), Value=value, Type="String", Overwrite=True)
+    except Exception as exc:  # pylint: disable=broad-except
+        print({"warning": "failed to store ecr latest tag", "repository": repository, "error": str(exc)})
+
+
+def _ecr_latest_tag(repository):
+    # 最新のイメージのタグ（タグが無ければ None）をリポジトリごとに TTL 付きで覚えておく。
+    # 期限切れ後は list_images でダイジェスト一覧を取り、前回（コールドスタート時は SSM に保存した分）から
+    # 増えたイメージだけ describe_images して push 日時を比べる
+    with _ecr_latest_lock:
+        entry = _ecr_latest.get(repository)
+    if entry and time.monotonic() < entry["expiresAt"]:
+        _count_cache("ecrLatestTag", True)
+        return entry["tag"]
+    if entry is None:
+        stored = _load_ecr_latest(repository)
+        if stored:
+            known = stored.pop("knownDigests", None)
+            entry = {**stored, "digests": set(known) if known is not None else None, "expiresAt": 0.0}
+            if time.time() - stored.get("checkedAt", 0) < ECR_LATEST_TAG_TTL_SECONDS:
+                entry["expiresAt"] = time.monotonic() + ECR_LATEST_TAG_TTL_SECONDS
+                with _ecr_latest_lock:
+                    _ecr_latest[repository] = entry
+                _count_cache("ecrLatestTag", True)
+                return entry["tag"]
+    _count_cache("ecrLatestTag", False)
+
+    images = _ecr_image_tags(repository)
+    digests_by_key = {_digest_key(digest): digest for digest in images}
+    known = entry.get("digests") if entry else None
+    if known is None or (entry.get("digest") and _digest_key(entry["digest"]) not in digests_by_key):
+        # 初回、または最新だったイメージが削除された場合は全件から探し直す
+        base = None
+        newest = _ecr_newest_image(repository, images)
+    else:
+        base = entry
+        newest = _ecr_newest_image(repository, [digest for key, digest in digests_by_key.items() if key not in known])
+    if newest is not None and (base is None or newest["imagePushedAt"].timestamp() > base["pushedAt"]):
+        latest = {
+            "tag": (newest.get("imageTags") or [None])[0],
+            "digest": newest.get("imageDigest"),
+            "pushedAt": newest["imagePushedAt"].timestamp(),
+        }
+    elif base is not None:
+        # 最新のイメージのタグが外された / 付け替えられた場合は list_images のタグに合わせる
+        tags = images[digests_by_key[_digest_key(base["digest"])]] if base.get("digest") else []
+        latest = {
+            "tag": base["tag"] if base["tag"] in tags else (tags[0] if tags else None),
+            "digest": base["digest"],
+            "pushedAt": base["pushedAt"],
+        }
+    else:
+        latest = {"tag": None, "digest": None, "pushedAt": 0}
+    entry = {
+        **latest,
+        "checkedAt": time.time(),
+        "digests": set(digests_by_key),
+        "expiresAt": time.monotonic() + ECR_LATEST_TAG_TTL_SECONDS,
+    }
+    with _ecr_latest_lock:
+        _ecr_latest[repository] = entry
+    _store_ecr_latest(repository, entry)
+    return entry["tag"]
+
+
+def _image_tag(image):
+    if not image:
+        return None
+    return image.rsplit(":", 1)[-1] if ":" in image else image
+
+
+def _service_status(svc, image, ecr_latest_tag):
+    return {
+        "desiredCount": svc.get("desiredCount", 0),
+        "runningCount": svc.get("runningCount", 0),
+        "status": svc.get("status", "UNKNOWN"),
+        "image": image,
+        "imageTag": _image_tag(image),
+        "ecrLatestTag": ecr_latest_tag,
+    }
+
+
 def _describe(service_arn):
     resp = ecs.describe_services(cluster=CLUSTER_ARN, services=[service_arn])
     services = resp.get("services", [])
@@ -97,50 +325,28 @@ def _describe(service_arn):
     if not services:
         reason = failures[0].get("reason", "NOT_FOUND") if failures else "NOT_FOUND"
         raise ValueError(f"service not found: {service_arn} ({reason})")
-    svc = services[0]
+    return _status_for_service(services[0])
 
+
+def _status_for_service(svc):
     image = None
-    image_tag = None
     ecr_latest_tag = None
     task_def_arn = svc.get("taskDefinition")
     if task_def_arn:
         try:
-            td = ecs.describe_task_definition(taskDefinition=task_def_arn).get("taskDefinition", {})
-            containers = td.get("containerDefinitions", [])
-            target = next((c for c in containers if c.get("essential", True) and c.get("image")), None) or (containers[0] if containers else None)
-            image = target.get("image") if target else None
+            image = _task_definition_image(task_def_arn)
             if image:
-                image_tag = image.rsplit(":", 1)[-1] if ":" in image else image
                 # ECR の最新タグを取得（イメージが ECR の場合のみ）
                 try:
-                    parts = image.split("/", 1)
-                    if len(parts) == 2 and ".dkr.ecr." in parts[0]:
-                        repository = parts[1].split(":")[0]
-                        latest_detail = None
-                        paginator = ecr.get_paginator("describe_images")
-                        for page in paginator.paginate(repositoryName=repository, PaginationConfig={"PageSize": 100}):
-                            for detail in page.get("imageDetails", []):
-                                pushed = detail.get("imagePushedAt")
-                                if not pushed:
-                                    continue
-                                if latest_detail is None or pushed > latest_detail.get("imagePushedAt"):
-                                    latest_detail = detail
-                        if latest_detail:
-                            tags = latest_detail.get("imageTags") or []
-                            ecr_latest_tag = tags[0] if tags else None
+                    repository = _ecr_repository(image)
+                    if repository:
+                        ecr_latest_tag = _ecr_latest_tag(repository)
                 except Exception as exc:  # pylint: disable=broad-except
                     print({"warning": "ecr_describe_images failed", "error": str(exc), "image": image})
         except Exception as exc:  # pylint: disable=broad-except
             print({"warning": "describe_task_definition failed", "error": str(exc)})
 
-    return {
-        "desiredCount": svc.get("desiredCount", 0),
-        "runningCount": svc.get("runningCount", 0),
-        "status": svc.get("status", "UNKNOWN"),
-        "image": image,
-        "imageTag": image_tag,
-        "ecrLatestTag": ecr_latest_tag,
-    }
+    return _service_status(svc, image, ecr_latest_tag)
 
 
 def _describe_tg_health(tg_arn):
@@ -171,21 +377,134 @@ def _describe_tg_health(tg_arn):
     return {"summary": summary, "targets": details}
 
 
-def _load_ssm_parameter_value(name, label):
-    if not name:
-        return None
+def _status_targets(realm):
+    # (service_key, realm, service_arn) の一覧。realm 指定時は realm ごとに分かれたサービスをその realm に絞る
+    targets = []
+    for service_key in sorted(SERVICE_ARNS.keys()):
+        raw = SERVICE_ARNS.get(service_key)
+        if isinstance(raw, dict) and not realm:
+            targets.extend((service_key, key, raw[key]) for key in sorted(raw.keys()) if raw.get(key))
+            continue
+        service_arn, resolved_realm = _select_by_realm(raw, realm)
+        if service_arn:
+            targets.append((service_key, resolved_realm, service_arn))
+    return targets
+
+
+def _describe_services_batched(service_arns):
+    found = {}
+    failures = {}
+    unique = sorted(service_arns)
+    for i in range(0, len(unique), DESCRIBE_SERVICES_BATCH):
+        resp = ecs.describe_services(cluster=CLUSTER_ARN, services=unique[i : i + DESCRIBE_SERVICES_BATCH])
+        for svc in resp.get("services", []):
+            found[svc.get("serviceArn")] = svc
+        for failure in resp.get("failures", []):
+            failures[failure.get("arn")] = failure.get("reason", "NOT_FOUND")
+    return found, failures
+
+
+def _call(func, arg):
+    # 並行実行した呼び出しの例外は値として返し、ほかのサービスの結果に影響させない
     try:
-        resp = ssm.get_parameter(Name=name, WithDecryption=True)
-        return resp.get("Parameter", {}).get("Value")
+        return func(arg), None
     except Exception as exc:  # pylint: disable=broad-except
-        print({"warning": f"failed to load {label}", "parameter": name, "error": str(exc)})
-        return None
+        return None, str(exc)
+
+
+def _describe_all(realm):
+    # 全サービスの状態を 1 回で返す。describe_services は 10 件ずつまとめ、
+    # タスク定義 / ECR リポジトリ / ターゲットグループは重複を除いて並行に取得する
+    targets = _status_targets(realm)
+    service_arns = {service_arn for _, _, service_arn in targets}
+    services, failures = _describe_services_batched(service_arns)
+    task_def_arns = {svc.get("taskDefinition") for svc in services.values() if svc.get("taskDefinition")}
+    tg_arns = {}
+    for service_key, service_realm, _ in targets:
+        tg_arn, _ = _get_target_group_arn(service_key, service_realm)
+        if tg_arn:
+            tg_arns[(service_key, service_realm)] = tg_arn
+
+    with ThreadPoolExecutor(max_workers=STATUS_CONCURRENCY) as pool:
+        tg_futures = {arn: pool.submit(_call, _describe_tg_health, arn) for arn in set(tg_arns.values())}
+        td_calls = []
+        td_futures = {
+            arn: pool.submit(_call, functools.partial(_task_definition_image, api_calls=td_calls), arn) for arn in task_def_arns
+        }
+        images = {}
+        for arn, future in td_futures.items():
+            image, error = future.result()
+            if error:
+                print({"warning": "describe_task_definition failed", "error": error, "taskDefinition": arn})
+            images[arn] = image
+        repositories = {_ecr_repository(image) for image in images.values() if image} - {None}
+        ecr_futures = {repository: pool.submit(_call, _ecr_latest_tag, repository) for repository in repositories}
+        latest_tags = {}
+        for repository, future in ecr_futures.items():
+            tag, error = future.result()
+            if error:
+                print({"warning": "ecr_describe_images failed", "error": error, "repository": repository})
+            latest_tags[repository] = tag
+        tg_health = {arn: future.result() for arn, future in tg_futures.items()}
+
+    results = []
+    for service_key, service_realm, service_arn in targets:
+        entry = {"service": service_key, "resolvedRealm": service_realm or None}
+        svc = services.get(service_arn)
+        if svc is None:
+            entry["error"] = f"service not found: {service_arn} ({failures.get(service_arn, 'NOT_FOUND')})"
+            results.append(entry)
+            continue
+        image = images.get(svc.get("taskDefinition"))
+        repository = _ecr_repository(image) if image else None
+        entry.update(_service_status(svc, image, latest_tags.get(repository) if repository else None))
+        tg_arn = tg_arns.get((service_key, service_realm))
+        if tg_arn:
+            health, error = tg_health[tg_arn]
+            if error:
+                entry["targetGroupHealthError"] = error
+            else:
+                entry["targetGroupHealth"] = health
+        results.append(entry)
+    return {
+        "services": results,
+        "calls": {
+            "describeServices": math.ceil(len(service_arns) / DESCRIBE_SERVICES_BATCH),
+            "describeTaskDefinition": len(td_calls),
+            "ecrRepositories": len(repositories),
+            "targetGroups": len(tg_futures),
+        },
+        "cache": _cache_report(),
+    }
+
+
+def _load_ssm_parameter_values(names, label):
+    # 複数のパラメータを 1 回の GetParameters で取得する（ウォームコンテナ内では TTL の間キャッシュ）
+    names = [name for name in names if name]
+    if not names:
+        return {}
+    try:
+        values = ssm_cache.get_many(ssm, names)
+    except Exception as exc:  # pylint: disable=broad-except
+        print({"warning": f"failed to load {label}", "parameters": names, "error": str(exc)})
+        return {}
+    for name, value in values.items():
+        if value is None:
+            print({"warning": f"failed to load {label}", "parameter": name, "error": "parameter not found"})
+    return values
+
+
+def _load_ssm_parameter_value(name, label):
+    return _load_ssm_parameter_values([name], label).get(name)
 
 
 def _get_keycloak_admin_credentials():
+    values = _load_ssm_parameter_values(
+        [KEYCLOAK_ADMIN_USERNAME_PARAMETER, KEYCLOAK_ADMIN_PASSWORD_PARAMETER], "Keycloak admin credentials"
+    )
     return {
-        "username": _load_ssm_parameter_value(KEYCLOAK_ADMIN_USERNAME_PARAMETER, "Keycloak admin username"),
-        "password": _load_ssm_parameter_value(KEYCLOAK_ADMIN_PASSWORD_PARAMETER, "Keycloak admin password"),
+        "username": values.get(KEYCLOAK_ADMIN_USERNAME_PARAMETER),
+        "password": values.get(KEYCLOAK_ADMIN_PASSWORD_PARAMETER),
     }
 
 def _get_odoo_admin_credentials():
@@ -203,22 +522,16 @@ def _get_pgadmin_admin_credentials():
 
 
 def _update(service_arn, desired):
-    ecs.update_service(cluster=CLUSTER_ARN, service=service_arn, desiredCount=desired)
+    # update_service のレスポンスに更新後のサービスが含まれるため describe_services し直さない
+    resp = ecs.update_service(cluster=CLUSTER_ARN, service=service_arn, desiredCount=desired)
+    if resp.get("service"):
+        return _status_for_service(resp["service"])
     return _describe(service_arn)
 
 def _schedule_parameter_name(service_key):
     return f"{SERVICE_CONTROL_SSM_PATH.rstrip('/')}/{service_key}/schedule"
 
-DEFAULT_SCHEDULE = {
-    "enabled": False,
-    "start_time": "17:00",
-    "stop_time": "22:00",
-    "weekday_start_time": "17:00",
-    "weekday_stop_time": "22:00",
-    "holiday_start_time": "08:00",
-    "holiday_stop_time": "23:00",
-    "idle_minutes": 60,
-}
+DEFAULT_SCHEDULE = service_schedule.DEFAULT_SCHEDULE
 TIME_PATTERN = re.compile(r"^\d{2}:\d{2}$")
 
 def _validate_time(value):
@@ -226,24 +539,28 @@ def _validate_time(value):
         raise ValueError("time must be in HH:MM format")
 
 def _get_schedule(service_key):
+    # 単一サービスの参照 / 更新はキャッシュを使わない。別コンテナが直前に書いた値を
+    # 古いキャッシュで返したり、古い値を元に上書きしたりしないようにする
     if not SERVICE_CONTROL_SSM_PATH:
         return dict(DEFAULT_SCHEDULE)
-    try:
-        resp = ssm.get_parameter(Name=_schedule_parameter_name(service_key))
-        payload = json.loads(resp["Parameter"]["Value"])
-        return {**DEFAULT_SCHEDULE, **payload}
-    except ssm.exceptions.ParameterNotFound:
+    value = ssm_cache.get(ssm, _schedule_parameter_name(service_key), fresh=True)
+    if value is None:
         return dict(DEFAULT_SCHEDULE)
+    return {**DEFAULT_SCHEDULE, **json.loads(value)}
 
 def _put_schedule(service_key, schedule):
     if not SERVICE_CONTROL_SSM_PATH:
         return
-    ssm.put_parameter(
-        Name=_schedule_parameter_name(service_key),
-        Value=json.dumps(schedule),
-        Type="String",
-        Overwrite=True,
-    )
+    ssm_cache.put(ssm, _schedule_parameter_name(service_key), json.dumps(schedule), Type="String")
+
+def _with_transitions(schedule):
+    # スケジューラと同じタイムラインから、次の開始 / 停止時刻（現地時刻）を付ける
+    next_start, next_stop = service_schedule.next_transitions(schedule, service_schedule.local_now())
+    return {
+        **schedule,
+        "next_start": next_start.isoformat() if next_start else None,
+        "next_stop": next_stop.isoformat() if next_stop else None,
+    }
 
 def _update_schedule(service_key, payload):
     schedule = _get_schedule(service_key)
@@ -277,6 +594,8 @@ def handler(event, context):
             return _response(200, _get_odoo_admin_credentials())
         if route.endswith("/pgadmin-admin-credentials") and method == "GET":
             return _response(200, _get_pgadmin_admin_credentials())
+        if route.endswith("/status/all") and method == "GET":
+            return _response(200, _describe_all(realm))
         service_arn, resolved_realm = _get_service_arn(service_key, realm)
         if route.endswith("/status") and method == "GET":
             body = _describe(service_arn)
@@ -284,21 +603,24 @@ def handler(event, context):
             tg_arn, _ = _get_target_group_arn(service_key, realm)
             if tg_arn:
                 body["targetGroupHealth"] = _describe_tg_health(tg_arn)
+            body["cache"] = _cache_report()
             return _response(200, body)
         if route.endswith("/start") and method == "POST":
             body = _update(service_arn, START_DESIRED)
             body["resolvedRealm"] = resolved_realm or None
+            body["cache"] = _cache_report()
             return _response(200, body)
         if route.endswith("/stop") and method == "POST":
             body = _update(service_arn, 0)
             body["resolvedRealm"] = resolved_realm or None
+            body["cache"] = _cache_report()
             return _response(200, body)
         if route.endswith("/schedule"):
             if method == "GET":
-                return _response(200, _get_schedule(service_key))
+                return _response(200, _with_transitions(_get_schedule(service_key)))
             if method == "POST":
                 payload = json.loads(event.get("body") or "{}")
-                return _response(200, _update_schedule(service_key, payload))
+                return _response(200, _with_transitions(_update_schedule(service_key, payload)))
         return _response(404, {"message": "Not found"})
     except ValueError as exc:
         return _response(400, {"message": str(exc)})
@@ -1,10 +1,17 @@
 import base64
 import json
 import os
+import re
 
+import json_codec
 
 NAME_PREFIX = os.environ.get("NAME_PREFIX", "").strip("-")
 ENABLED_SERVICES = set(json.loads(os.environ.get("ENABLED_SERVICES", "[]") or "[]"))
+# 先頭だけで判定を試みるバイト数。base64 は 4 文字 = 3 バイト単位でデコードする
+HEADER_SCAN_BYTES = max(3, int(os.environ.get("HEADER_SCAN_BYTES", "1024") or "1024"))
+HEADER_SCAN_CHARS = -(-HEADER_SCAN_BYTES // 3) * 4
+# 最初にデコードする長さ。先頭の resource.attributes などが収まらなければ HEADER_SCAN_CHARS まで広げる
+HEADER_FIRST_SCAN_CHARS = min(HEADER_SCAN_CHARS, 512)
 
 SERVICE_ATTR_KEYS = {
     "aws.ecs.service.name",
@@ -25,6 +32,12 @@ NAMESPACE_ATTR_KEYS = {
     "aws.cloudwatch.namespace",
     "aws.cloudwatch.metric.namespace",
 }
+# 属性キー → 役割の索引（import 時に 1 回だけ構築）
+ATTR_KEY_ROLES = {
+    **{key: "namespace" for key in NAMESPACE_ATTR_KEYS},
+    **{key: "canary" for key in CANARY_ATTR_KEYS},
+    **{key: "service" for key in SERVICE_ATTR_KEYS},
+}
 
 
 def _build_allowed_service_names():
@@ -45,6 +58,15 @@ ALLOW_SYNTHETICS = (
 )
 
 
+# CloudWatch Metric Streams の JSON 形式は 1 レコードに改行区切りで複数メトリクスを含むことがある
+JSON_FORMAT_HEADER_RE = re.compile(rb'\{\s*"metric_stream_name"\s*:')
+OTLP_HEADER_RE = re.compile(rb'\{\s*"resourceMetrics"\s*:\s*\[\s*\{\s*"resource"\s*:\s*\{\s*"attributes"\s*:\s*\[')
+JSON_WHITESPACE = " \t\n\r"
+_JSON_DECODER = json.JSONDecoder()
+# 先頭部分が足りず判定できなかったことを表す
+_NEED_MORE = object()
+
+
 def _attr_value(value):
     if not isinstance(value, dict):
         return None
@@ -54,16 +76,34 @@ def _attr_value(value):
     return None
 
 
-def _extract_service_from_otlp(payload):
+def _scan_attributes(attrs, service_name=None, namespace=None):
+    for attr in attrs:
+        if not isinstance(attr, dict):
+            continue
+        role = ATTR_KEY_ROLES.get(attr.get("key"))
+        if role is None:
+            continue
+        if role == "namespace":
+            if namespace is None:
+                namespace = _attr_value(attr.get("value"))
+        elif service_name is None:
+            service_name = _attr_value(attr.get("value"))
+        if service_name is not None and namespace is not None:
+            break
+    return service_name, namespace
+
+
+def _extract_from_otlp(payload):
+    # resourceMetrics を 1 回だけ走査し、service（canary を含む）と namespace を同時に取り出す
+    service_name = None
+    namespace = None
     resource_metrics = payload.get("resourceMetrics") or payload.get("resource_metrics") or []
     for resource_metric in resource_metrics:
         attrs = (resource_metric.get("resource") or {}).get("attributes") or []
-        for attr in attrs:
-            if attr.get("key") in SERVICE_ATTR_KEYS.union(CANARY_ATTR_KEYS):
-                value = _attr_value(attr.get("value"))
-                if value:
-                    return value
-    return None
+        service_name, namespace = _scan_attributes(attrs, service_name, namespace)
+        if service_name is not None and namespace is not None:
+            break
+    return service_name, namespace
 
 
 def _extract_service_from_json(payload):
@@ -84,27 +124,16 @@ def _extract_service_from_json(payload):
     return None
 
 
-def _extract_service_name(payload):
-    return _extract_service_from_otlp(payload) or _extract_service_from_json(payload)
-
-
-def _extract_namespace_from_otlp(payload):
-    resource_metrics = payload.get("resourceMetrics") or payload.get("resource_metrics") or []
-    for resource_metric in resource_metrics:
-        attrs = (resource_metric.get("resource") or {}).get("attributes") or []
-        for attr in attrs:
-            if attr.get("key") in NAMESPACE_ATTR_KEYS:
-                value = _attr_value(attr.get("value"))
-                if value:
-                    return value
-    return None
-
-
-def _extract_namespace(payload):
+def _extract_service_and_namespace(payload):
+    # resourceMetrics の無いレコード（JSON 形式のメトリクスストリーム）は OTLP の走査を省く
+    if not ("resourceMetrics" in payload or "resource_metrics" in payload):
+        otlp_service, otlp_namespace = None, None
+    else:
+        otlp_service, otlp_namespace = _extract_from_otlp(payload)
+    service_name = otlp_service or _extract_service_from_json(payload)
     namespace = payload.get("namespace")
-    if namespace:
-        return str(namespace)
-    return _extract_namespace_from_otlp(payload)
+    namespace = str(namespace) if namespace else otlp_namespace
+    return service_name, namespace
 
 
 def _should_keep(service_name, namespace):
@@ -117,6 +146,69 @@ def _should_keep(service_name, namespace):
     return False
 
 
+def _classify_json_format_header(head):
+    # 先頭のメトリクスが先頭部分の中で閉じ、その後にも値が続くレコード（改行区切りの複数メトリクス）は
+    # 1 つの JSON として解釈できず、全体を解析しても従来どおり残すことになるため、ここで残す。
+    # メトリクス 1 件だけのレコードは数百バイトで HEADER_SCAN_BYTES に収まり、全体の解析に回る
+    if b"\n{" not in head:
+        return _NEED_MORE
+    try:
+        text = head.decode("utf-8", "ignore")
+        _, end = _JSON_DECODER.raw_decode(text)
+    except ValueError:
+        return _NEED_MORE
+    if text[end:].strip(JSON_WHITESPACE):
+        return True
+    return None
+
+
+def _classify_otlp_header(head):
+    # 先頭の resource.attributes が閉じていれば、最初に見つかる service はそこで確定する。
+    # 許可された service なら残す。破損したレコードも全体の解析で残すため、後続を読まなくても結果は変わらない
+    match = OTLP_HEADER_RE.match(head)
+    if not match:
+        return None
+    end = head.find(b"]", match.end())
+    if end < 0:
+        return _NEED_MORE
+    segment = head[match.end() : end]
+    if b"[" in segment:
+        return None
+    # 許可された service 名が文字列として現れなければ、解析しても残すとは決まらない
+    if not any(b'"%s"' % name.encode("utf-8") in segment for name in ALLOWED_SERVICE_NAMES):
+        return None
+    try:
+        attrs = json.loads(b"[" + segment + b"]")
+    except ValueError:
+        return None
+    service_name, _ = _scan_attributes(attrs)
+    if service_name in ALLOWED_SERVICE_NAMES:
+        return True
+    return None
+
+
+def _classify_header(data):
+    # HEADER_SCAN_BYTES を超えるレコードは先頭だけをデコードし、残すと確定できるものを先に残す。
+    # 落とす判定はしない（後続が破損していれば全体の解析では残すため、先頭だけでは決められない）。
+    # Metric Streams の出力と同じく、キーの重複しない JSON を前提とする。
+    # 判定できない場合と、先頭だけで全体が収まる小さなレコードは None を返し、全体の解析に任せる
+    # "{" で始まらない（base64 の先頭が "e" でない）レコードはデコードしない
+    if len(data) <= HEADER_SCAN_CHARS or not data.startswith("e"):
+        return None
+    for scan_chars in (HEADER_FIRST_SCAN_CHARS, HEADER_SCAN_CHARS):
+        try:
+            head = base64.b64decode(data[:scan_chars])
+        except ValueError:
+            return None
+        if JSON_FORMAT_HEADER_RE.match(head):
+            keep = _classify_json_format_header(head)
+        else:
+            keep = _classify_otlp_header(head)
+        if keep is not _NEED_MORE:
+            return keep
+    return None
+
+
 def handler(event, context):
     records_out = []
     for record in event.get("records", []):
@@ -125,13 +217,19 @@ def handler(event, context):
         if not data:
             records_out.append({"recordId": record_id, "result": "Dropped", "data": ""})
             continue
+        # 許可リストが空なら全レコードを残すため、デコード自体を省く
+        if not ALLOWED_SERVICE_NAMES:
+            records_out.append({"recordId": record_id, "result": "Ok", "data": data})
+            continue
+        if _classify_header(data):
+            records_out.append({"recordId": record_id, "result": "Ok", "data": data})
+            continue
         try:
-            payload = json.loads(base64.b64decode(data))
+            payload = json_codec.loads(base64.b64decode(data))
         except Exception:
             records_out.append({"recordId": record_id, "result": "Ok", "data": data})
             continue
-        service_name = _extract_service_name(payload)
-        namespace = _extract_namespace(payload)
+        service_name, namespace = _extract_service_and_namespace(payload)
         result = "Ok" if _should_keep(service_name, namespace) else "Dropped"
         records_out.append({"recordId": record_id, "result": result, "data": data})
     return {"records": records_out}
@@ -1,10 +1,17 @@
+import hashlib
 import json
 import math
 import os
-from datetime import date, datetime, timedelta, timezone
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 import boto3
 
+import service_schedule
+import ssm_cache
+
 ecs = boto3.client("ecs")
 ssm = boto3.client("ssm")
 cloudwatch = boto3.client("cloudwatch")
@@ -18,7 +25,6 @@ SERVICE_ARNS_SSM_PARAMETER = os.environ.get("SERVICE_ARNS_SSM_PARAMETER", "")
 AUTOSTOP_ALARMS_SSM_PARAMETER = os.environ.get("SERVICE_CONTROL_AUTOSTOP_ALARMS_SSM_PARAMETER", "")
 SERVICE_CONTROL_AUTOSTOP_POLICY_ARNS_RAW = json.loads(os.environ.get("SERVICE_CONTROL_AUTOSTOP_POLICY_ARNS") or "{}")
 START_DESIRED = int(os.environ.get("START_DESIRED", "1"))
-JST_OFFSET = int(os.environ.get("SERVICE_CONTROL_SCHEDULE_TIMEZONE_OFFSET", "9"))
 SERVICE_CONTROL_AUTOSTOP_ALARM_REGION = os.environ.get("SERVICE_CONTROL_AUTOSTOP_ALARM_REGION", "")
 SERVICE_CONTROL_AUTOSTOP_WAF_NAME = os.environ.get("SERVICE_CONTROL_AUTOSTOP_WAF_NAME", "")
 SERVICE_CONTROL_AUTOSTOP_ALARM_PERIOD_SECONDS = int(os.environ.get("SERVICE_CONTROL_AUTOSTOP_ALARM_PERIOD_SECONDS", "300"))
@@ -29,7 +35,31 @@ SERVICE_CONTROL_AUTOSTOP_ALARM_STATISTIC = os.environ.get("SERVICE_CONTROL_AUTOS
 SERVICE_CONTROL_AUTOSTOP_ALARM_COMPARISON_OPERATOR = os.environ.get("SERVICE_CONTROL_AUTOSTOP_ALARM_COMPARISON_OPERATOR", "LessThanOrEqualToThreshold")
 SERVICE_CONTROL_AUTOSTOP_ALARM_THRESHOLD = float(os.environ.get("SERVICE_CONTROL_AUTOSTOP_ALARM_THRESHOLD", "0"))
 SERVICE_CONTROL_AUTOSTOP_ALARM_TREAT_MISSING_DATA = os.environ.get("SERVICE_CONTROL_AUTOSTOP_ALARM_TREAT_MISSING_DATA", "breaching")
-HOLIDAY_CACHE = {}
+# サービスごとのアラーム更新 / 起動処理の並列度
+SCHEDULER_CONCURRENCY = max(1, int(os.environ.get("SCHEDULER_CONCURRENCY", "8") or "8"))
+# describe_services に一度に渡せるサービス数の上限
+DESCRIBE_SERVICES_BATCH = 10
+# アラーム名 -> 最後に確認 / 書き込みしたアラーム設定のフィンガープリント（ウォームコンテナの間だけ保持）
+ALARM_FINGERPRINTS = {}
+# 予測起動: WAF の CountedRequests の履歴から曜日 / 休日ごとの時間帯別の需要を求め、
+# 需要が見込まれる時間帯の少し前から、スケジュール外でもサービスを起動しておく。
+# その時間帯が終わるまではアイドル停止アラームのアクションを止め、終わった後の停止はアラームに任せる
+PREWARM_ENABLED = os.environ.get("SERVICE_CONTROL_PREWARM_ENABLED", "false").strip().lower() in ("1", "true", "yes")
+PREWARM_LOOKBACK_DAYS = max(7, int(os.environ.get("SERVICE_CONTROL_PREWARM_LOOKBACK_DAYS", "28") or "28"))
+PREWARM_LEAD_MINUTES = max(0, int(os.environ.get("SERVICE_CONTROL_PREWARM_LEAD_MINUTES", "15") or "15"))
+# 同じ区分（曜日 / 休日）の同じ時間帯のうち、リクエストがあった日の割合がこの値以上なら需要ありとみなす
+PREWARM_MIN_PROBABILITY = float(os.environ.get("SERVICE_CONTROL_PREWARM_MIN_PROBABILITY", "0.5") or "0.5")
+# 需要プロファイルを作り直す間隔
+PREWARM_REFRESH_SECONDS = int(os.environ.get("SERVICE_CONTROL_PREWARM_REFRESH_SECONDS", "3600") or "3600")
+# 区分は曜日 0-6 と、平日の祝日・振替休日 7
+DEMAND_CLASSES = 8
+HOLIDAY_DEMAND_CLASS = 7
+HOURS_PER_DAY = 24
+# GetMetricData 1 回あたりのクエリ数の上限
+GET_METRIC_DATA_MAX_QUERIES = 500
+# 需要プロファイル（ウォームコンテナの間だけ保持）。
+# observed / hits[service_key] は 区分 * 24 + 時 ごとの、観測した日数 / リクエストがあった日数
+DEMAND_PROFILES = {"keys": (), "expiresAt": 0.0, "observed": None, "hits": {}}
 
 
 def _parse_cluster_arn(cluster_arn):
@@ -88,147 +118,46 @@ SERVICE_ARNS = _load_service_arns()
 SERVICE_CONTROL_AUTOSTOP_POLICIES = _load_autostop_policies()
 
 
-DEFAULT_SCHEDULE = {
-    "enabled": False,
-    "start_time": "17:00",
-    "stop_time": "22:00",
-    "weekday_start_time": "17:00",
-    "weekday_stop_time": "22:00",
-    "holiday_start_time": "08:00",
-    "holiday_stop_time": "23:00",
-    "idle_minutes": 60,
-}
-DEFAULT_START_MINUTES = 17 * 60
-DEFAULT_STOP_MINUTES = 22 * 60
-
-
-def _nth_weekday(year, month, weekday, nth):
-    first = date(year, month, 1)
-    offset = (weekday - first.weekday() + 7) % 7
-    return first + timedelta(days=offset + 7 * (nth - 1))
-
-
-def _japan_equinox(year, spring=True):
-    base = 20.8431 if spring else 23.2488
-    day = math.floor(base + 0.242194 * (year - 1980) - math.floor((year - 1980) / 4))
-    month = 3 if spring else 9
-    return date(year, month, day)
-
-
-def _base_japan_holidays(year):
-    holidays = {
-        date(year, 1, 1),
-        date(year, 2, 11),
-        _japan_equinox(year, True),
-        date(year, 4, 29),
-        date(year, 5, 3),
-        date(year, 5, 4),
-        date(year, 5, 5),
-        _japan_equinox(year, False),
-        date(year, 11, 3),
-        date(year, 11, 23),
-    }
-    holidays.add(_nth_weekday(year, 1, 0, 2) if year >= 2000 else date(year, 1, 15))
-    if year >= 2020:
-        holidays.add(date(year, 2, 23))
-    elif 1989 <= year <= 2018:
-        holidays.add(date(year, 12, 23))
-    if year >= 2003:
-        holidays.add(_nth_weekday(year, 7, 0, 3))
-    elif year >= 1996:
-        holidays.add(date(year, 7, 20))
-    if year >= 2016:
-        holidays.add(date(year, 8, 11))
-    if year >= 2003:
-        holidays.add(_nth_weekday(year, 9, 0, 3))
-    elif year >= 1966:
-        holidays.add(date(year, 9, 15))
-    holidays.add(_nth_weekday(year, 10, 0, 2) if year >= 2000 else date(year, 10, 10))
-    return holidays
-
-
-def _apply_substitute_holidays(holidays):
-    substitutes = set()
-    for holiday in sorted(holidays):
-        if holiday.weekday() != 6:
-            continue
-        candidate = holiday + timedelta(days=1)
-        while candidate in holidays or candidate in substitutes:
-            candidate += timedelta(days=1)
-        substitutes.add(candidate)
-    return substitutes
-
-
-def _apply_bridge_holidays(holidays):
-    bridges = set()
-    for holiday in holidays:
-        candidate = holiday + timedelta(days=1)
-        if candidate in holidays or candidate.weekday() >= 5:
-            continue
-        if candidate + timedelta(days=1) in holidays:
-            bridges.add(candidate)
-    return bridges
-
-
-def _japan_holidays(year):
-    if year in HOLIDAY_CACHE:
-        return HOLIDAY_CACHE[year]
-    holidays = _base_japan_holidays(year)
-    holidays |= _apply_substitute_holidays(holidays)
-    holidays |= _apply_bridge_holidays(holidays)
-    holidays |= _apply_substitute_holidays(holidays)
-    HOLIDAY_CACHE[year] = holidays
-    return holidays
-
-
-def _is_off_day(local_date):
-    if local_date.weekday() >= 5:
-        return True
-    return local_date in _japan_holidays(local_date.year)
-
+DEFAULT_SCHEDULE = service_schedule.DEFAULT_SCHEDULE
 
 
 def _schedule_parameter_name(service_key):
     return f"{SERVICE_CONTROL_SSM_PATH.rstrip('/')}/{service_key}/schedule"
 
 
-def _parse_time(value, fallback):
+def _load_schedules(service_keys):
+    # 全サービスのスケジュールを GetParameters でまとめて取得する（1 回あたり 10 件）
+    # API からのスケジュール変更は、ウォームコンテナのキャッシュが切れる最大 SSM_CACHE_TTL_SECONDS 後に反映される
+    if not SERVICE_CONTROL_SSM_PATH:
+        return {}
+    names = {service_key: _schedule_parameter_name(service_key) for service_key in service_keys}
     try:
-        parts = value.split(":")
-        if len(parts) != 2:
-            raise ValueError
-        hours = int(parts[0])
-        minutes = int(parts[1])
-        return hours * 60 + minutes
-    except Exception:
-        return fallback
+        values = ssm_cache.get_many(ssm, list(names.values()))
+    except Exception as exc:  # pylint: disable=broad-except
+        print({"warning": "failed to load schedules", "error": str(exc)})
+        return {}
+    schedules = {}
+    for service_key, name in names.items():
+        try:
+            schedules[service_key] = json.loads(values[name]) if values.get(name) else None
+        except Exception:
+            schedules[service_key] = None
+    return schedules
 
 
 def _get_schedule(service_key):
-    if not SERVICE_CONTROL_SSM_PATH:
-        return None
-    try:
-        resp = ssm.get_parameter(Name=_schedule_parameter_name(service_key))
-        return json.loads(resp["Parameter"]["Value"])
-    except ssm.exceptions.ParameterNotFound:
-        return None
-    except Exception:
-        return None
+    return _load_schedules([service_key]).get(service_key)
 
 
 def _put_schedule(service_key, schedule):
     if not SERVICE_CONTROL_SSM_PATH:
         return
-    ssm.put_parameter(
-        Name=_schedule_parameter_name(service_key),
-        Value=json.dumps(schedule),
-        Type="String",
-        Overwrite=True,
-    )
+    ssm_cache.put(ssm, _schedule_parameter_name(service_key), json.dumps(schedule), Type="String")
 
 
-def _ensure_schedule(service_key):
-    schedule = _get_schedule(service_key)
+def _ensure_schedule(service_key, schedule=None):
+    if schedule is None:
+        schedule = _get_schedule(service_key)
     if not schedule:
         schedule = dict(DEFAULT_SCHEDULE)
         _put_schedule(service_key, schedule)
@@ -250,41 +179,23 @@ def _ensure_schedule(service_key):
 
 
 def _current_local_datetime():
-    return datetime.now(timezone.utc) + timedelta(hours=JST_OFFSET)
+    return service_schedule.local_now()
 
 
-def _time_window(schedule, local_dt):
-    base_start_raw = schedule.get("start_time", DEFAULT_SCHEDULE["start_time"])
-    base_stop_raw = schedule.get("stop_time", DEFAULT_SCHEDULE["stop_time"])
-    base_start = _parse_time(base_start_raw, DEFAULT_START_MINUTES)
-    base_stop = _parse_time(base_stop_raw, DEFAULT_STOP_MINUTES)
-    if _is_off_day(local_dt.date()):
-        start_raw = schedule.get("holiday_start_time") or base_start_raw
-        stop_raw = schedule.get("holiday_stop_time") or base_stop_raw
-    else:
-        start_raw = schedule.get("weekday_start_time") or base_start_raw
-        stop_raw = schedule.get("weekday_stop_time") or base_stop_raw
-    start = _parse_time(start_raw, base_start)
-    stop = _parse_time(stop_raw, base_stop)
-    return start, stop
+def _should_be_active(schedule, local_dt):
+    # 前日から数日分の稼働区間を展開したタイムラインを二分探索する
+    return service_schedule.is_active(schedule, local_dt)
 
 
-def _should_be_active(schedule, local_dt):
-    if not schedule or not schedule.get("enabled"):
-        return False
-    current_minutes = local_dt.hour * 60 + local_dt.minute
-    start, stop = _time_window(schedule, local_dt)
-    if start <= stop:
-        return start <= current_minutes < stop
-    return current_minutes >= start or current_minutes < stop
-
-
-def _describe_current_desired(service_arn):
-    resp = ecs.describe_services(cluster=CLUSTER_ARN, services=[service_arn])
-    services = resp.get("services") or []
-    if not services:
-        return None
-    return services[0].get("desiredCount", 0)
+def _describe_desired_counts(service_arns):
+    # {service_arn: desiredCount}。見つからないサービスは含めない
+    desired = {}
+    unique = sorted(set(service_arns))
+    for i in range(0, len(unique), DESCRIBE_SERVICES_BATCH):
+        resp = ecs.describe_services(cluster=CLUSTER_ARN, services=unique[i : i + DESCRIBE_SERVICES_BATCH])
+        for svc in resp.get("services") or []:
+            desired[svc.get("serviceArn")] = svc.get("desiredCount", 0)
+    return desired, math.ceil(len(unique) / DESCRIBE_SERVICES_BATCH)
 
 
 def _update_desired(service_arn, desired):
@@ -297,12 +208,25 @@ def _alarm_details(service_key):
     return alarm_name, rule_name
 
 
-def _update_idle_alarm(service_key, schedule, active):
+def _counted_requests_metric(rule_name):
+    return {
+        "Namespace": SERVICE_CONTROL_AUTOSTOP_ALARM_NAMESPACE,
+        "MetricName": SERVICE_CONTROL_AUTOSTOP_ALARM_METRIC_NAME,
+        "Dimensions": [
+            {"Name": "WebACL", "Value": SERVICE_CONTROL_AUTOSTOP_WAF_NAME},
+            {"Name": "Rule", "Value": rule_name},
+            {"Name": "Region", "Value": SERVICE_CONTROL_AUTOSTOP_ALARM_REGION},
+        ],
+    }
+
+
+def _idle_alarm_spec(service_key, schedule, active):
+    # put_metric_alarm に渡す設定。対象外なら None
     policy_arn = SERVICE_CONTROL_AUTOSTOP_POLICIES.get(service_key)
     if not policy_arn:
-        return
+        return None
     if not SERVICE_CONTROL_AUTOSTOP_WAF_NAME or not SERVICE_CONTROL_AUTOSTOP_ALARM_REGION:
-        return
+        return None
     alarm_name, rule_name = _alarm_details(service_key)
     idle_minutes = schedule.get("idle_minutes") if schedule else DEFAULT_SCHEDULE["idle_minutes"]
     try:
@@ -310,77 +234,314 @@ def _update_idle_alarm(service_key, schedule, active):
     except (TypeError, ValueError):
         idle_value = DEFAULT_SCHEDULE["idle_minutes"]
     evaluation_periods = max(1, math.ceil(idle_value / SERVICE_CONTROL_AUTOSTOP_ALARM_PERIOD_MINUTES))
-    try:
-        # WAF "CountedRequests" may not emit datapoints when there is no traffic.
-        # When datapoints are missing, CloudWatch alarms can transition to ALARM (TreatMissingData),
-        # but Application Auto Scaling may fail to execute the scaling action with:
-        #   "Metric data points must be provided"
-        # Use metric math to fill missing datapoints with 0 so the alarm always has data.
-        metrics = [
-            {
-                "Id": "m1",
-                "MetricStat": {
-                    "Metric": {
-                        "Namespace": SERVICE_CONTROL_AUTOSTOP_ALARM_NAMESPACE,
-                        "MetricName": SERVICE_CONTROL_AUTOSTOP_ALARM_METRIC_NAME,
-                        "Dimensions": [
-                            {"Name": "WebACL", "Value": SERVICE_CONTROL_AUTOSTOP_WAF_NAME},
-                            {"Name": "Rule", "Value": rule_name},
-                            {"Name": "Region", "Value": SERVICE_CONTROL_AUTOSTOP_ALARM_REGION},
-                        ],
-                    },
-                    "Period": SERVICE_CONTROL_AUTOSTOP_ALARM_PERIOD_SECONDS,
-                    "Stat": SERVICE_CONTROL_AUTOSTOP_ALARM_STATISTIC,
-                },
-                "ReturnData": False,
+    # WAF "CountedRequests" may not emit datapoints when there is no traffic.
+    # When datapoints are missing, CloudWatch alarms can transition to ALARM (TreatMissingData),
+    # but Application Auto Scaling may fail to execute the scaling action with:
+    #   "Metric data points must be provided"
+    # Use metric math to fill missing datapoints with 0 so the alarm always has data.
+    metrics = [
+        {
+            "Id": "m1",
+            "MetricStat": {
+                "Metric": _counted_requests_metric(rule_name),
+                "Period": SERVICE_CONTROL_AUTOSTOP_ALARM_PERIOD_SECONDS,
+                "Stat": SERVICE_CONTROL_AUTOSTOP_ALARM_STATISTIC,
             },
+            "ReturnData": False,
+        },
+        {
+            "Id": "e1",
+            "Expression": "FILL(m1, 0)",
+            "Label": "CountedRequestsFilled",
+            "ReturnData": True,
+        },
+    ]
+    return {
+        "AlarmName": alarm_name,
+        "ComparisonOperator": SERVICE_CONTROL_AUTOSTOP_ALARM_COMPARISON_OPERATOR,
+        "EvaluationPeriods": evaluation_periods,
+        "Metrics": metrics,
+        "Threshold": SERVICE_CONTROL_AUTOSTOP_ALARM_THRESHOLD,
+        "TreatMissingData": SERVICE_CONTROL_AUTOSTOP_ALARM_TREAT_MISSING_DATA,
+        "ActionsEnabled": not active,
+        "AlarmActions": [policy_arn],
+    }
+
+
+def _alarm_fingerprint(alarm):
+    # put_metric_alarm の引数と describe_alarms の結果はキー名が同じなので、同じ関数で比較用の値を作る
+    metrics = []
+    for metric in alarm.get("Metrics") or []:
+        stat = metric.get("MetricStat") or {}
+        inner = stat.get("Metric") or {}
+        metrics.append(
             {
-                "Id": "e1",
-                "Expression": "FILL(m1, 0)",
-                "Label": "CountedRequestsFilled",
-                "ReturnData": True,
-            },
-        ]
-        cloudwatch.put_metric_alarm(
-            AlarmName=alarm_name,
-            ComparisonOperator=SERVICE_CONTROL_AUTOSTOP_ALARM_COMPARISON_OPERATOR,
-            EvaluationPeriods=evaluation_periods,
-            Metrics=metrics,
-            Threshold=SERVICE_CONTROL_AUTOSTOP_ALARM_THRESHOLD,
-            TreatMissingData=SERVICE_CONTROL_AUTOSTOP_ALARM_TREAT_MISSING_DATA,
-            ActionsEnabled=not active,
-            AlarmActions=[policy_arn],
+                "Id": metric.get("Id"),
+                "Expression": metric.get("Expression"),
+                "Label": metric.get("Label"),
+                "ReturnData": metric.get("ReturnData", True),
+                "Namespace": inner.get("Namespace"),
+                "MetricName": inner.get("MetricName"),
+                "Dimensions": sorted([d.get("Name"), d.get("Value")] for d in inner.get("Dimensions") or []),
+                "Period": stat.get("Period"),
+                "Stat": stat.get("Stat"),
+            }
         )
+    evaluation_periods = alarm.get("EvaluationPeriods")
+    projection = {
+        "ComparisonOperator": alarm.get("ComparisonOperator"),
+        "EvaluationPeriods": evaluation_periods,
+        "DatapointsToAlarm": alarm.get("DatapointsToAlarm") or evaluation_periods,
+        "Threshold": float(alarm.get("Threshold") or 0),
+        "TreatMissingData": alarm.get("TreatMissingData"),
+        "ActionsEnabled": bool(alarm.get("ActionsEnabled")),
+        "AlarmActions": sorted(alarm.get("AlarmActions") or []),
+        "Metrics": sorted(metrics, key=lambda m: m["Id"] or ""),
+    }
+    return hashlib.sha256(json.dumps(projection, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _describe_alarm_fingerprints(alarm_names):
+    # 対象アラームを 1 回の describe_alarms（100 件ずつ）で取得する。失敗したら None
+    if not alarm_names:
+        return {}
+    fingerprints = {}
+    names = sorted(set(alarm_names))
+    try:
+        paginator = cloudwatch.get_paginator("describe_alarms")
+        for i in range(0, len(names), 100):
+            for page in paginator.paginate(AlarmNames=names[i : i + 100], AlarmTypes=["MetricAlarm"]):
+                for alarm in page.get("MetricAlarms", []):
+                    fingerprints[alarm["AlarmName"]] = _alarm_fingerprint(alarm)
+    except Exception as exc:  # pylint: disable=broad-except
+        print({"warning": "describe_alarms failed", "error": str(exc)})
+        return None
+    ALARM_FINGERPRINTS.update(fingerprints)
+    return fingerprints
+
+
+def _update_idle_alarm(service_key, schedule, active, live_fingerprints=None):
+    # updated / unchanged / failed / skipped を返す。
+    # 実際のアラーム（取得できなかった場合は前回書き込んだ内容）と同じなら put_metric_alarm しない
+    spec = _idle_alarm_spec(service_key, schedule, active)
+    if spec is None:
+        return "skipped"
+    alarm_name = spec["AlarmName"]
+    fingerprint = _alarm_fingerprint(spec)
+    known = live_fingerprints.get(alarm_name) if live_fingerprints is not None else ALARM_FINGERPRINTS.get(alarm_name)
+    if known == fingerprint:
+        return "unchanged"
+    try:
+        cloudwatch.put_metric_alarm(**spec)
+        ALARM_FINGERPRINTS[alarm_name] = fingerprint
+        return "updated"
     except Exception as exc:  # pylint: disable=broad-except
+        ALARM_FINGERPRINTS.pop(alarm_name, None)
         print({"service": service_key, "alarm": alarm_name, "error": str(exc)})
+        return "failed"
+
+
+def _demand_class(local_date):
+    # 曜日（0-6）。平日の祝日・振替休日は HOLIDAY_DEMAND_CLASS
+    weekday = local_date.weekday()
+    if weekday < 5 and service_schedule.is_off_day(local_date):
+        return HOLIDAY_DEMAND_CLASS
+    return weekday
+
+
+def _fetch_hourly_requests(service_keys, start, hours):
+    # {service_key: array("d")}。start（UTC の正時）から hours 時間分の 1 時間ごとのリクエスト数。
+    # 全サービスを 1 回の GetMetricData にまとめる。データポイントが無い時間は 0
+    series = {service_key: array("d", [0.0]) * hours for service_key in service_keys}
+    calls = 0
+    for i in range(0, len(service_keys), GET_METRIC_DATA_MAX_QUERIES):
+        query_ids = {f"m{i + n}": service_key for n, service_key in enumerate(service_keys[i : i + GET_METRIC_DATA_MAX_QUERIES])}
+        kwargs = {
+            "MetricDataQueries": [
+                {
+                    "Id": query_id,
+                    "MetricStat": {
+                        "Metric": _counted_requests_metric(_alarm_details(service_key)[1]),
+                        "Period": 3600,
+                        "Stat": "Sum",
+                    },
+                    "ReturnData": True,
+                }
+                for query_id, service_key in query_ids.items()
+            ],
+            "StartTime": start,
+            "EndTime": start + timedelta(hours=hours),
+            "ScanBy": "TimestampAscending",
+        }
+        while True:
+            resp = cloudwatch.get_metric_data(**kwargs)
+            calls += 1
+            for result in resp.get("MetricDataResults", []):
+                values = series.get(query_ids.get(result.get("Id")))
+                if values is None:
+                    continue
+                for timestamp, value in zip(result.get("Timestamps") or [], result.get("Values") or []):
+                    index = int((timestamp - start).total_seconds() // 3600)
+                    if 0 <= index < hours:
+                        values[index] += value
+            if not resp.get("NextToken"):
+                break
+            kwargs["NextToken"] = resp["NextToken"]
+    return series, calls
+
+
+def _demand_slots(start, hours):
+    # 各時間（UTC の start から）を 区分 * 24 + 現地時刻の時 に対応づける
+    first_local = start + timedelta(hours=service_schedule.TIMEZONE_OFFSET_HOURS)
+    slots = array("B", [0]) * hours
+    for i in range(hours):
+        moment = first_local + timedelta(hours=i)
+        slots[i] = _demand_class(moment.date()) * HOURS_PER_DAY + moment.hour
+    return slots
+
+
+def _load_demand_profiles(service_keys, now_utc):
+    # 直近 PREWARM_LOOKBACK_DAYS 日分（完了した時間のみ）から需要プロファイルを作り、PREWARM_REFRESH_SECONDS の間使い回す。
+    # 取得に失敗した場合は前回のプロファイルのまま、次回の実行で取り直す
+    keys = tuple(sorted(service_keys))
+    if DEMAND_PROFILES["keys"] == keys and time.monotonic() < DEMAND_PROFILES["expiresAt"]:
+        return DEMAND_PROFILES, 0
+    hours = PREWARM_LOOKBACK_DAYS * HOURS_PER_DAY
+    start = now_utc.replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours)
+    try:
+        series, calls = _fetch_hourly_requests(list(keys), start, hours)
+    except Exception as exc:  # pylint: disable=broad-except
+        print({"warning": "get_metric_data failed", "error": str(exc)})
+        return DEMAND_PROFILES, 1
+    slots = _demand_slots(start, hours)
+    observed = array("H", [0]) * (DEMAND_CLASSES * HOURS_PER_DAY)
+    for slot in slots:
+        observed[slot] += 1
+    hits = {}
+    for service_key, values in series.items():
+        counts = array("H", [0]) * (DEMAND_CLASSES * HOURS_PER_DAY)
+        for slot, value in zip(slots, values):
+            if value > 0:
+                counts[slot] += 1
+        hits[service_key] = counts
+    DEMAND_PROFILES.update(
+        {"keys": keys, "expiresAt": time.monotonic() + PREWARM_REFRESH_SECONDS, "observed": observed, "hits": hits}
+    )
+    return DEMAND_PROFILES, calls
+
+
+def _demand_probability(profiles, service_key, local_dt):
+    # その区分・時間帯のうち、リクエストがあった日の割合
+    hits = profiles["hits"].get(service_key)
+    observed = profiles["observed"]
+    if hits is None or observed is None:
+        return 0.0
+    demand_class = _demand_class(local_dt.date())
+    slot = demand_class * HOURS_PER_DAY + local_dt.hour
+    if not observed[slot] and demand_class == HOLIDAY_DEMAND_CLASS:
+        # 履歴に平日の休日が無ければ日曜と同じとみなす
+        slot = 6 * HOURS_PER_DAY + local_dt.hour
+    return hits[slot] / observed[slot] if observed[slot] else 0.0
+
+
+def _prewarm_due(profiles, service_key, local_now):
+    # いまの時間帯か、PREWARM_LEAD_MINUTES 後の時間帯に需要が見込まれるか
+    for moment in (local_now, local_now + timedelta(minutes=PREWARM_LEAD_MINUTES)):
+        probability = _demand_probability(profiles, service_key, moment)
+        if probability > 0 and probability >= PREWARM_MIN_PROBABILITY:
+            return True
+    return False
+
+
+def _realm_service_arns(service_arn):
+    arns = list(service_arn.values()) if isinstance(service_arn, dict) else [service_arn]
+    return [arn for arn in arns if arn]
+
+
+def _reconcile_service(service_key, schedule, active, service_arns, desired_counts, live_fingerprints):
+    # アラームの更新と、稼働時間帯なのに停止しているサービスの起動
+    started_at = time.monotonic()
+    report = {"service": service_key, "active": active, "alarm": None, "started": [], "errors": []}
+    report["alarm"] = _update_idle_alarm(service_key, schedule, active, live_fingerprints)
+    if active:
+        for service_arn in service_arns:
+            current = desired_counts.get(service_arn)
+            if current is None or current == START_DESIRED:
+                continue
+            try:
+                _update_desired(service_arn, START_DESIRED)
+                report["started"].append(service_arn)
+            except Exception as exc:  # pylint: disable=broad-except
+                print({"service": service_key, "error": str(exc)})
+                report["errors"].append({"serviceArn": service_arn, "error": str(exc)})
+    report["latencyMs"] = round((time.monotonic() - started_at) * 1000, 1)
+    return report
 
 
 def handler(event, context):
+    tick_started_at = time.monotonic()
     local_now = _current_local_datetime()
-    for service_key in SERVICE_CONTROL_SCHEDULE_SERVICES:
-        service_arn = SERVICE_ARNS.get(service_key)
-        if not service_arn:
-            continue
-        schedule = _ensure_schedule(service_key)
+    targets = [key for key in SERVICE_CONTROL_SCHEDULE_SERVICES if SERVICE_ARNS.get(key)]
+    schedules = _load_schedules(targets)
+
+    # 予測起動はアイドル停止アラームのあるサービスだけ（需要の時間帯が終わった後、需要が無ければアラームで止まる）
+    prewarm_targets = []
+    if PREWARM_ENABLED and SERVICE_CONTROL_AUTOSTOP_WAF_NAME and SERVICE_CONTROL_AUTOSTOP_ALARM_REGION:
+        prewarm_targets = [key for key in targets if SERVICE_CONTROL_AUTOSTOP_POLICIES.get(key)]
+    profiles, metric_data_calls = (
+        _load_demand_profiles(prewarm_targets, datetime.now(timezone.utc)) if prewarm_targets else (None, 0)
+    )
+
+    plans = []
+    prewarmed = set()
+    for service_key in targets:
+        schedule = _ensure_schedule(service_key, schedules.get(service_key))
         active = _should_be_active(schedule, local_now)
-        _update_idle_alarm(service_key, schedule, active)
-        if not active:
-            continue
-        service_arns = (
-            list(service_arn.values())
-            if isinstance(service_arn, dict)
-            else [service_arn]
-        )
-        for actual_service_arn in service_arns:
-            if not actual_service_arn:
-                continue
-            desired = START_DESIRED
-            current = _describe_current_desired(actual_service_arn)
-            if current is None:
-                continue
-            if current != desired:
-                try:
-                    _update_desired(actual_service_arn, desired)
-                except Exception as exc:  # pylint: disable=broad-except
-                    print({"service": service_key, "error": str(exc)})
-    return {"status": "ok", "timestamp": datetime.now(timezone.utc).isoformat()}
+        if not active and service_key in prewarm_targets and _prewarm_due(profiles, service_key, local_now):
+            # 稼働時間帯と同じ扱いにし、起動したうえで需要の時間帯が終わるまでアラームの停止アクションを止める。
+            # 停止中のアイドル期間でアラームは ALARM のままのため、アクションを有効にしておくと起動直後に止められる
+            active = True
+            prewarmed.add(service_key)
+        plans.append((service_key, schedule, active, _realm_service_arns(SERVICE_ARNS[service_key])))
+
+    # 稼働時間帯のサービスだけ、現在の desiredCount を 10 件ずつまとめて取得する
+    active_arns = [arn for _, _, active, arns in plans if active for arn in arns]
+    desired_counts, describe_calls = _describe_desired_counts(active_arns) if active_arns else ({}, 0)
+
+    # アラームの現在の設定も 1 回でまとめて取得し、変わっていないものは書き込まない
+    alarm_names = [_alarm_details(service_key)[0] for service_key, _, _, _ in plans if service_key in SERVICE_CONTROL_AUTOSTOP_POLICIES]
+    live_fingerprints = _describe_alarm_fingerprints(alarm_names)
+
+    with ThreadPoolExecutor(max_workers=SCHEDULER_CONCURRENCY) as pool:
+        futures = [
+            pool.submit(_reconcile_service, service_key, schedule, active, service_arns, desired_counts, live_fingerprints)
+            for service_key, schedule, active, service_arns in plans
+        ]
+        reports = [future.result() for future in futures]
+    for report in reports:
+        report["prewarm"] = report["service"] in prewarmed
+
+    # 次にいずれかのサービスの稼働状態が変わる時刻（現地時刻）。単発のイベントで起動する場合の目安
+    transitions = [
+        moment
+        for _, schedule, _, _ in plans
+        for moment in service_schedule.next_transitions(schedule, local_now)
+        if moment is not None
+    ]
+
+    result = {
+        "status": "ok",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "durationMs": round((time.monotonic() - tick_started_at) * 1000, 1),
+        "describeServicesCalls": describe_calls,
+        "metricDataCalls": metric_data_calls,
+        "prewarmed": len(prewarmed),
+        "alarmsUpdated": sum(1 for report in reports if report["alarm"] == "updated"),
+        "alarmsUnchanged": sum(1 for report in reports if report["alarm"] == "unchanged"),
+        "started": sum(len(report["started"]) for report in reports),
+        "errors": sum(len(report["errors"]) for report in reports),
+        "nextTransition": min(transitions).isoformat() if transitions else None,
+        "services": reports,
+    }
+    print(result)
+    return result
@@ -0,0 +1,365 @@
+import base64
+import bisect
+import hashlib
+import json
+import math
+import os
+from datetime import date, datetime, timedelta, timezone
+
+# サービス制御 Lambda / スケジューラ共通のスケジュール判定。
+# スケジュールを「稼働区間の一覧」にまとめておき、時刻の判定は二分探索で行う
+TIMEZONE_OFFSET_HOURS = int(os.environ.get("SERVICE_CONTROL_SCHEDULE_TIMEZONE_OFFSET", "9"))
+# 何日先まで区間を展開するか（前日分も含めて展開する）
+TIMELINE_DAYS = max(2, int(os.environ.get("SERVICE_CONTROL_SCHEDULE_TIMELINE_DAYS", "8") or "8"))
+MINUTES_PER_DAY = 24 * 60
+
+DEFAULT_SCHEDULE = {
+    "enabled": False,
+    "start_time": "17:00",
+    "stop_time": "22:00",
+    "weekday_start_time": "17:00",
+    "weekday_stop_time": "22:00",
+    "holiday_start_time": "08:00",
+    "holiday_stop_time": "23:00",
+    "idle_minutes": 60,
+}
+DEFAULT_START_MINUTES = 17 * 60
+DEFAULT_STOP_MINUTES = 22 * 60
+HOLIDAY_CACHE = {}
+# 祝日テーブル（1 日 1 ビット）を同梱する範囲と、そのファイル。範囲外の年は必要になった時に作る
+HOLIDAY_TABLE_FIRST_YEAR = 2007
+HOLIDAY_TABLE_LAST_YEAR = 2060
+HOLIDAY_TABLE_VERSION = 1
+HOLIDAY_TABLE_FILE = os.environ.get("SERVICE_CONTROL_HOLIDAY_TABLE_FILE") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "japan_holidays.json"
+)
+# 法律で個別に定められた祝日。移動した祝日は移動先を add、本来の日を remove に入れる
+SPECIAL_HOLIDAYS = {
+    # 即位の日・即位礼正殿の儀（2019）、東京オリンピック・パラリンピックに伴う移動（2020・2021）
+    "add": [
+        "2019-05-01",
+        "2019-10-22",
+        "2020-07-23",
+        "2020-07-24",
+        "2020-08-10",
+        "2021-07-22",
+        "2021-07-23",
+        "2021-08-08",
+    ],
+    "remove": [
+        "2020-07-20",
+        "2020-08-11",
+        "2020-10-12",
+        "2021-07-19",
+        "2021-08-11",
+        "2021-10-11",
+    ],
+}
+_BIT_DIGITS = bytes.maketrans(b"\x00\x01", b"01")
+# タイムラインに影響するスケジュールの項目
+TIMELINE_KEYS = (
+    "enabled",
+    "start_time",
+    "stop_time",
+    "weekday_start_time",
+    "weekday_stop_time",
+    "holiday_start_time",
+    "holiday_stop_time",
+)
+# スケジュールの項目 -> タイムライン。ウォームコンテナの間だけ保持する
+_timelines = {}
+
+
+def _nth_weekday(year, month, weekday, nth):
+    first = date(year, month, 1)
+    offset = (weekday - first.weekday() + 7) % 7
+    return first + timedelta(days=offset + 7 * (nth - 1))
+
+
+def _japan_equinox(year, spring=True):
+    base = 20.8431 if spring else 23.2488
+    day = math.floor(base + 0.242194 * (year - 1980) - math.floor((year - 1980) / 4))
+    month = 3 if spring else 9
+    return date(year, month, day)
+
+
+def _base_japan_holidays(year):
+    holidays = {
+        date(year, 1, 1),
+        date(year, 2, 11),
+        _japan_equinox(year, True),
+        date(year, 4, 29),
+        date(year, 5, 3),
+        date(year, 5, 4),
+        date(year, 5, 5),
+        _japan_equinox(year, False),
+        date(year, 11, 3),
+        date(year, 11, 23),
+    }
+    holidays.add(_nth_weekday(year, 1, 0, 2) if year >= 2000 else date(year, 1, 15))
+    if year >= 2020:
+        holidays.add(date(year, 2, 23))
+    elif 1989 <= year <= 2018:
+        holidays.add(date(year, 12, 23))
+    if year >= 2003:
+        holidays.add(_nth_weekday(year, 7, 0, 3))
+    elif year >= 1996:
+        holidays.add(date(year, 7, 20))
+    if year >= 2016:
+        holidays.add(date(year, 8, 11))
+    if year >= 2003:
+        holidays.add(_nth_weekday(year, 9, 0, 3))
+    elif year >= 1966:
+        holidays.add(date(year, 9, 15))
+    holidays.add(_nth_weekday(year, 10, 0, 2) if year >= 2000 else date(year, 10, 10))
+    return holidays
+
+
+def _load_holiday_overrides():
+    # 政府が個別に定める祝日の追加・移動。SERVICE_CONTROL_HOLIDAY_OVERRIDES={"add": [...], "remove": [...]} を組み込み分に足す
+    overrides = {key: list(dates) for key, dates in SPECIAL_HOLIDAYS.items()}
+    raw = os.environ.get("SERVICE_CONTROL_HOLIDAY_OVERRIDES", "").strip()
+    if raw:
+        try:
+            extra = json.loads(raw)
+        except json.JSONDecodeError:
+            extra = {}
+        for key in ("add", "remove"):
+            for text in extra.get(key) or []:
+                try:
+                    overrides[key].append(date.fromisoformat(str(text)).isoformat())
+                except ValueError:
+                    continue
+    return {key: sorted(set(dates)) for key, dates in overrides.items()}
+
+
+def _holiday_table_fingerprint(first_year, last_year, overrides):
+    # 規則・対象期間・上書きのどれかが変わったら同梱ファイルを使わない
+    spec = json.dumps(
+        [HOLIDAY_TABLE_VERSION, first_year, last_year, overrides], sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(spec.encode("utf-8")).hexdigest()
+
+
+def _day_bits(flags):
+    # 1 日 1 バイトのフラグ列 -> 1 日 1 ビットの整数（最下位ビットが初日）
+    return int(bytes(flags).translate(_BIT_DIGITS)[::-1] or b"0", 2)
+
+
+def build_holiday_table(first_year, last_year, overrides=None):
+    # first_year..last_year の休日（祝日・振替休日・国民の休日。土日は含まない）を 1 日 1 ビットで返す。
+    # 祝日だけを年ごとに並べ、振替休日と国民の休日は期間全体の整数ビット演算でまとめて求める
+    origin = date(first_year, 1, 1).toordinal()
+    days = date(last_year, 12, 31).toordinal() - origin + 1
+    national = bytearray(days)
+    for year in range(first_year, last_year + 1):
+        for holiday in _base_japan_holidays(year):
+            national[holiday.toordinal() - origin] = 1
+    for key, flag in (("add", 1), ("remove", 0)):
+        for text in (overrides or {}).get(key) or []:
+            index = date.fromisoformat(text).toordinal() - origin
+            if 0 <= index < days:
+                national[index] = flag
+    sundays = bytearray(days)
+    first_sunday = (6 - date(first_year, 1, 1).weekday()) % 7
+    sundays[first_sunday::7] = b"\x01" * len(range(first_sunday, days, 7))
+
+    national_bits = _day_bits(national)
+    # 振替休日: 日曜の祝日の後で最初の祝日でない日（連休中は次の日へ送る）
+    substitutes = 0
+    carry = (national_bits & _day_bits(sundays)) << 1
+    while carry:
+        substitutes |= carry & ~national_bits
+        carry = (carry & national_bits) << 1
+    # 国民の休日: 前日と翌日が祝日の日（振替休日は数えない）
+    bridges = (national_bits << 1) & (national_bits >> 1) & ~national_bits
+    holidays = (national_bits | substitutes | bridges) & ((1 << days) - 1)
+    return holidays.to_bytes((days + 7) // 8, "little")
+
+
+def _load_holiday_table():
+    # 同梱の祝日テーブルを読み込む。無い・規則や上書きが変わった場合はその場で作る
+    overrides = _load_holiday_overrides()
+    fingerprint = _holiday_table_fingerprint(HOLIDAY_TABLE_FIRST_YEAR, HOLIDAY_TABLE_LAST_YEAR, overrides)
+    try:
+        with open(HOLIDAY_TABLE_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("fingerprint") == fingerprint:
+            return base64.b64decode(data["bitmap"]), overrides, "file"
+    except (OSError, ValueError, KeyError):
+        pass
+    return build_holiday_table(HOLIDAY_TABLE_FIRST_YEAR, HOLIDAY_TABLE_LAST_YEAR, overrides), overrides, "built"
+
+
+def write_holiday_table(path=None):
+    # 同梱用の祝日テーブルを書き出す（python3 service_schedule.py）
+    overrides = _load_holiday_overrides()
+    bitmap = build_holiday_table(HOLIDAY_TABLE_FIRST_YEAR, HOLIDAY_TABLE_LAST_YEAR, overrides)
+    data = {
+        "version": HOLIDAY_TABLE_VERSION,
+        "firstYear": HOLIDAY_TABLE_FIRST_YEAR,
+        "lastYear": HOLIDAY_TABLE_LAST_YEAR,
+        "fingerprint": _holiday_table_fingerprint(HOLIDAY_TABLE_FIRST_YEAR, HOLIDAY_TABLE_LAST_YEAR, overrides),
+        "bitmap": base64.b64encode(bitmap).decode("ascii"),
+    }
+    with open(path or HOLIDAY_TABLE_FILE, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+        f.write("\n")
+
+
+HOLIDAY_BITMAP, HOLIDAY_OVERRIDES, HOLIDAY_TABLE_SOURCE = _load_holiday_table()
+HOLIDAY_ORIGIN = date(HOLIDAY_TABLE_FIRST_YEAR, 1, 1).toordinal()
+HOLIDAY_DAYS = date(HOLIDAY_TABLE_LAST_YEAR, 12, 31).toordinal() - HOLIDAY_ORIGIN + 1
+
+
+def japan_holidays(year):
+    if year in HOLIDAY_CACHE:
+        return HOLIDAY_CACHE[year]
+    if HOLIDAY_TABLE_FIRST_YEAR <= year <= HOLIDAY_TABLE_LAST_YEAR:
+        bitmap = HOLIDAY_BITMAP
+        offset = date(year, 1, 1).toordinal() - HOLIDAY_ORIGIN
+    else:
+        # テーブルの範囲外の年はその年だけ作る
+        bitmap = build_holiday_table(year, year, HOLIDAY_OVERRIDES)
+        offset = 0
+    first = date(year, 1, 1).toordinal()
+    days = date(year, 12, 31).toordinal() - first + 1
+    holidays = {
+        date.fromordinal(first + i)
+        for i in range(days)
+        if bitmap[(offset + i) >> 3] >> ((offset + i) & 7) & 1
+    }
+    HOLIDAY_CACHE[year] = holidays
+    return holidays
+
+
+def is_off_day(local_date):
+    if local_date.weekday() >= 5:
+        return True
+    index = local_date.toordinal() - HOLIDAY_ORIGIN
+    if 0 <= index < HOLIDAY_DAYS:
+        return bool(HOLIDAY_BITMAP[index >> 3] >> (index & 7) & 1)
+    return local_date in japan_holidays(local_date.year)
+
+
+def parse_time(value, fallback):
+    try:
+        parts = value.split(":")
+        if len(parts) != 2:
+            raise ValueError
+        hours = int(parts[0])
+        minutes = int(parts[1])
+        return hours * 60 + minutes
+    except Exception:
+        return fallback
+
+
+def local_now():
+    return datetime.now(timezone.utc) + timedelta(hours=TIMEZONE_OFFSET_HOURS)
+
+
+def time_window(schedule, local_date):
+    base_start_raw = schedule.get("start_time", DEFAULT_SCHEDULE["start_time"])
+    base_stop_raw = schedule.get("stop_time", DEFAULT_SCHEDULE["stop_time"])
+    base_start = parse_time(base_start_raw, DEFAULT_START_MINUTES)
+    base_stop = parse_time(base_stop_raw, DEFAULT_STOP_MINUTES)
+    if is_off_day(local_date):
+        start_raw = schedule.get("holiday_start_time") or base_start_raw
+        stop_raw = schedule.get("holiday_stop_time") or base_stop_raw
+    else:
+        start_raw = schedule.get("weekday_start_time") or base_start_raw
+        stop_raw = schedule.get("weekday_stop_time") or base_stop_raw
+    start = parse_time(start_raw, base_start)
+    stop = parse_time(stop_raw, base_stop)
+    return start, stop
+
+
+def _minute_index(local_dt):
+    return local_dt.date().toordinal() * MINUTES_PER_DAY + local_dt.hour * 60 + local_dt.minute
+
+
+def _from_minute_index(index):
+    day, minute = divmod(index, MINUTES_PER_DAY)
+    return datetime.combine(date.fromordinal(day), datetime.min.time()) + timedelta(minutes=minute)
+
+
+def compile_timeline(schedule, first_date, days=TIMELINE_DAYS):
+    # first_date から days 日分の稼働区間を (開始, 終了) の分インデックスで返す（隣接する区間は結合）。
+    # 各日の判定はその日の平日 / 休日の時間帯だけで行う（日をまたぐ設定は 0 時から stop まで、start から 24 時まで）
+    starts = []
+    ends = []
+    if schedule and schedule.get("enabled"):
+        for offset in range(days):
+            local_date = first_date + timedelta(days=offset)
+            base = local_date.toordinal() * MINUTES_PER_DAY
+            start, stop = time_window(schedule, local_date)
+            if start <= stop:
+                spans = [(start, stop)]
+            else:
+                spans = [(0, stop), (start, MINUTES_PER_DAY)]
+            for span_start, span_stop in spans:
+                span_start = base + max(0, span_start)
+                span_stop = base + min(MINUTES_PER_DAY, span_stop)
+                if span_start >= span_stop:
+                    continue
+                if ends and ends[-1] >= span_start:
+                    ends[-1] = max(ends[-1], span_stop)
+                else:
+                    starts.append(span_start)
+                    ends.append(span_stop)
+    return {
+        "from": first_date.toordinal() * MINUTES_PER_DAY,
+        "until": (first_date.toordinal() + days) * MINUTES_PER_DAY,
+        "starts": starts,
+        "ends": ends,
+    }
+
+
+def timeline(schedule, local_dt):
+    # local_dt の前日から TIMELINE_DAYS 日分。範囲を外れたら作り直す
+    key = tuple((schedule or {}).get(name) for name in TIMELINE_KEYS)
+    try:
+        hash(key)
+    except TypeError:
+        key = json.dumps(key, sort_keys=True, default=str)
+    index = _minute_index(local_dt)
+    cached = _timelines.get(key)
+    if cached is None or not cached["from"] + MINUTES_PER_DAY <= index < cached["until"] - MINUTES_PER_DAY:
+        cached = compile_timeline(schedule, local_dt.date() - timedelta(days=1))
+        if len(_timelines) >= 256:
+            _timelines.clear()
+        _timelines[key] = cached
+    return cached
+
+
+def is_active(schedule, local_dt):
+    compiled = timeline(schedule, local_dt)
+    index = _minute_index(local_dt)
+    i = bisect.bisect_right(compiled["starts"], index) - 1
+    return i >= 0 and index < compiled["ends"][i]
+
+
+def next_transitions(schedule, local_dt):
+    # (次の開始, 次の停止) を現地時刻の datetime で返す。展開した範囲に無ければ None
+    compiled = timeline(schedule, local_dt)
+    starts = compiled["starts"]
+    ends = compiled["ends"]
+    index = _minute_index(local_dt)
+    i = bisect.bisect_right(starts, index) - 1
+    if i >= 0 and index < ends[i]:
+        next_start = starts[i + 1] if i + 1 < len(starts) else None
+        next_stop = ends[i]
+    else:
+        next_start = starts[i + 1] if i + 1 < len(starts) else None
+        next_stop = ends[i + 1] if i + 1 < len(ends) else None
+    # 展開範囲の終端で切れている区間の終了時刻は確定していない
+    if next_stop is not None and next_stop >= compiled["until"]:
+        next_stop = None
+    return (
+        _from_minute_index(next_start) if next_start is not None else None,
+        _from_minute_index(next_stop) if next_stop is not None else None,
+    )
+
+
+if __name__ == "__main__":
+    write_holiday_table()
@@ -0,0 +1,54 @@
+import os
+import threading
+import time
+
+# サービス制御 Lambda / スケジューラ共通の SSM パラメータキャッシュ。
+# ウォームコンテナの間だけ値を保持し、未取得の名前は GetParameters でまとめて取得する
+SSM_CACHE_TTL_SECONDS = int(os.environ.get("SSM_CACHE_TTL_SECONDS", "60") or "60")
+# GetParameters の 1 回あたりの上限
+GET_PARAMETERS_BATCH = 10
+
+# name -> (value, 有効期限の time.monotonic())。存在しないパラメータは value=None で覚える
+_entries = {}
+_lock = threading.Lock()
+
+
+def get_many(client, names, fresh=False):
+    # {name: value}。存在しないパラメータは None
+    # fresh=True はキャッシュを使わずに取得し直す（取得した値でキャッシュは更新する）
+    now = time.monotonic()
+    result = {}
+    missing = []
+    with _lock:
+        for name in dict.fromkeys(names):
+            entry = None if fresh else _entries.get(name)
+            if entry is not None and now < entry[1]:
+                result[name] = entry[0]
+            else:
+                missing.append(name)
+    for i in range(0, len(missing), GET_PARAMETERS_BATCH):
+        chunk = missing[i : i + GET_PARAMETERS_BATCH]
+        resp = client.get_parameters(Names=chunk, WithDecryption=True)
+        fetched = {param["Name"]: param.get("Value") for param in resp.get("Parameters", [])}
+        expires_at = time.monotonic() + SSM_CACHE_TTL_SECONDS
+        with _lock:
+            for name in chunk:
+                _entries[name] = (fetched.get(name), expires_at)
+                result[name] = fetched.get(name)
+    return result
+
+
+def get(client, name, fresh=False):
+    if not name:
+        return None
+    return get_many(client, [name], fresh=fresh).get(name)
+
+
+def put(client, name, value, **kwargs):
+    # 書き込んだ値でキャッシュも更新し、同じコンテナ内の次の読み込みで古い値を返さないようにする。
+    # 他のウォームコンテナ（別の API Lambda / スケジューラ）のキャッシュは消せないため、
+    # そちらでは最大 SSM_CACHE_TTL_SECONDS の間、書き込み前の値が読まれる
+    client.put_parameter(Name=name, Value=value, Overwrite=True, **kwargs)
+    with _lock:
+        _entries[name] = (value, time.monotonic() + SSM_CACHE_TTL_SECONDS)
+
@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+import tracemalloc
+
+import pytest
+
+# Lambda テンプレート（modules/stack/templates）は Lambda 上と同じくフラットなモジュールとして import する
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "modules", "stack", "templates")
+sys.path.insert(0, TEMPLATES_DIR)
+
+# import 時に boto3 クライアントを作るテンプレートのため。API は呼ばない（クライアントはテスト側で差し替える）
+os.environ.setdefault("AWS_DEFAULT_REGION", "ap-northeast-1")
+
+
+# ベンチマークは BENCHMARK=1 のときだけ実行する（pytest -s で結果を表示）。データ量は BENCHMARK_SCALE 倍にする
+BENCHMARK = os.environ.get("BENCHMARK", "").strip().lower() in ("1", "true", "yes")
+BENCHMARK_SCALE = float(os.environ.get("BENCHMARK_SCALE", "1") or "1")
+BENCHMARK_REPEAT = 3
+
+
+class _Benchmark:
+    scale = BENCHMARK_SCALE
+
+    def rate(self, name, fn, units, unit="records"):
+        # BENCHMARK_REPEAT 回のうち最速の 1 回から、1 秒あたりの処理量を求める
+        best = None
+        for _ in range(BENCHMARK_REPEAT):
+            started_at = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - started_at
+            best = elapsed if best is None else min(best, elapsed)
+        per_second = units / best
+        print({"benchmark": name, unit: units, "seconds": round(best, 4), f"{unit}PerSecond": round(per_second, 1)})
+        return per_second
+
+    def peak_bytes(self, name, fn):
+        # fn の実行中に増えた Python のメモリ確保量の最大値
+        tracemalloc.start()
+        try:
+            fn()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        print({"benchmark": name, "peakMiB": round(peak / 1048576, 2)})
+        return peak
+
+
+@pytest.fixture
+def benchmark():
+    if not BENCHMARK:
+        pytest.skip("set BENCHMARK=1 to run benchmarks")
+    return _Benchmark()
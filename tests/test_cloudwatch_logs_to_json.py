@@ -0,0 +1,187 @@
+import base64
+import gzip
+import io
+import json
+import os
+import random
+
+import pytest
+
+pytest.importorskip("boto3")
+
+import cloudwatch_logs_to_json_lambda as transformer  # noqa: E402
+
+
+def _reference_handler(event):
+    # 変更前（GzipFile + イベントごとの json.dumps と join）の実装。出力がバイト単位で一致することの基準
+    output = []
+    for record in event.get("records", []):
+        try:
+            raw = base64.b64decode(record["data"])
+            try:
+                raw = gzip.GzipFile(fileobj=io.BytesIO(raw)).read()
+            except OSError:
+                pass
+            payload = json.loads(raw.decode("utf-8"))
+            lines = [
+                json.dumps(
+                    {
+                        "timestamp": item.get("timestamp"),
+                        "message": item.get("message"),
+                        "log_group": payload.get("logGroup"),
+                        "log_stream": payload.get("logStream"),
+                    }
+                )
+                for item in payload.get("logEvents") or []
+            ]
+            data = ("\n".join(lines) + "\n") if lines else ""
+            result = "Ok"
+        except Exception:
+            data = ""
+            result = "ProcessingFailed"
+        output.append({"recordId": record["recordId"], "result": result, "data": base64.b64encode(data.encode("utf-8")).decode("utf-8")})
+    return {"records": output}
+
+
+def _payload(messages, log_group="/aws/ecs/sulu/app", log_stream="ecs/app/0123"):
+    return {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": log_group,
+        "logStream": log_stream,
+        "subscriptionFilters": ["to-firehose"],
+        "logEvents": [{"id": str(i), "timestamp": 1720000000000 + i, "message": message} for i, message in enumerate(messages)],
+    }
+
+
+def _record(record_id, payload, compress=True, members=1):
+    raw = json.dumps(payload).encode("utf-8")
+    if compress:
+        # CloudWatch Logs は連結された gzip メンバーを送ることがある
+        size = -(-len(raw) // members)
+        raw = b"".join(gzip.compress(raw[i : i + size]) for i in range(0, len(raw), size))
+    return {"recordId": record_id, "data": base64.b64encode(raw).decode("ascii")}
+
+
+MESSAGES = [
+    "plain ascii",
+    "日本語のメッセージ",
+    'quotes " and \\ backslashes',
+    "control \x00\x01\x1f and DEL \x7f",
+    "tab\tnewline\ncarriage\r",
+    "emoji \U0001f600 and lone surrogate-free text",
+    "",
+    None,
+]
+
+
+@pytest.mark.parametrize(
+    "records",
+    [
+        [_record("1", _payload(MESSAGES))],
+        [_record("1", _payload(MESSAGES), members=3), _record("2", _payload(["x" * 5000] * 20, log_group="ロググループ"))],
+        [_record("1", _payload(MESSAGES), compress=False)],
+        [_record("1", _payload([]))],
+        [{"recordId": "bad", "data": base64.b64encode(b"not json").decode("ascii")}, _record("2", _payload(MESSAGES))],
+        [{"recordId": "truncated", "data": base64.b64encode(gzip.compress(b'{"logEvents": [')[:-4]).decode("ascii")}],
+    ],
+)
+def test_output_is_byte_identical_to_reference(records):
+    event = {"records": records}
+    assert transformer.handler(event, None) == _reference_handler(event)
+
+
+class _FakeFirehose:
+    # failing に含まれるデータは常に失敗として返す PutRecordBatch の代わり
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.calls = []
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.calls.append([item["Data"] for item in Records])
+        results = [{"ErrorCode": "ServiceUnavailableException"} if item["Data"] in self.failing else {"RecordId": "x"} for item in Records]
+        return {"FailedPutCount": sum(1 for item in results if "ErrorCode" in item), "RequestResponses": results}
+
+
+def _random_messages(count, size):
+    return [os.urandom(size // 2).hex() for _ in range(count)]
+
+
+def _events_of(data):
+    return json.loads(gzip.decompress(data))["logEvents"]
+
+
+@pytest.fixture
+def firehose(monkeypatch):
+    fake = _FakeFirehose()
+    monkeypatch.setattr(transformer, "firehose", fake)
+    monkeypatch.setattr(transformer.time, "sleep", lambda seconds: None)
+    # 小さな上限で、レスポンス上限と再投入の 1 レコード上限の両方を超えさせる
+    monkeypatch.setattr(transformer, "RESPONSE_SIZE_LIMIT", 200_000)
+    monkeypatch.setattr(transformer, "REINGEST_MAX_RECORD_BYTES", 30_000)
+    return fake
+
+
+def _event(records):
+    return {"deliveryStreamArn": "arn:aws:firehose:ap-northeast-1:123456789012:deliverystream/logs", "records": records}
+
+
+def test_oversized_record_is_split_under_the_per_record_limit(firehose):
+    payload = _payload(_random_messages(60, 4000))
+    resp = transformer.handler(_event([_record("big", payload)]), None)
+    assert resp["records"][0]["result"] == "Dropped"
+    parts = [data for call in firehose.calls for data in call]
+    assert len(parts) > 2
+    assert all(len(data) <= transformer.REINGEST_MAX_RECORD_BYTES for data in parts)
+    assert [event for data in parts for event in _events_of(data)] == payload["logEvents"]
+
+
+def test_single_event_over_the_per_record_limit_fails_only_that_record(firehose):
+    records = [_record("ok", _payload(["small"])), _record("huge", _payload(_random_messages(1, 200_000)))]
+    resp = transformer.handler(_event(records), None)
+    assert [item["result"] for item in resp["records"]] == ["Ok", "ProcessingFailed"]
+    assert firehose.calls == []
+
+
+def test_partial_reingest_failure_is_reported_per_record(firehose):
+    # 3 件目以降はレスポンス上限を超えて再投入される
+    records = [_record(str(i), _payload(_random_messages(10, 4000))) for i in range(6)]
+    failing = base64.b64decode(records[4]["data"])
+    firehose.failing.add(failing)
+    resp = transformer.handler(_event(records), None)
+    results = [item["result"] for item in resp["records"]]
+    assert results[4] == "ProcessingFailed"
+    assert "Dropped" in results and results.count("ProcessingFailed") == 1
+    # 成功したデータは 1 回だけ送り、失敗したデータだけを上限回数まで再試行する
+    sent = [data for call in firehose.calls for data in call]
+    assert sent.count(failing) == transformer.REINGEST_MAX_ATTEMPTS
+    assert all(sent.count(data) == 1 for data in sent if data != failing)
+
+
+def _firehose_batch(records, events_per_record, seed=0):
+    # CloudWatch Logs サブスクリプションから届く Firehose のバッチ（アプリのログらしい長さのばらつき）
+    rng = random.Random(seed)
+    batch = []
+    for n in range(records):
+        messages = [
+            json.dumps({"level": rng.choice(["INFO", "WARN", "ERROR"]), "msg": "request handled " + "x" * rng.randrange(20, 400), "latency_ms": rng.random() * 100})
+            if rng.random() < 0.7
+            else "GET /api/items/%d 200 %.3f 日本語" % (rng.randrange(100000), rng.random())
+            for _ in range(events_per_record)
+        ]
+        batch.append(_record(str(n), _payload(messages, log_stream=f"ecs/app/{n % 8}")))
+    return {"records": batch}
+
+
+def test_benchmark_firehose_batch(benchmark):
+    # 出力が 6 MB のレスポンス上限に収まる大きさのバッチで、元の実装と比べる
+    event = _firehose_batch(int(200 * benchmark.scale), 60)
+    assert transformer.handler(event, None) == _reference_handler(event)
+    records = len(event["records"])
+    before = benchmark.rate("firehose transform reference", lambda: _reference_handler(event), records)
+    after = benchmark.rate("firehose transform", lambda: transformer.handler(event, None), records)
+    before_peak = benchmark.peak_bytes("firehose transform reference", lambda: _reference_handler(event))
+    after_peak = benchmark.peak_bytes("firehose transform", lambda: transformer.handler(event, None))
+    # ピークの大半はレスポンス（base64）そのもの
+    assert after_peak <= before_peak
+    assert after > before
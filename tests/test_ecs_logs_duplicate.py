@@ -0,0 +1,405 @@
+import base64
+import gzip
+import json
+import random
+import threading
+import time
+import types
+
+import pytest
+
+pytest.importorskip("boto3")
+
+from botocore.exceptions import ClientError  # noqa: E402
+
+import ecs_logs_duplicate_lambda as duplicator  # noqa: E402
+
+HOUR_MS = 60 * 60 * 1000
+
+
+def _event_bytes(event):
+    return len(event["message"].encode("utf-8")) + duplicator.EVENT_OVERHEAD_BYTES
+
+
+def _random_events(rng):
+    # 件数・メッセージ長（マルチバイト文字を含む）・時刻の広がりを毎回変える
+    count = rng.choice([0, 1, 5, 500, 9999, 10000, 10001, 15000])
+    max_message = rng.choice([0, 10, 200, 5000, 262144])
+    span_ms = rng.choice([0, 1000, 23 * HOUR_MS, 24 * HOUR_MS, 72 * HOUR_MS])
+    alphabet = rng.choice(["a", "aあ", "🙂x"])
+    start = 1_720_000_000_000
+    events = []
+    for i in range(count):
+        length = rng.randint(0, max_message) if max_message and rng.random() < 0.05 else rng.randint(0, min(max_message, 80))
+        events.append(
+            {
+                "id": str(i),
+                "timestamp": start + (rng.randint(0, span_ms) if span_ms else 0),
+                "message": "".join(rng.choice(alphabet) for _ in range(min(length, 64))) * max(1, length // 64),
+            }
+        )
+    return events
+
+
+def _check_batches(events, batches):
+    # 上限を守る / 時刻順にすべてのイベントを 1 回ずつ送る / 次のイベントが入る余地があればバッチを切らない
+    flattened = [event for batch in batches for event in batch]
+    expected = sorted(events, key=lambda e: e["timestamp"])
+    assert [(e["timestamp"], e["message"]) for e in flattened] == [(e["timestamp"], e["message"]) for e in expected]
+    for i, batch in enumerate(batches):
+        assert 0 < len(batch) <= duplicator.MAX_EVENTS_PER_BATCH
+        assert sum(_event_bytes(event) for event in batch) <= duplicator.MAX_BATCH_BYTES
+        assert batch[-1]["timestamp"] - batch[0]["timestamp"] <= duplicator.MAX_BATCH_SPAN_MS
+        if i + 1 < len(batches):
+            following = batches[i + 1][0]
+            assert (
+                len(batch) + 1 > duplicator.MAX_EVENTS_PER_BATCH
+                or sum(_event_bytes(event) for event in batch) + _event_bytes(following) > duplicator.MAX_BATCH_BYTES
+                or following["timestamp"] - batch[0]["timestamp"] > duplicator.MAX_BATCH_SPAN_MS
+            )
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_batches_respect_put_log_events_limits(seed):
+    events = _random_events(random.Random(seed))
+    _check_batches(events, list(duplicator._batches(events)))
+
+
+def test_batches_split_at_10000_events():
+    events = [{"timestamp": 1, "message": "x"} for _ in range(20001)]
+    assert [len(batch) for batch in duplicator._batches(events)] == [10000, 10000, 1]
+
+
+def test_batches_count_26_bytes_per_event_and_utf8_length():
+    # 1 イベント 1,024 バイト（メッセージ 998 バイト + 26）なら 1 MiB にちょうど 1,024 件
+    events = [{"timestamp": 1, "message": "x" * 998} for _ in range(2049)]
+    assert [len(batch) for batch in duplicator._batches(events)] == [1024, 1024, 1]
+    # 3 バイト文字はバイト数で数える
+    events = [{"timestamp": 1, "message": "あ" * 1000} for _ in range(400)]
+    assert [len(batch) for batch in duplicator._batches(events)] == [346, 54]
+
+
+def test_batches_split_when_span_exceeds_24_hours():
+    day = duplicator.MAX_BATCH_SPAN_MS
+    events = [{"timestamp": t, "message": "x"} for t in (0, day, day + 1, 2 * day + 1, 2 * day + 2)]
+    assert [[e["timestamp"] for e in batch] for batch in duplicator._batches(events)] == [[0, day], [day + 1, 2 * day + 1], [2 * day + 2]]
+
+
+class _ResourceAlreadyExists(ClientError):
+    pass
+
+
+class _ResourceNotFound(ClientError):
+    pass
+
+
+class _FakeLogs:
+    # put_log_events の呼び出しを記録する CloudWatch Logs の代わり。throttle 回数だけ ThrottlingException を返す
+    exceptions = types.SimpleNamespace(
+        ResourceAlreadyExistsException=_ResourceAlreadyExists,
+        ResourceNotFoundException=_ResourceNotFound,
+    )
+
+    def __init__(self, throttle=0):
+        self.throttle = throttle
+        self.puts = []
+        self.created = []
+        # 作成時に返すエラーコード（名前 -> コード）と、削除されたロググループ
+        self.create_errors = {}
+        self.deleted = set()
+
+    def _create(self, operation, name, kwargs):
+        self.created.append((operation, *kwargs.values()))
+        code = self.create_errors.get(name)
+        if code:
+            raise ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+    def create_log_group(self, **kwargs):
+        self._create("CreateLogGroup", kwargs["logGroupName"], kwargs)
+        self.deleted.discard(kwargs["logGroupName"])
+
+    def create_log_stream(self, **kwargs):
+        self._create("CreateLogStream", kwargs["logStreamName"], kwargs)
+
+    def put_log_events(self, **kwargs):
+        if kwargs["logGroupName"] in self.deleted:
+            raise _ResourceNotFound({"Error": {"Code": "ResourceNotFoundException", "Message": "gone"}}, "PutLogEvents")
+        if self.throttle:
+            self.throttle -= 1
+            raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, "PutLogEvents")
+        self.puts.append(kwargs)
+        return {}
+
+
+@pytest.fixture
+def fake_logs(monkeypatch):
+    fake = _FakeLogs()
+    monkeypatch.setattr(duplicator, "logs", fake)
+    monkeypatch.setattr(duplicator, "_known_log_groups", {})
+    monkeypatch.setattr(duplicator, "_known_log_streams", {})
+    return fake
+
+
+def _put_kwargs(count=3):
+    return {"logGroupName": "/aws/ecs/r/p-svc", "logStreamName": "s", "logEvents": [{"timestamp": 1, "message": "x"}] * count}
+
+
+def test_put_retries_throttling_until_success(monkeypatch, fake_logs):
+    sleeps = []
+    monkeypatch.setattr(duplicator.time, "sleep", sleeps.append)
+    fake_logs.throttle = 2
+    stats = duplicator._new_stats()
+    duplicator._put_with_retry(_put_kwargs(), stats, deadline=time.monotonic() + 60)
+    assert len(fake_logs.puts) == 1 and stats["retries"] == 2 and len(sleeps) == 2
+
+
+def test_put_gives_up_when_the_deadline_cannot_cover_a_retry(monkeypatch, fake_logs):
+    sleeps = []
+    monkeypatch.setattr(duplicator.time, "sleep", sleeps.append)
+    fake_logs.throttle = 10
+    stats = duplicator._new_stats()
+    deadline = time.monotonic() + duplicator.PUT_CALL_RESERVE_SECONDS / 2
+    assert duplicator._put_with_retry(_put_kwargs(3), stats, deadline) is None
+    assert sleeps == [] and stats["droppedEvents"] == 3 and stats["retries"] == 0
+
+
+def test_put_raises_after_max_attempts_without_deadline(monkeypatch, fake_logs):
+    monkeypatch.setattr(duplicator.time, "sleep", lambda seconds: None)
+    fake_logs.throttle = duplicator.PUT_MAX_ATTEMPTS
+    with pytest.raises(ClientError):
+        duplicator._put_with_retry(_put_kwargs(), duplicator._new_stats())
+
+
+class _Context:
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+def _awslogs_event(events, log_group="/aws/ecs/sulu/p-sulu/app", log_stream="ecs/app/0123"):
+    payload = {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": log_group,
+        "logStream": log_stream,
+        "subscriptionFilters": ["duplicate"],
+        "logEvents": events,
+    }
+    return {"awslogs": {"data": base64.b64encode(gzip.compress(json.dumps(payload).encode("utf-8"))).decode("ascii")}}
+
+
+def _log_events(count, size=10, start=1_720_000_000_000):
+    return [{"id": str(i), "timestamp": start + i, "message": "m" * size} for i in range(count)]
+
+
+def test_handler_drops_batches_instead_of_timing_out(monkeypatch, fake_logs):
+    monkeypatch.setattr(duplicator.time, "sleep", lambda seconds: None)
+    fake_logs.throttle = 100
+    resp = duplicator.handler(_awslogs_event(_log_events(5)), _Context(1000))
+    assert resp["ok"] and resp["droppedEvents"] == 5 and resp["retries"] == 0
+
+
+@pytest.mark.parametrize(
+    "target",
+    ["/aws/ecs/{realm}/{service}/{container}", "/aws/ecs/{realm!s}/{service:}/{container}"],
+)
+def test_routes_reject_the_source_log_group_template(target):
+    with pytest.raises(ValueError, match="source log group"):
+        duplicator._compile_routes([{"name": "loop", "target_log_group": target}])
+
+
+def test_handler_skips_destinations_equal_to_the_source_log_group(monkeypatch, fake_logs):
+    source = "/aws/ecs/sulu/p-sulu/app"
+    routes = duplicator._compile_routes(
+        [{"name": "service"}, {"name": "literal", "target_log_group": source}],
+    )
+    monkeypatch.setattr(duplicator, "_routes_by_realm", routes[0])
+    monkeypatch.setattr(duplicator, "_matchers", routes[1])
+    resp = duplicator.handler(_awslogs_event(_log_events(4), log_group=source), None)
+    assert resp["loopSkippedEvents"] == 4
+    assert resp["targetGroups"] == ["/aws/ecs/sulu/p-sulu"]
+    assert {put["logGroupName"] for put in fake_logs.puts} == {"/aws/ecs/sulu/p-sulu"}
+
+
+@pytest.mark.parametrize("count, size", [(30000, 10), (20000, 60), (5000, 1000), (12345, 333)])
+def test_handler_sends_the_minimum_number_of_batches(monkeypatch, fake_logs, count, size):
+    # ルーティングのチャンクごとに送っても、まとめて詰めた場合と同じ回数で送る
+    monkeypatch.setattr(duplicator, "STREAM_DECODE_MIN_BYTES", 1)
+    events = _log_events(count, size)
+    resp = duplicator.handler(_awslogs_event(events), None)
+    expected = list(duplicator._batches(events))
+    assert len(fake_logs.puts) == len(expected)
+    assert sorted(len(put["logEvents"]) for put in fake_logs.puts) == sorted(len(batch) for batch in expected)
+    assert resp["events"] == count and resp["droppedEvents"] == 0
+
+
+def test_sender_sends_complete_batches_before_close(fake_logs):
+    sender = duplicator._Sender()
+    key = ("/aws/ecs/sulu/p-sulu", "s")
+    for chunk in duplicator._chunked(_log_events(25000), 1000):
+        sender.add({key: chunk})
+    # 2 バッチ分は送信を始めていて、残りの 5,000 件は close() まで持ち越す
+    assert len(sender._pending[key]) == 5000
+    sender.close()
+    assert [len(put["logEvents"]) for put in fake_logs.puts] == [10000, 10000, 5000]
+
+
+class _Clock:
+    # time.monotonic / time.sleep の代わり。sleep した分だけ進む
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = _Clock()
+    monkeypatch.setattr(duplicator, "time", fake)
+    return fake
+
+
+GROUP = "/aws/ecs/sulu/p-sulu"
+
+
+def test_known_log_group_and_stream_are_cached_until_ttl(fake_logs, clock):
+    stats = duplicator._new_stats()
+    assert duplicator._ensure_log_group(GROUP, stats) and duplicator._ensure_log_stream(GROUP, "s", stats)
+    assert duplicator._ensure_log_group(GROUP, stats) and duplicator._ensure_log_stream(GROUP, "s", stats)
+    assert len(fake_logs.created) == 2
+    assert stats["controlPlaneCalls"] == 2 and stats["apiCallsAvoided"] == 2
+
+    clock.now += duplicator.KNOWN_RESOURCE_TTL_SECONDS - 1
+    assert duplicator._ensure_log_group(GROUP, stats)
+    assert len(fake_logs.created) == 2
+    clock.now += 1
+    assert duplicator._ensure_log_group(GROUP, stats) and duplicator._ensure_log_stream(GROUP, "s", stats)
+    assert fake_logs.created[2:] == [("CreateLogGroup", GROUP), ("CreateLogStream", GROUP, "s")]
+    assert stats["controlPlaneCalls"] == 4 and stats["apiCallsAvoided"] == 3
+
+
+def test_failed_create_is_negatively_cached_until_ttl(fake_logs, clock):
+    fake_logs.create_errors[GROUP] = "AccessDeniedException"
+    stats = duplicator._new_stats()
+    assert duplicator._ensure_log_group(GROUP, stats) is False
+    assert duplicator._ensure_log_group(GROUP, stats) is False
+    assert len(fake_logs.created) == 1 and stats["apiCallsAvoided"] == 1
+
+    # 権限が直ったら、ネガティブキャッシュが切れた後の呼び出しで作成できる
+    del fake_logs.create_errors[GROUP]
+    clock.now += duplicator.NEGATIVE_CACHE_TTL_SECONDS
+    assert duplicator._ensure_log_group(GROUP, stats) is True
+    assert len(fake_logs.created) == 2 and stats["controlPlaneCalls"] == 2
+
+
+def test_transient_create_errors_are_not_cached(fake_logs, clock):
+    fake_logs.create_errors[GROUP] = "ServiceUnavailableException"
+    stats = duplicator._new_stats()
+    for _ in range(2):
+        with pytest.raises(ClientError):
+            duplicator._ensure_log_group(GROUP, stats)
+    assert len(fake_logs.created) == 2 and duplicator._known_log_groups == {}
+
+
+def test_skipped_events_while_destination_is_negatively_cached(fake_logs, clock):
+    fake_logs.create_errors["s"] = "LimitExceededException"
+    batches = [_log_events(3), _log_events(2)]
+    stats = duplicator._send_to_stream(GROUP, "s", batches)
+    assert stats["skippedEvents"] == 5 and fake_logs.puts == []
+    # 2 つ目のバッチはストリームを作り直さない
+    assert [call[0] for call in fake_logs.created] == ["CreateLogGroup", "CreateLogStream"]
+    assert stats["apiCallsAvoided"] == 1
+
+
+def test_deleted_log_group_is_recreated_and_the_batch_resent_once(fake_logs, clock):
+    duplicator._send_to_stream(GROUP, "s", [_log_events(2)])
+    fake_logs.created.clear()
+    fake_logs.deleted.add(GROUP)
+
+    stats = duplicator._send_to_stream(GROUP, "s", [_log_events(3)])
+    # キャッシュ上は作成済みのまま送り、ResourceNotFoundException で忘れて作り直す
+    assert fake_logs.created == [("CreateLogGroup", GROUP), ("CreateLogStream", GROUP, "s")]
+    assert [len(put["logEvents"]) for put in fake_logs.puts] == [2, 3]
+    assert stats["apiCallsAvoided"] == 2 and stats["controlPlaneCalls"] == 2 and stats["skippedEvents"] == 0
+
+    # 作り直した後はキャッシュから送る
+    stats = duplicator._send_to_stream(GROUP, "s", [_log_events(1)])
+    assert stats["apiCallsAvoided"] == 2 and stats["controlPlaneCalls"] == 0 and len(fake_logs.created) == 2
+
+
+def test_deleted_log_group_that_cannot_be_recreated_skips_the_batch(fake_logs, clock):
+    duplicator._send_to_stream(GROUP, "s", [_log_events(2)])
+    fake_logs.deleted.add(GROUP)
+    fake_logs.create_errors[GROUP] = "AccessDeniedException"
+    stats = duplicator._send_to_stream(GROUP, "s", [_log_events(3)])
+    assert stats["skippedEvents"] == 3 and len(fake_logs.puts) == 1
+    assert duplicator._known_log_groups[GROUP][0] is False
+
+
+def test_handler_reports_api_calls_avoided_on_warm_invocations(fake_logs, clock):
+    first = duplicator.handler(_awslogs_event(_log_events(5)), None)
+    second = duplicator.handler(_awslogs_event(_log_events(5)), None)
+    assert (first["controlPlaneCalls"], first["apiCallsAvoided"]) == (2, 0)
+    assert (second["controlPlaneCalls"], second["apiCallsAvoided"]) == (0, 2)
+    assert len(fake_logs.created) == 2 and len(fake_logs.puts) == 2
+
+
+class _OrderedLogs(_FakeLogs):
+    # 宛先ごとに受け取った順と、同じ宛先への呼び出しの重なりを記録する。呼び出しごとに少し待って順序を入れ替わりやすくする
+    def __init__(self, seed):
+        super().__init__()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.received = {}
+        self.inflight = {}
+        self.overlaps = 0
+
+    def put_log_events(self, **kwargs):
+        key = (kwargs["logGroupName"], kwargs["logStreamName"])
+        with self._lock:
+            self.inflight[key] = self.inflight.get(key, 0) + 1
+            if self.inflight[key] > 1:
+                self.overlaps += 1
+            delay = self._rng.uniform(0, 0.003)
+        time.sleep(delay)
+        with self._lock:
+            self.received.setdefault(key, []).append([event["message"] for event in kwargs["logEvents"]])
+            self.inflight[key] -= 1
+        return {}
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_sender_keeps_each_stream_in_order_across_destinations(monkeypatch, seed):
+    fake = _OrderedLogs(seed)
+    monkeypatch.setattr(duplicator, "logs", fake)
+    monkeypatch.setattr(duplicator, "_known_log_groups", {})
+    monkeypatch.setattr(duplicator, "_known_log_streams", {})
+    monkeypatch.setattr(duplicator, "MAX_EVENTS_PER_BATCH", 50)
+    rng = random.Random(seed)
+    keys = [(f"/aws/ecs/sulu/p-{service}", stream) for service in ("sulu", "n8n", "zulip") for stream in ("a", "b")]
+    sent = {key: [] for key in keys}
+    sender = duplicator._Sender()
+    for chunk in range(40):
+        # チャンクごとに宛先の組み合わせと件数を変える（時刻は宛先ごとに単調増加）
+        destinations = {}
+        for key in rng.sample(keys, rng.randint(1, len(keys))):
+            events = []
+            for _ in range(rng.randint(1, 120)):
+                events.append({"timestamp": 1_720_000_000_000 + len(sent[key]), "message": f"{key[0]}|{key[1]}|{len(sent[key])}"})
+                sent[key].append(events[-1]["message"])
+            destinations[key] = events
+        sender.add(destinations)
+    stats = sender.close()
+
+    assert fake.overlaps == 0
+    assert stats["skippedEvents"] == 0 and stats["droppedEvents"] == 0
+    for key in keys:
+        batches = fake.received[key]
+        assert [message for batch in batches for message in batch] == sent[key]
+        assert all(0 < len(batch) <= 50 for batch in batches)
@@ -0,0 +1,182 @@
+import base64
+import gzip
+import importlib
+import json
+import os
+import random
+import types
+
+import pytest
+
+import json_codec
+
+BACKENDS = ["json", "orjson", "msgspec"]
+
+STRINGS = [
+    "",
+    "plain ascii",
+    "日本語のログ",
+    "control \x00\x01\x08\x0b\x0c\x1b\x1f",
+    "DEL \x7f and C1 \x80\x9f",
+    "line\nbreak\ttab\rreturn",
+    'quote " backslash \\ slash /',
+    "separators   ",
+    "emoji \U0001f600",
+    "lone surrogate \ud800",
+    "<script>&amp;</script>",
+]
+INTEGERS = [0, -1, 1720000000000, 2**53 + 1, 2**63 - 1, -(2**63), 2**64 - 1, 2**64, -(2**63) - 1, 10**30]
+
+
+@pytest.fixture(params=BACKENDS)
+def codec(request, monkeypatch):
+    if request.param != "json":
+        pytest.importorskip(request.param)
+    monkeypatch.setenv("JSON_BACKEND", request.param)
+    module = importlib.reload(json_codec)
+    assert module.BACKEND == request.param
+    yield module
+    monkeypatch.delenv("JSON_BACKEND")
+    importlib.reload(json_codec)
+
+
+@pytest.mark.parametrize("value", STRINGS + INTEGERS + [None])
+def test_dumps_bytes_is_identical_to_stdlib(codec, value):
+    assert codec.dumps_bytes(value) == json.dumps(value).encode("utf-8")
+
+
+@pytest.mark.parametrize("value", [1.5, 1e100, float("nan"), True, ["a", 1], {"k": "日本"}])
+def test_dumps_bytes_falls_back_for_other_types(codec, value):
+    assert codec.dumps_bytes(value) == json.dumps(value).encode("utf-8")
+
+
+def test_loads_matches_stdlib_on_log_payloads(codec):
+    payload = {
+        "messageType": "DATA_MESSAGE",
+        "logGroup": "/aws/ecs/sulu/app",
+        "logEvents": [{"id": str(i), "timestamp": 1720000000000 + i, "message": message} for i, message in enumerate(STRINGS)],
+    }
+    raw = json.dumps(payload).encode("utf-8")
+    assert codec.loads(raw) == json.loads(raw)
+
+
+def test_loads_accepts_stdlib_only_input(codec):
+    assert json.dumps(codec.loads(b'{"v": [NaN, Infinity, -Infinity]}')) == '{"v": [NaN, Infinity, -Infinity]}'
+    with pytest.raises(json.JSONDecodeError):
+        codec.loads(b"{not json")
+
+
+@pytest.mark.parametrize("value", [v for v in INTEGERS if -(2**63) <= v < 2**64])
+def test_loads_keeps_64_bit_integers_exact(codec, value):
+    result = codec.loads(str(value).encode("ascii"))
+    assert type(result) is int and result == value
+
+
+@pytest.mark.parametrize("value", [2**64, -(2**63) - 1, 10**30])
+def test_loads_integers_beyond_64_bits(codec, value):
+    result = codec.loads(str(value).encode("ascii"))
+    if codec.BACKEND == "orjson":
+        # orjson は 64bit を超える整数を float として返す（CloudWatch の数値は int64 に収まるため許容している）
+        assert type(result) is float and result == float(value)
+    elif codec.BACKEND == "msgspec" and type(result) is float:
+        assert result == float(value)
+    else:
+        assert type(result) is int and result == value
+
+
+def _cloudwatch_logs_payload(count, seed):
+    rng = random.Random(seed)
+    return {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": "/aws/ecs/sulu/p-sulu/app",
+        "logStream": "ecs/app/0123",
+        "subscriptionFilters": ["to-firehose"],
+        "logEvents": [
+            {
+                "id": str(i),
+                "timestamp": 1720000000000 + i,
+                "message": json.dumps({"level": "INFO", "msg": "request handled " + "x" * rng.randrange(20, 400), "latency_ms": rng.random() * 100})
+                if rng.random() < 0.7
+                else "GET /api/items/%d 200 %.3f 日本語" % (rng.randrange(100000), rng.random()),
+            }
+            for i in range(count)
+        ],
+    }
+
+
+def _otlp_record(record_id, service, points):
+    payload = {
+        "resourceMetrics": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "cloud.provider", "value": {"stringValue": "aws"}},
+                        {"key": "aws.namespace", "value": {"stringValue": "AWS/ECS"}},
+                        {"key": "service.name", "value": {"stringValue": service}},
+                    ]
+                },
+                "scopeMetrics": [
+                    {"metrics": [{"name": "CPUUtilization", "gauge": {"dataPoints": [{"asDouble": i * 0.5, "timeUnixNano": 1720000000000000000 + i} for i in range(points)]}}]}
+                ],
+            }
+        ]
+    }
+    return {"recordId": record_id, "data": base64.b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")}
+
+
+class _AlreadyExists(Exception):
+    pass
+
+
+class _NotFound(Exception):
+    pass
+
+
+class _DiscardingLogs:
+    exceptions = types.SimpleNamespace(ResourceAlreadyExistsException=_AlreadyExists, ResourceNotFoundException=_NotFound)
+
+    def create_log_group(self, **kwargs):
+        pass
+
+    def create_log_stream(self, **kwargs):
+        pass
+
+    def put_log_events(self, **kwargs):
+        return {}
+
+
+def test_benchmark_log_handlers_per_backend(benchmark, codec, monkeypatch):
+    # 3 つのログ系 Lambda をそれぞれのバックエンドで実行する（pytest -s で比較）
+    pytest.importorskip("boto3")
+    os.environ.setdefault("NAME_PREFIX", "p")
+    os.environ.setdefault("ENABLED_SERVICES", json.dumps(["sulu", "n8n", "synthetics"]))
+    transformer = importlib.import_module("cloudwatch_logs_to_json_lambda")
+    duplicator = importlib.import_module("ecs_logs_duplicate_lambda")
+    stream_filter = importlib.import_module("service_control_metric_stream_filter")
+    monkeypatch.setattr(duplicator, "logs", _DiscardingLogs())
+    monkeypatch.setattr(duplicator, "_known_log_groups", {})
+    monkeypatch.setattr(duplicator, "_known_log_streams", {})
+    monkeypatch.setattr(stream_filter, "ALLOWED_SERVICE_NAMES", {"p-sulu", "sulu", "p-n8n", "n8n"})
+    scale = benchmark.scale
+
+    firehose_event = {
+        "records": [
+            {"recordId": str(n), "data": base64.b64encode(gzip.compress(json.dumps(_cloudwatch_logs_payload(60, n)).encode("utf-8"))).decode("ascii")}
+            for n in range(int(200 * scale))
+        ]
+    }
+    resp = transformer.handler(firehose_event, None)
+    assert all(record["result"] == "Ok" for record in resp["records"])
+    benchmark.rate(f"cloudwatch_logs_to_json {codec.BACKEND}", lambda: transformer.handler(firehose_event, None), len(firehose_event["records"]))
+
+    duplicate_payload = _cloudwatch_logs_payload(int(5000 * scale), 0)
+    duplicate_event = {"awslogs": {"data": base64.b64encode(gzip.compress(json.dumps(duplicate_payload).encode("utf-8"))).decode("ascii")}}
+    assert duplicator.handler(duplicate_event, None)["events"] == len(duplicate_payload["logEvents"])
+    benchmark.rate(f"ecs_logs_duplicate {codec.BACKEND}", lambda: duplicator.handler(duplicate_event, None), len(duplicate_payload["logEvents"]), unit="events")
+
+    services = ["p-sulu", "p-n8n", "p-zulip", "p-gitlab"]
+    filter_event = {"records": [_otlp_record(str(n), services[n % len(services)], 1 + n % 40) for n in range(int(3000 * scale))]}
+    results = [record["result"] for record in stream_filter.handler(filter_event, None)["records"]]
+    assert results.count("Ok") == sum(1 for n in range(len(results)) if n % len(services) < 2)
+    benchmark.rate(f"metric_stream_filter {codec.BACKEND}", lambda: stream_filter.handler(filter_event, None), len(filter_event["records"]))
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("boto3")
+
+os.environ.setdefault("CLUSTER_ARN", "arn:aws:ecs:ap-northeast-1:123456789012:cluster/p-ecs")
+os.environ.setdefault(
+    "SERVICE_ARNS",
+    json.dumps({"n8n": "arn:s/n8n", "zulip": "arn:s/zulip", "sulu": {"a": "arn:s/sulu-a", "b": "arn:s/sulu-b"}}),
+)
+
+import service_control_lambda as control  # noqa: E402
+
+
+class _FakeEcs:
+    # describe_task_definition の実際の呼び出し回数を数える ECS の代わり
+    def __init__(self):
+        self.task_definition_calls = []
+
+    def describe_services(self, cluster, services):
+        return {
+            "services": [
+                {"serviceArn": arn, "desiredCount": 1, "runningCount": 1, "status": "ACTIVE", "taskDefinition": f"td-{arn.rsplit('/', 1)[-1].split('-')[0]}"}
+                for arn in services
+            ],
+            "failures": [],
+        }
+
+    def describe_task_definition(self, taskDefinition):
+        self.task_definition_calls.append(taskDefinition)
+        return {"taskDefinition": {"containerDefinitions": [{"image": f"docker.io/library/{taskDefinition}:1"}]}}
+
+
+@pytest.fixture
+def fake_ecs(monkeypatch):
+    fake = _FakeEcs()
+    monkeypatch.setattr(control, "ecs", fake)
+    monkeypatch.setattr(control, "_task_definition_images", control.OrderedDict())
+    monkeypatch.setattr(control, "TARGET_GROUP_ARNS", {})
+    return fake
+
+
+def test_describe_all_counts_only_actual_task_definition_calls(fake_ecs):
+    first = control._describe_all(None)
+    # sulu の 2 realm は同じタスク定義
+    assert sorted(fake_ecs.task_definition_calls) == ["td-n8n", "td-sulu", "td-zulip"]
+    assert first["calls"]["describeTaskDefinition"] == 3
+
+    second = control._describe_all(None)
+    assert len(fake_ecs.task_definition_calls) == 3
+    assert second["calls"]["describeTaskDefinition"] == 0
+    assert all(entry.get("imageTag") == "1" for entry in second["services"])
+
+
+class _FakeSsm:
+    # 複数のコンテナから共有される SSM パラメータストアの代わり
+    def __init__(self):
+        self.values = {}
+        self.get_calls = 0
+
+    def get_parameters(self, Names, WithDecryption):
+        self.get_calls += 1
+        return {"Parameters": [{"Name": name, "Value": self.values[name]} for name in Names if name in self.values]}
+
+    def put_parameter(self, Name, Value, Overwrite, **kwargs):
+        self.values[Name] = Value
+
+
+def test_schedule_get_is_not_served_from_stale_cache(monkeypatch):
+    fake = _FakeSsm()
+    monkeypatch.setattr(control, "ssm", fake)
+    monkeypatch.setattr(control, "SERVICE_CONTROL_SSM_PATH", "/p/service-control")
+    monkeypatch.setattr(control.ssm_cache, "_entries", {})
+    name = control._schedule_parameter_name("n8n")
+
+    control._update_schedule("n8n", {"start_time": "08:00"})
+    # 同じコンテナのキャッシュには書き込んだ値が残る
+    assert control.ssm_cache.get(fake, name) == fake.values[name]
+
+    # 別のコンテナが書き込んだ値は、キャッシュの TTL 内でも単一サービスの GET に反映される
+    fake.values[name] = json.dumps({**json.loads(fake.values[name]), "start_time": "10:00"})
+    assert control._get_schedule("n8n")["start_time"] == "10:00"
+    # 更新は最新の値を元にする
+    updated = control._update_schedule("n8n", {"stop_time": "18:00"})
+    assert (updated["start_time"], updated["stop_time"]) == ("10:00", "18:00")
+
+
+class _ParameterNotFound(Exception):
+    pass
+
+
+class _FakeEcr:
+    # list_images / describe_images の代わり。images は push 順の (digest, [tag, ...])
+    def __init__(self, images):
+        self.images = images
+        self.described = []
+
+    def get_paginator(self, name):
+        assert name == "list_images"
+        return self
+
+    def paginate(self, repositoryName, PaginationConfig, **kwargs):
+        image_ids = [
+            {"imageDigest": digest, **({"imageTag": tag} if tag else {})}
+            for digest, tags in self.images
+            for tag in tags or [None]
+        ]
+        size = PaginationConfig["PageSize"]
+        return [{"imageIds": image_ids[i : i + size]} for i in range(0, len(image_ids), size)]
+
+    def describe_images(self, repositoryName, imageIds):
+        self.described.extend(image_id["imageDigest"] for image_id in imageIds)
+        order = {digest: (n, tags) for n, (digest, tags) in enumerate(self.images)}
+        return {
+            "imageDetails": [
+                {
+                    "imageDigest": image_id["imageDigest"],
+                    "imagePushedAt": datetime(2026, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=order[image_id["imageDigest"]][0]),
+                    **({"imageTags": order[image_id["imageDigest"]][1]} if order[image_id["imageDigest"]][1] else {}),
+                }
+                for image_id in imageIds
+            ]
+        }
+
+    def push(self, digest, tags):
+        # 同じタグは新しいイメージに移る
+        self.images = [(d, [t for t in old if t not in tags]) for d, old in self.images] + [(digest, tags)]
+
+
+def _digest(n):
+    return "sha256:" + hashlib.sha256(str(n).encode("ascii")).hexdigest()
+
+
+@pytest.fixture
+def fake_ecr(monkeypatch):
+    fake = _FakeEcr([(_digest(n), [f"v{n}"]) for n in range(250)])
+    monkeypatch.setattr(control, "ecr", fake)
+    monkeypatch.setattr(control, "_ecr_latest", {})
+    return fake
+
+
+def _expire(repository="app"):
+    control._ecr_latest[repository]["expiresAt"] = 0.0
+
+
+def test_ecr_latest_tag_describes_only_new_digests_on_refresh(fake_ecr):
+    assert control._ecr_latest_tag("app") == "v249"
+    assert len(fake_ecr.described) == 250
+
+    fake_ecr.described.clear()
+    fake_ecr.push(_digest(250), ["v250", "latest"])
+    assert control._ecr_latest_tag("app") == "v249"
+    _expire()
+    assert control._ecr_latest_tag("app") == "v250"
+    assert fake_ecr.described == [_digest(250)]
+
+
+def test_ecr_latest_tag_reports_untagged_newest_image(fake_ecr):
+    # 元の実装と同じく、最新のイメージにタグが無ければ None
+    fake_ecr.push(_digest(250), [])
+    assert control._ecr_latest_tag("app") is None
+    # 新しいタグ付きイメージが push されれば、そのタグ
+    fake_ecr.push(_digest(251), ["v251"])
+    _expire()
+    assert control._ecr_latest_tag("app") == "v251"
+    # 最新のイメージのタグが外された場合も None
+    fake_ecr.images[-1] = (_digest(251), [])
+    _expire()
+    assert control._ecr_latest_tag("app") is None
+    assert fake_ecr.described[-1] == _digest(251) and len(fake_ecr.described) == 252
+
+
+def test_ecr_latest_tag_rescans_when_newest_image_is_deleted(fake_ecr):
+    assert control._ecr_latest_tag("app") == "v249"
+    fake_ecr.described.clear()
+    fake_ecr.images.pop()
+    _expire()
+    assert control._ecr_latest_tag("app") == "v248"
+    assert len(fake_ecr.described) == 249
+
+
+class _FakeEcrSsm:
+    exceptions = type("exceptions", (), {"ParameterNotFound": _ParameterNotFound})
+
+    def __init__(self):
+        self.values = {}
+
+    def get_parameter(self, Name):
+        if Name not in self.values:
+            raise _ParameterNotFound(Name)
+        return {"Parameter": {"Name": Name, "Value": self.values[Name]}}
+
+    def put_parameter(self, Name, Value, Type, Overwrite):
+        assert len(Value.encode("utf-8")) <= control.SSM_PARAMETER_MAX_BYTES
+        self.values[Name] = Value
+
+
+@pytest.fixture
+def fake_ecr_ssm(monkeypatch):
+    fake = _FakeEcrSsm()
+    monkeypatch.setattr(control, "ssm", fake)
+    monkeypatch.setattr(control, "ECR_LATEST_TAG_SSM_CACHE", True)
+    monkeypatch.setattr(control, "SERVICE_CONTROL_SSM_PATH", "/p/service-control")
+    return fake
+
+
+def test_ecr_latest_tag_cold_start_is_seeded_from_stored_digests(monkeypatch, fake_ecr, fake_ecr_ssm):
+    # 4 KB に 200 件ほど収まる
+    fake_ecr.images = fake_ecr.images[:150]
+    assert control._ecr_latest_tag("app") == "v149"
+    stored = json.loads(fake_ecr_ssm.values["/p/service-control/ecr-latest/app"])
+    assert len(stored["knownDigests"]) == 150
+
+    # 別のコンテナのコールドスタート。TTL 内なら SSM の値をそのまま使う
+    monkeypatch.setattr(control, "_ecr_latest", {})
+    fake_ecr.described.clear()
+    fake_ecr.push(_digest(250), ["v250"])
+    assert control._ecr_latest_tag("app") == "v149"
+    assert fake_ecr.described == []
+
+    # TTL 切れでも、保存済みのダイジェストは describe_images しない
+    monkeypatch.setattr(control, "_ecr_latest", {})
+    fake_ecr_ssm.values["/p/service-control/ecr-latest/app"] = json.dumps({**stored, "checkedAt": 0})
+    assert control._ecr_latest_tag("app") == "v250"
+    assert fake_ecr.described == [_digest(250)]
+
+
+def test_ecr_latest_tag_omits_digests_that_do_not_fit_in_ssm(monkeypatch, fake_ecr, fake_ecr_ssm):
+    fake_ecr.images = [(_digest(n), [f"v{n}"]) for n in range(400)]
+    assert control._ecr_latest_tag("app") == "v399"
+    stored = json.loads(fake_ecr_ssm.values["/p/service-control/ecr-latest/app"])
+    assert "knownDigests" not in stored and stored["tag"] == "v399"
+
+    monkeypatch.setattr(control, "_ecr_latest", {})
+    fake_ecr_ssm.values["/p/service-control/ecr-latest/app"] = json.dumps({**stored, "checkedAt": 0})
+    fake_ecr.described.clear()
+    assert control._ecr_latest_tag("app") == "v399"
+    assert len(fake_ecr.described) == 400
@@ -0,0 +1,289 @@
+import base64
+import json
+import os
+import random
+
+import pytest
+
+os.environ.setdefault("NAME_PREFIX", "p")
+os.environ.setdefault("ENABLED_SERVICES", json.dumps(["sulu", "n8n", "synthetics"]))
+
+import service_control_metric_stream_filter as stream_filter  # noqa: E402
+
+SERVICE_KEYS = sorted(stream_filter.SERVICE_ATTR_KEYS | stream_filter.CANARY_ATTR_KEYS)
+NAMESPACE_KEYS = sorted(stream_filter.NAMESPACE_ATTR_KEYS)
+
+
+# 変更前の抽出処理（service と namespace をそれぞれ resourceMetrics から探す）
+def _baseline_service_from_otlp(payload):
+    resource_metrics = payload.get("resourceMetrics") or payload.get("resource_metrics") or []
+    for resource_metric in resource_metrics:
+        attrs = (resource_metric.get("resource") or {}).get("attributes") or []
+        for attr in attrs:
+            if attr.get("key") in SERVICE_KEYS:
+                value = stream_filter._attr_value(attr.get("value"))
+                if value:
+                    return value
+    return None
+
+
+def _baseline_namespace_from_otlp(payload):
+    resource_metrics = payload.get("resourceMetrics") or payload.get("resource_metrics") or []
+    for resource_metric in resource_metrics:
+        attrs = (resource_metric.get("resource") or {}).get("attributes") or []
+        for attr in attrs:
+            if attr.get("key") in NAMESPACE_KEYS:
+                value = stream_filter._attr_value(attr.get("value"))
+                if value:
+                    return value
+    return None
+
+
+def _baseline_extract(payload):
+    service_name = _baseline_service_from_otlp(payload) or stream_filter._extract_service_from_json(payload)
+    namespace = payload.get("namespace")
+    namespace = str(namespace) if namespace else _baseline_namespace_from_otlp(payload)
+    return service_name, namespace
+
+
+def _attr(key, value):
+    return {"key": key, "value": {"stringValue": value}}
+
+
+def _otlp(resource_attrs, scope_attrs=(), point_attrs=(), key="resourceMetrics"):
+    return {
+        key: [
+            {
+                "resource": {"attributes": list(attrs)},
+                "scopeMetrics": [
+                    {
+                        "scope": {"name": "aws.cloudwatch", "attributes": list(scope_attrs)},
+                        "metrics": [
+                            {
+                                "name": "CPUUtilization",
+                                "gauge": {"dataPoints": [{"asDouble": 1.0, "attributes": list(point_attrs)}]},
+                            }
+                        ],
+                    }
+                ],
+            }
+            for attrs in resource_attrs
+        ]
+    }
+
+
+EXTRACTION_CASES = [
+    # resource の属性
+    _otlp([[_attr("aws.namespace", "AWS/ECS"), _attr("aws.ecs.service.name", "p-sulu")]]),
+    _otlp([[_attr("service.name", "p-n8n"), _attr("aws.cloudwatch.namespace", "AWS/ECS")]], key="resource_metrics"),
+    _otlp([[_attr("CanaryName", "p-canary"), _attr("aws.namespace", "CloudWatchSynthetics")]]),
+    # 最初の resource の service が空なら次の resource を見る
+    _otlp([[_attr("service.name", ""), _attr("aws.namespace", "AWS/ECS")], [_attr("ServiceName", "p-sulu")]]),
+    _otlp([[{"key": "service.name", "value": {"intValue": 0}}]]),
+    _otlp([[{"key": "service.name", "value": {"boolValue": False}}, _attr("TaskDefinitionFamily", "p-n8n")]]),
+    # scope / datapoint の属性は見ない
+    _otlp([[_attr("aws.namespace", "AWS/ECS")]], scope_attrs=[_attr("service.name", "p-sulu")]),
+    _otlp([[_attr("cloud.provider", "aws")]], point_attrs=[_attr("service.name", "p-sulu"), _attr("aws.namespace", "X")]),
+    # service.name が無い / namespace だけ
+    _otlp([[_attr("cloud.provider", "aws"), _attr("aws.namespace", "AWS/ECS")]]),
+    _otlp([[_attr("aws.cloudwatch.metric.namespace", "CloudWatchSynthetics")]]),
+    _otlp([[]]),
+    _otlp([]),
+    {"resourceMetrics": [{"resource": None}, {}]},
+    # トップレベルの namespace / dimensions と OTLP の組み合わせ
+    {**_otlp([[_attr("aws.namespace", "AWS/ECS")]]), "namespace": "CloudWatchSynthetics"},
+    {**_otlp([[_attr("aws.namespace", "AWS/ECS")]]), "dimensions": {"ServiceName": "p-sulu"}},
+    {**_otlp([[_attr("service.name", "p-n8n")]]), "metric_stream_name": "s", "dimensions": {"ServiceName": "p-sulu"}},
+    # JSON 形式
+    {"metric_stream_name": "s", "namespace": "AWS/ECS", "dimensions": {"ClusterName": "c", "ServiceName": "p-sulu"}},
+    {"metric_stream_name": "s", "namespace": "CloudWatchSynthetics", "dimensions": {"CanaryName": "p-canary"}},
+    {"metric_stream_name": "s", "namespace": "AWS/ECS", "dimensions": {"ServiceName": "", "serviceName": "p-n8n"}},
+    {"metric_stream_name": "s", "namespace": "", "dimensions": []},
+    {},
+]
+
+
+@pytest.mark.parametrize("payload", EXTRACTION_CASES)
+def test_extraction_matches_baseline(payload):
+    assert stream_filter._extract_service_and_namespace(payload) == _baseline_extract(payload)
+
+
+def _random_attrs(rng):
+    keys = SERVICE_KEYS + NAMESPACE_KEYS + ["cloud.provider", "aws.ecs.cluster.name"]
+    attrs = []
+    for _ in range(rng.randint(0, 6)):
+        value = rng.choice(
+            [
+                {"stringValue": rng.choice(["p-sulu", "p-other", "", "CloudWatchSynthetics", "AWS/ECS"])},
+                {"string_value": "p-n8n"},
+                {"intValue": rng.choice([0, 7])},
+                {"doubleValue": 1.5},
+                {"boolValue": rng.choice([True, False])},
+                {"stringValue": None},
+                {"arrayValue": {"values": []}},
+                {},
+                None,
+            ]
+        )
+        attrs.append({"key": rng.choice(keys), "value": value})
+    return attrs
+
+
+def test_extraction_matches_baseline_on_random_payloads():
+    rng = random.Random(9)
+    for _ in range(3000):
+        payload = _otlp(
+            [_random_attrs(rng) for _ in range(rng.randint(0, 3))],
+            scope_attrs=_random_attrs(rng),
+            point_attrs=_random_attrs(rng),
+            key=rng.choice(["resourceMetrics", "resource_metrics"]),
+        )
+        if rng.random() < 0.3:
+            payload["namespace"] = rng.choice(["", "AWS/ECS", "CloudWatchSynthetics"])
+        if rng.random() < 0.3:
+            payload["dimensions"] = {rng.choice(["ServiceName", "CanaryName", "other"]): rng.choice(["", "p-sulu"])}
+        if rng.random() < 0.2:
+            payload["metric_stream_name"] = "s"
+        assert stream_filter._extract_service_and_namespace(payload) == _baseline_extract(payload), payload
+
+
+def _baseline_result(data):
+    # 変更前の handler の判定（全体をデコードして解析し、解析できなければ残す）
+    if not data:
+        return "Dropped"
+    try:
+        payload = json.loads(base64.b64decode(data))
+    except Exception:
+        return "Ok"
+    return "Ok" if stream_filter._should_keep(*_baseline_extract(payload)) else "Dropped"
+
+
+def _large_otlp(rng):
+    service = rng.choice(["p-sulu", "sulu", "p-other", "x]y", "[p-sulu]", "", None])
+    attrs = [_attr("cloud.provider", "aws"), _attr("aws.namespace", rng.choice(["AWS/ECS", "CloudWatchSynthetics"]))]
+    if service is not None:
+        attrs.append(_attr(rng.choice(SERVICE_KEYS), service))
+    if rng.random() < 0.2:
+        attrs.append({"key": "tags", "value": {"arrayValue": {"values": [{"stringValue": "a"}]}}})
+    rng.shuffle(attrs)
+    resources = [attrs] + [[_attr("service.name", rng.choice(["p-n8n", "p-other"]))] for _ in range(rng.randint(0, 2))]
+    payload = _otlp(resources, point_attrs=[_attr("service.name", "p-sulu")])
+    points = payload["resourceMetrics"][0]["scopeMetrics"][0]["metrics"][0]["gauge"]["dataPoints"]
+    points.extend({"asDouble": rng.random(), "timeUnixNano": i} for i in range(rng.randint(20, 60)))
+    if rng.random() < 0.2:
+        payload["namespace"] = "CloudWatchSynthetics"
+    separators = rng.choice([(",", ":"), (", ", ": ")])
+    return json.dumps(payload, separators=separators, ensure_ascii=rng.random() < 0.5)
+
+
+def _json_format_metric(rng):
+    dimensions = {"ClusterName": "c" * rng.randint(1, 40)}
+    service = rng.choice(["p-sulu", "p-other", "n8n", None])
+    if service:
+        dimensions[rng.choice(["ServiceName", "CanaryName", "serviceName"])] = service
+    return {
+        "metric_stream_name": 's"x',
+        "account_id": "123456789012",
+        "region": "ap-northeast-1",
+        "namespace": rng.choice(["AWS/ECS", "CloudWatchSynthetics"]),
+        "metric_name": "CPU]Utilization",
+        "dimensions": dimensions,
+        "timestamp": 1,
+        "value": {"max": 1, "min": 0, "sum": 1, "count": 1},
+        "unit": "Percent",
+    }
+
+
+def _large_json_format(rng):
+    kind = rng.choice(["lines", "pretty", "single"])
+    if kind == "lines":
+        lines = [json.dumps(_json_format_metric(rng), separators=(",", ":")) for _ in range(rng.randint(6, 40))]
+        return "\n".join(lines) + rng.choice(["", "\n"])
+    metric = _json_format_metric(rng)
+    if kind == "pretty":
+        return json.dumps(metric, indent=2) + " " * 1500
+    metric["dimensions"]["Padding"] = "p" * 1500
+    return json.dumps(metric, separators=(",", ":"))
+
+
+def _damage_tail(rng, text):
+    # 先頭（HEADER_SCAN_BYTES）より後ろだけを壊す
+    raw = text.encode("utf-8")
+    cut = rng.randint(min(stream_filter.HEADER_SCAN_BYTES, len(raw)), len(raw))
+    choice = rng.choice(["truncate", "garbage", "append", "brace"])
+    if choice == "truncate":
+        return raw[:cut]
+    if choice == "garbage":
+        return raw[:cut] + b"\xff\x00" + raw[cut + 2 :]
+    if choice == "append":
+        return raw + b'{"x":'
+    return raw[:cut] + b"}" + raw[cut:]
+
+
+def _corpus(seed):
+    rng = random.Random(seed)
+    records = []
+    for i in range(3000):
+        text = _large_otlp(rng) if rng.random() < 0.6 else _large_json_format(rng)
+        damaged = rng.random() < 0.4
+        raw = _damage_tail(rng, text) if damaged else text.encode("utf-8")
+        data = base64.b64encode(raw).decode("ascii")
+        if rng.random() < 0.05:
+            position = rng.randint(0, len(data))
+            data = data[:position] + rng.choice(["!", "=", "A"]) + data[position:]
+        records.append(({"recordId": str(i), "data": data}, damaged))
+    return records
+
+
+ALLOW_LISTS = [
+    pytest.param({"p-sulu", "sulu", "p-n8n", "n8n", "p-synthetics", "synthetics"}, True, id="with-synthetics"),
+    pytest.param({"p-sulu", "sulu"}, False, id="without-synthetics"),
+]
+
+
+@pytest.mark.parametrize("allowed, allow_synthetics", ALLOW_LISTS)
+def test_header_classification_never_changes_kept_records(monkeypatch, allowed, allow_synthetics):
+    monkeypatch.setattr(stream_filter, "ALLOWED_SERVICE_NAMES", allowed)
+    monkeypatch.setattr(stream_filter, "ALLOW_SYNTHETICS", allow_synthetics)
+    corpus = _corpus(10)
+    kept_from_header = {"intact": 0, "damaged": 0}
+    for record, damaged in corpus:
+        decision = stream_filter._classify_header(record["data"])
+        # 先頭だけでは残すか判定不能かのどちらか。残すのは全体を解析しても残るレコードだけ
+        assert decision in (None, True)
+        if decision:
+            assert _baseline_result(record["data"]) == "Ok", record
+            kept_from_header["damaged" if damaged else "intact"] += 1
+
+    out = stream_filter.handler({"records": [record for record, _ in corpus]}, None)
+    assert [r["result"] for r in out["records"]] == [_baseline_result(record["data"]) for record, _ in corpus]
+    assert [r["data"] for r in out["records"]] == [record["data"] for record, _ in corpus]
+    # 先頭だけでの判定が、後続が壊れたレコードも含めて実際に使われている
+    assert kept_from_header["intact"] > 100 and kept_from_header["damaged"] > 50
+
+
+def test_header_classification_cases(monkeypatch):
+    monkeypatch.setattr(stream_filter, "ALLOWED_SERVICE_NAMES", {"p-sulu"})
+    monkeypatch.setattr(stream_filter, "ALLOW_SYNTHETICS", False)
+    pad = [{"asDouble": 1.0}] * 200
+
+    def encoded(payload_text):
+        return base64.b64encode(payload_text.encode("utf-8")).decode("ascii")
+
+    def otlp(attrs):
+        return json.dumps({"resourceMetrics": [{"resource": {"attributes": attrs}, "scopeMetrics": [{"metrics": [{"gauge": {"dataPoints": pad}}]}]}]})
+
+    metric = _json_format_metric(random.Random(1))
+    # 許可された service は先頭だけで残す（後続が壊れていても全体の解析で残る）
+    assert stream_filter._classify_header(encoded(otlp([_attr("service.name", "p-sulu")]))) is True
+    assert stream_filter._classify_header(encoded(otlp([_attr("service.name", "p-sulu")])[:-300])) is True
+    # 許可されていない service / service なし / 属性内の括弧は全体の解析に任せる
+    assert stream_filter._classify_header(encoded(otlp([_attr("service.name", "p-other")]))) is None
+    assert stream_filter._classify_header(encoded(otlp([_attr("cloud.provider", "aws")]))) is None
+    assert stream_filter._classify_header(encoded(otlp([_attr("x", "]"), _attr("service.name", "p-sulu")]))) is None
+    # 改行区切りの複数メトリクスは残す。整形された 1 件のメトリクスは全体の解析に任せる
+    lines = "\n".join(json.dumps(metric) for _ in range(10))
+    assert stream_filter._classify_header(encoded(lines)) is True
+    assert stream_filter._classify_header(encoded(json.dumps(metric, indent=2) + "\n" * 2000)) is None
+    # 先頭だけで全体が収まる小さなレコードは先頭だけでは判定しない
+    assert stream_filter._classify_header(encoded(json.dumps(metric))) is None
@@ -0,0 +1,222 @@
+import os
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("boto3")
+
+os.environ.setdefault("CLUSTER_ARN", "arn:aws:ecs:ap-northeast-1:123456789012:cluster/p-ecs")
+
+import service_control_scheduler as scheduler  # noqa: E402
+import service_schedule  # noqa: E402
+
+LOCAL = timedelta(hours=service_schedule.TIMEZONE_OFFSET_HOURS)
+
+
+def _zulip(local_dt):
+    # 平日（祝日を除く）の 9 時台だけ使われる
+    return 12.0 if local_dt.weekday() < 5 and not service_schedule.is_off_day(local_dt.date()) and local_dt.hour == 9 else 0.0
+
+
+def _odoo(local_dt):
+    # 平日の祝日の 10 時台と、日曜の 11 時台に使われる
+    holiday = local_dt.weekday() < 5 and service_schedule.is_off_day(local_dt.date())
+    return 3.0 if (holiday and local_dt.hour == 10) or (local_dt.weekday() == 6 and local_dt.hour == 11) else 0.0
+
+
+def _n8n(local_dt):
+    # 月曜の 8 時台、日付が偶数の日だけ使われる
+    return 1.0 if local_dt.weekday() == 0 and local_dt.hour == 8 and local_dt.day % 2 == 0 else 0.0
+
+
+DEMAND = {"zulip": _zulip, "odoo": _odoo, "n8n": _n8n}
+
+
+class _FakeCloudWatch:
+    # WAF の CountedRequests を DEMAND から 1 時間ごとに返す。結果は 2 ページに分ける
+    def __init__(self):
+        self.metric_data_calls = []
+        self.failure = None
+        self.alarms = {}
+
+    def get_metric_data(self, **kwargs):
+        self.metric_data_calls.append(kwargs)
+        if self.failure is not None:
+            raise self.failure
+        results = []
+        for query in kwargs["MetricDataQueries"]:
+            rule = query["MetricStat"]["Metric"]["Dimensions"][1]["Value"]
+            demand = DEMAND[rule[len("count-jp-") :]]
+            timestamps, values = [], []
+            moment = kwargs["StartTime"]
+            while moment < kwargs["EndTime"]:
+                value = demand(moment + LOCAL)
+                if value:
+                    timestamps.append(moment)
+                    values.append(value)
+                moment += timedelta(hours=1)
+            results.append({"Id": query["Id"], "Timestamps": timestamps, "Values": values})
+        half = "NextToken" not in kwargs
+        return {
+            "MetricDataResults": [
+                {**result, "Timestamps": result["Timestamps"][:5] if half else result["Timestamps"][5:], "Values": result["Values"][:5] if half else result["Values"][5:]}
+                for result in results
+            ],
+            **({"NextToken": "page-2"} if half else {}),
+        }
+
+    def put_metric_alarm(self, **kwargs):
+        self.alarms[kwargs["AlarmName"]] = kwargs
+
+    def get_paginator(self, name):
+        return _EmptyAlarmPaginator()
+
+
+class _EmptyAlarmPaginator:
+    def paginate(self, **kwargs):
+        return iter([{"MetricAlarms": []}])
+
+
+class _FakeEcs:
+    def __init__(self):
+        self.updates = []
+
+    def describe_services(self, cluster, services):
+        return {"services": [{"serviceArn": arn, "desiredCount": 0} for arn in services]}
+
+    def update_service(self, cluster, service, desiredCount):
+        self.updates.append((service, desiredCount))
+
+
+@pytest.fixture
+def fake_cloudwatch(monkeypatch):
+    fake = _FakeCloudWatch()
+    monkeypatch.setattr(scheduler, "cloudwatch", fake)
+    monkeypatch.setattr(scheduler, "DEMAND_PROFILES", {"keys": (), "expiresAt": 0.0, "observed": None, "hits": {}})
+    monkeypatch.setattr(scheduler, "PREWARM_LOOKBACK_DAYS", 28)
+    monkeypatch.setattr(scheduler, "PREWARM_LEAD_MINUTES", 15)
+    monkeypatch.setattr(scheduler, "PREWARM_MIN_PROBABILITY", 0.5)
+    return fake
+
+
+def _utc(local_dt):
+    return (local_dt - LOCAL).replace(tzinfo=timezone.utc)
+
+
+def test_profiles_bucket_hours_by_weekday_and_holiday_class(fake_cloudwatch):
+    # 2025-04-22 から 28 日分。平日の祝日は 4/29（火）、5/5（月）、5/6（火）
+    profiles, calls = scheduler._load_demand_profiles(["zulip", "odoo", "n8n"], _utc(datetime(2025, 5, 20, 0, 30)))
+    assert calls == 2
+    assert len(fake_cloudwatch.metric_data_calls[0]["MetricDataQueries"]) == 3
+
+    holiday_slot = scheduler.HOLIDAY_DEMAND_CLASS * scheduler.HOURS_PER_DAY
+    assert profiles["observed"][holiday_slot + 10] == 3
+    # 火曜は 4 日のうち 2 日が祝日
+    assert profiles["observed"][1 * scheduler.HOURS_PER_DAY + 9] == 2
+    # 月曜は 5/5 が祝日のため 4/28・5/12・5/19 の 3 日
+    assert profiles["observed"][0 * scheduler.HOURS_PER_DAY + 8] == 3
+    assert sum(profiles["observed"]) == 28 * 24
+
+    probability = scheduler._demand_probability
+    assert probability(profiles, "zulip", datetime(2025, 5, 27, 9, 0)) == 1.0
+    assert probability(profiles, "zulip", datetime(2025, 5, 27, 10, 0)) == 0.0
+    # 平日の祝日は祝日の区分で数える
+    assert probability(profiles, "zulip", datetime(2025, 7, 21, 9, 0)) == 0.0
+    assert probability(profiles, "odoo", datetime(2025, 7, 21, 10, 0)) == 1.0
+    assert probability(profiles, "odoo", datetime(2025, 5, 26, 10, 0)) == 0.0
+    assert probability(profiles, "odoo", datetime(2025, 5, 25, 11, 0)) == 1.0
+    # 月曜 3 日のうち偶数日は 4/28・5/12
+    assert probability(profiles, "n8n", datetime(2025, 5, 26, 8, 0)) == pytest.approx(2 / 3)
+    assert probability(profiles, "unknown", datetime(2025, 5, 27, 9, 0)) == 0.0
+
+
+def test_holiday_class_falls_back_to_sunday_without_holiday_history(fake_cloudwatch):
+    # 2025-06-02 から 28 日分には平日の祝日が無い
+    profiles, _ = scheduler._load_demand_profiles(["odoo"], _utc(datetime(2025, 6, 30, 0, 30)))
+    holiday_slot = scheduler.HOLIDAY_DEMAND_CLASS * scheduler.HOURS_PER_DAY
+    assert profiles["observed"][holiday_slot + 11] == 0
+    # 海の日（月曜）は日曜の時間帯で判断する
+    assert scheduler._demand_probability(profiles, "odoo", datetime(2025, 7, 21, 11, 0)) == 1.0
+    assert scheduler._demand_probability(profiles, "odoo", datetime(2025, 7, 21, 10, 0)) == 0.0
+    # 祝日の履歴がある場合は日曜の時間帯を借りない
+    fake_cloudwatch.metric_data_calls.clear()
+    profiles["expiresAt"] = 0.0
+    profiles, _ = scheduler._load_demand_profiles(["odoo"], _utc(datetime(2025, 5, 20, 0, 30)))
+    assert scheduler._demand_probability(profiles, "odoo", datetime(2025, 7, 21, 11, 0)) == 0.0
+
+
+def test_prewarm_threshold_and_lead_window(monkeypatch, fake_cloudwatch):
+    profiles, _ = scheduler._load_demand_profiles(["zulip", "n8n"], _utc(datetime(2025, 5, 20, 0, 30)))
+    tuesday = date(2025, 5, 27)
+
+    def due(service_key, hour, minute, day=tuesday):
+        return scheduler._prewarm_due(profiles, service_key, datetime(day.year, day.month, day.day, hour, minute))
+
+    # 9 時台の需要: 15 分前から起動し、9 時台の間は起動しておく
+    assert not due("zulip", 8, 44)
+    assert due("zulip", 8, 45)
+    assert due("zulip", 9, 59)
+    assert not due("zulip", 10, 0)
+    monkeypatch.setattr(scheduler, "PREWARM_LEAD_MINUTES", 30)
+    assert due("zulip", 8, 30)
+
+    # 確率 2/3 の時間帯は、しきい値が 2/3 以下なら起動する
+    monday = date(2025, 5, 26)
+    monkeypatch.setattr(scheduler, "PREWARM_MIN_PROBABILITY", 2 / 3)
+    assert due("n8n", 8, 0, monday)
+    monkeypatch.setattr(scheduler, "PREWARM_MIN_PROBABILITY", 0.7)
+    assert not due("n8n", 8, 0, monday)
+    # しきい値 0 でも需要の無い時間帯は起動しない
+    monkeypatch.setattr(scheduler, "PREWARM_MIN_PROBABILITY", 0.0)
+    assert not due("n8n", 12, 0, monday)
+
+
+def test_failed_refresh_keeps_previous_profiles(fake_cloudwatch):
+    now = _utc(datetime(2025, 5, 20, 0, 30))
+    profiles, calls = scheduler._load_demand_profiles(["zulip"], now)
+    assert calls == 2
+    # 有効期限内は取得しない
+    assert scheduler._load_demand_profiles(["zulip"], now) == (profiles, 0)
+
+    previous_hits = profiles["hits"]["zulip"]
+    profiles["expiresAt"] = 0.0
+    fake_cloudwatch.failure = RuntimeError("throttled")
+    kept, calls = scheduler._load_demand_profiles(["zulip"], now + timedelta(days=1))
+    assert calls == 1
+    assert kept is profiles and kept["hits"]["zulip"] is previous_hits
+    assert scheduler._demand_probability(kept, "zulip", datetime(2025, 5, 27, 9, 0)) == 1.0
+    # 次の実行で取り直す
+    fake_cloudwatch.failure = None
+    _, calls = scheduler._load_demand_profiles(["zulip"], now + timedelta(days=1))
+    assert calls == 2
+
+
+def test_prewarmed_service_is_started_with_alarm_actions_suspended(monkeypatch, fake_cloudwatch):
+    ecs = _FakeEcs()
+    monkeypatch.setattr(scheduler, "ecs", ecs)
+    monkeypatch.setattr(scheduler, "ALARM_FINGERPRINTS", {})
+    monkeypatch.setattr(scheduler, "SERVICE_CONTROL_SSM_PATH", "")
+    monkeypatch.setattr(scheduler, "SERVICE_CONTROL_SCHEDULE_SERVICES", ["zulip", "odoo"])
+    monkeypatch.setattr(scheduler, "SERVICE_ARNS", {"zulip": "arn:s/zulip", "odoo": "arn:s/odoo"})
+    monkeypatch.setattr(scheduler, "SERVICE_CONTROL_AUTOSTOP_POLICIES", {"zulip": "policy-zulip", "odoo": "policy-odoo"})
+    monkeypatch.setattr(scheduler, "SERVICE_CONTROL_AUTOSTOP_WAF_NAME", "waf")
+    monkeypatch.setattr(scheduler, "SERVICE_CONTROL_AUTOSTOP_ALARM_REGION", "ap-northeast-1")
+    monkeypatch.setattr(scheduler, "PREWARM_ENABLED", True)
+    # 次の祝日でない平日の 8 時 50 分（スケジュールは既定で無効）
+    local_now = datetime.now(timezone.utc).replace(tzinfo=None) + LOCAL + timedelta(days=1)
+    while local_now.weekday() >= 5 or service_schedule.is_off_day(local_now.date()):
+        local_now += timedelta(days=1)
+    local_now = local_now.replace(hour=8, minute=50, second=0, microsecond=0)
+    monkeypatch.setattr(scheduler, "_current_local_datetime", lambda: local_now)
+
+    result = scheduler.handler({}, None)
+
+    reports = {report["service"]: report for report in result["services"]}
+    assert reports["zulip"]["prewarm"] is True and reports["zulip"]["active"] is True
+    assert reports["odoo"]["prewarm"] is False and reports["odoo"]["active"] is False
+    assert ecs.updates == [("arn:s/zulip", scheduler.START_DESIRED)]
+    alarms = fake_cloudwatch.alarms
+    # 予測起動したサービスは、需要の時間帯が終わるまでアイドル停止のアクションを止める
+    assert alarms[scheduler._alarm_details("zulip")[0]]["ActionsEnabled"] is False
+    assert alarms[scheduler._alarm_details("odoo")[0]]["ActionsEnabled"] is True
+    assert result["prewarmed"] == 1 and result["metricDataCalls"] == 2
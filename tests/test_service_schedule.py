@@ -0,0 +1,129 @@
+import base64
+import json
+from datetime import date, timedelta
+
+import pytest
+
+import service_schedule
+
+# 内閣府「国民の祝日」（syukujitsu.csv）の掲載分。祝日・振替休日・国民の休日を土日に当たる日も含めて MMDD で並べる
+PUBLISHED_HOLIDAYS = {
+    2007: "0101 0108 0211 0212 0321 0429 0430 0503 0504 0505 0716 0917 0923 0924 1008 1103 1123 1223 1224",
+    2008: "0101 0114 0211 0320 0429 0503 0504 0505 0506 0721 0915 0923 1013 1103 1123 1124 1223",
+    2009: "0101 0112 0211 0320 0429 0503 0504 0505 0506 0720 0921 0922 0923 1012 1103 1123 1223",
+    2010: "0101 0111 0211 0321 0322 0429 0503 0504 0505 0719 0920 0923 1011 1103 1123 1223",
+    2011: "0101 0110 0211 0321 0429 0503 0504 0505 0718 0919 0923 1010 1103 1123 1223",
+    2012: "0101 0102 0109 0211 0320 0429 0430 0503 0504 0505 0716 0917 0922 1008 1103 1123 1223 1224",
+    2013: "0101 0114 0211 0320 0429 0503 0504 0505 0506 0715 0916 0923 1014 1103 1104 1123 1223",
+    2014: "0101 0113 0211 0321 0429 0503 0504 0505 0506 0721 0915 0923 1013 1103 1123 1124 1223",
+    2015: "0101 0112 0211 0321 0429 0503 0504 0505 0506 0720 0921 0922 0923 1012 1103 1123 1223",
+    2016: "0101 0111 0211 0320 0321 0429 0503 0504 0505 0718 0811 0919 0922 1010 1103 1123 1223",
+    2017: "0101 0102 0109 0211 0320 0429 0503 0504 0505 0717 0811 0918 0923 1009 1103 1123 1223",
+    2018: "0101 0108 0211 0212 0321 0429 0430 0503 0504 0505 0716 0811 0917 0923 0924 1008 1103 1123 1223 1224",
+    2019: "0101 0114 0211 0321 0429 0430 0501 0502 0503 0504 0505 0506 0715 0811 0812 0916 0923 1014 1022 1103 1104 1123",
+    2020: "0101 0113 0211 0223 0224 0320 0429 0503 0504 0505 0506 0723 0724 0810 0921 0922 1103 1123",
+    2021: "0101 0111 0211 0223 0320 0429 0503 0504 0505 0722 0723 0808 0809 0920 0923 1103 1123",
+    2022: "0101 0110 0211 0223 0321 0429 0503 0504 0505 0718 0811 0919 0923 1010 1103 1123",
+    2023: "0101 0102 0109 0211 0223 0321 0429 0503 0504 0505 0717 0811 0918 0923 1009 1103 1123",
+    2024: "0101 0108 0211 0212 0223 0320 0429 0503 0504 0505 0506 0715 0811 0812 0916 0922 0923 1014 1103 1104 1123",
+    2025: "0101 0113 0211 0223 0224 0320 0429 0503 0504 0505 0506 0721 0811 0915 0923 1013 1103 1123 1124",
+    2026: "0101 0112 0211 0223 0320 0429 0503 0504 0505 0506 0720 0811 0921 0922 0923 1012 1103 1123",
+    2027: "0101 0111 0211 0223 0321 0322 0429 0503 0504 0505 0719 0811 0920 0923 1011 1103 1123",
+}
+
+
+def _published(year):
+    return {date(year, int(text[:2]), int(text[2:])) for text in PUBLISHED_HOLIDAYS[year].split()}
+
+
+def _days(year):
+    day = date(year, 1, 1)
+    while day.year == year:
+        yield day
+        day += timedelta(days=1)
+
+
+@pytest.mark.parametrize("year", sorted(PUBLISHED_HOLIDAYS))
+def test_every_date_matches_published_calendar(year):
+    expected = _published(year)
+    assert service_schedule.japan_holidays(year) == expected
+    for day in _days(year):
+        assert service_schedule.is_off_day(day) == (day.weekday() >= 5 or day in expected), day
+
+
+@pytest.mark.parametrize(
+    "day, off",
+    [
+        # 振替休日（連休中の日曜は連休明けへ送る）
+        (date(2024, 2, 12), True),
+        (date(2025, 2, 24), True),
+        (date(2025, 2, 25), False),
+        (date(2020, 5, 6), True),
+        (date(2025, 5, 6), True),
+        (date(2025, 5, 7), False),
+        (date(2025, 11, 24), True),
+        # 国民の休日
+        (date(2015, 9, 22), True),
+        (date(2019, 4, 30), True),
+        (date(2019, 5, 2), True),
+        (date(2026, 9, 22), True),
+        # 2019: 即位の日・即位礼正殿の儀、天皇誕生日なし
+        (date(2019, 5, 1), True),
+        (date(2019, 10, 22), True),
+        (date(2019, 12, 23), False),
+        # 2020・2021: オリンピック・パラリンピックに伴う移動
+        (date(2020, 7, 20), False),
+        (date(2020, 7, 23), True),
+        (date(2020, 7, 24), True),
+        (date(2020, 8, 10), True),
+        (date(2020, 8, 11), False),
+        (date(2020, 10, 12), False),
+        (date(2021, 7, 19), False),
+        (date(2021, 7, 22), True),
+        (date(2021, 7, 23), True),
+        (date(2021, 8, 9), True),
+        (date(2021, 8, 11), False),
+        (date(2021, 10, 11), False),
+    ],
+)
+def test_substitute_citizens_and_special_holidays(day, off):
+    assert service_schedule.is_off_day(day) is off
+
+
+def test_table_follows_holiday_rules_over_full_range():
+    # 祝日（移動を反映）から振替休日・国民の休日を 1 日ずつ求め、ビット演算で作ったテーブルと比べる
+    first, last = service_schedule.HOLIDAY_TABLE_FIRST_YEAR, service_schedule.HOLIDAY_TABLE_LAST_YEAR
+    national = set()
+    for year in range(first, last + 1):
+        national |= service_schedule._base_japan_holidays(year)
+    national |= {date.fromisoformat(text) for text in service_schedule.SPECIAL_HOLIDAYS["add"]}
+    national -= {date.fromisoformat(text) for text in service_schedule.SPECIAL_HOLIDAYS["remove"]}
+    expected = set(national)
+    for holiday in national:
+        if holiday.weekday() == 6:
+            day = holiday + timedelta(days=1)
+            while day in national:
+                day += timedelta(days=1)
+            expected.add(day)
+    for holiday in national:
+        day = holiday + timedelta(days=1)
+        if day not in national and day + timedelta(days=1) in national:
+            expected.add(day)
+    for year in range(first, last + 1):
+        assert service_schedule.japan_holidays(year) == {day for day in expected if day.year == year}, year
+
+
+def test_bundled_table_matches_rules():
+    with open(service_schedule.HOLIDAY_TABLE_FILE, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    overrides = service_schedule._load_holiday_overrides()
+    first, last = service_schedule.HOLIDAY_TABLE_FIRST_YEAR, service_schedule.HOLIDAY_TABLE_LAST_YEAR
+    assert data["fingerprint"] == service_schedule._holiday_table_fingerprint(first, last, overrides)
+    assert base64.b64decode(data["bitmap"]) == service_schedule.build_holiday_table(first, last, overrides)
+    assert service_schedule.HOLIDAY_TABLE_SOURCE == "file"
+
+
+def test_years_outside_table_are_built_on_demand():
+    assert date(2061, 1, 10) in service_schedule.japan_holidays(2061)
+    assert service_schedule.is_off_day(date(2006, 1, 9))
+    assert not service_schedule.is_off_day(date(2006, 1, 10))
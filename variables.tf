@@ -686,6 +686,51 @@ variable "service_control_schedule_overwrite" {
   default     = true
 }
 
+variable "service_control_holiday_overrides" {
+  description = "Extra off-days for the service control schedule on top of the built-in Japanese holiday calendar. add lists government-announced special holidays and remove lists holidays that were moved (YYYY-MM-DD)."
+  type = object({
+    add    = optional(list(string), [])
+    remove = optional(list(string), [])
+  })
+  default = {}
+}
+
+variable "service_control_prewarm" {
+  description = "Predictive pre-warm for the service control scheduler. When enabled, services with an idle autostop alarm are started lead_minutes before hours in which WAF CountedRequests were seen on at least min_probability of the same weekday (or weekday holiday) over the last lookback_days; the idle alarm still stops them afterwards."
+  type = object({
+    enabled         = optional(bool, false)
+    lead_minutes    = optional(number, 15)
+    lookback_days   = optional(number, 28)
+    min_probability = optional(number, 0.5)
+  })
+  default = {}
+}
+
+variable "ecs_logs_duplicate_routes" {
+  description = "Routing table for the ECS log duplicator Lambda. Empty keeps the default copy from /aws/ecs/<realm>/<service>/<container> to /aws/ecs/<realm>/<service>. target_log_group accepts {realm}, {service} and {container}; target_log_stream accepts {log_stream} and {container}. Targets must stay under /aws/ecs/<realm>/<name_prefix>-*."
+  type = list(object({
+    name              = optional(string)
+    realms            = optional(list(string))
+    services          = optional(list(string))
+    containers        = optional(list(string))
+    target_log_group  = optional(string)
+    target_log_stream = optional(string)
+    pattern           = optional(string)
+    sample_rate       = optional(number)
+  }))
+  default = []
+
+  validation {
+    condition     = alltrue([for route in var.ecs_logs_duplicate_routes : route.target_log_group != "/aws/ecs/{realm}/{service}/{container}"])
+    error_message = "ecs_logs_duplicate_routes target_log_group must not be the source log group (/aws/ecs/{realm}/{service}/{container}); the duplicator would re-trigger itself."
+  }
+
+  validation {
+    condition     = alltrue([for route in var.ecs_logs_duplicate_routes : route.target_log_group == null || can(regex("^/aws/ecs/[^/]+/", route.target_log_group))])
+    error_message = "ecs_logs_duplicate_routes target_log_group must stay under /aws/ecs/<realm>/ (the duplicator may only write to /aws/ecs/<realm>/<name_prefix>-*)."
+  }
+}
+
 variable "service_control_metrics_stream_services" {
   description = "ECS service keys to export CloudWatch Metric Streams to S3 (e.g., n8n, zulip, gitlab). Use \"synthetics\" to include CloudWatch Synthetics metrics."
   type        = map(bool)